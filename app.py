@@ -1,27 +1,53 @@
 import os
 import io
 import re
+import sys
+import gzip
 import json
 import hmac
 import uuid
 import math
 import time
+import shutil
+import hashlib
+import collections
+import resource
 import zipfile
+import tempfile
 import requests
-import pyodbc
+import numpy as np
 import pandas as pd
 import threading
+import functools
+import contextlib
+import contextvars
+import tracemalloc
 from typing import Optional, Tuple
-from urllib.parse import urlparse, quote_plus
-from datetime import datetime, timedelta
-from sqlalchemy import create_engine, text
-from flask import Flask, request, jsonify
+from urllib.parse import urlparse, quote, quote_plus
+from datetime import datetime, timedelta, timezone
+from http.cookiejar import DefaultCookiePolicy
+from sqlalchemy import (
+    create_engine, event, text, inspect, bindparam, case, MetaData, Table, Column,
+    String, Date, DateTime, BigInteger, Integer, Float, LargeBinary, UnicodeText,
+)
+from sqlalchemy.exc import IntegrityError
+from flask import Flask, request, jsonify, Response, g
+from werkzeug.http import http_date
 from zoneinfo import ZoneInfo
+from prometheus_client import (
+    Counter, Histogram, CollectorRegistry, generate_latest,
+    CONTENT_TYPE_LATEST, REGISTRY, multiprocess,
+)
 
 app = Flask(__name__)
 
 # 1. CONFIGURAÇÕES
 
+# Backend de armazenamento: "mssql" (produção) ou "sqlite" (execução local,
+# profiling e benchmarks — um arquivo por schema em BANCO_SQLITE_DIR)
+BANCO_BACKEND     = os.getenv("BANCO_BACKEND", "mssql").lower()
+BANCO_SQLITE_DIR  = os.getenv("BANCO_SQLITE_DIR", "/tmp/weebhook_btg_db")
+
 SERVER_NAME       = os.getenv("SERVER_NAME")
 DATABASE_NAME     = os.getenv("DATABASE_NAME")
 USERNAME          = os.getenv("USERNAME")
@@ -33,9 +59,17 @@ BTG_CLIENT_SECRET = os.getenv("BTG_CLIENT_SECRET")
 URL_REPORT_NNM      = os.getenv("PARTNER_REPORT_URL_NNM")
 URL_REPORT_BASE     = os.getenv("PARTNER_REPORT_URL_BASEBTG")
 URL_REPORT_CUSTODIA = os.getenv("PARTNER_REPORT_URL_CUSTODIA")
-URL_POSICAO_PARTNER = "https://api.btgpactual.com/iaas-api-position/api/v1/position/partner"
-URL_POSICAO_REFRESH = "https://api.btgpactual.com/iaas-api-position/api/v1/position/refresh"
-URL_SALDO_CC        = "https://api.btgpactual.com/api-account-balance/api/v1/account-balance/list"
+# Base da API BTG — sobrescrita só para apontar a simuladores locais (teste de carga)
+URL_BTG_API         = os.getenv("BTG_API_BASE_URL", "https://api.btgpactual.com").rstrip("/")
+URL_BTG_TOKEN       = f"{URL_BTG_API}/iaas-auth/api/v1/authorization/oauth2/accesstoken"
+URL_POSICAO_PARTNER = f"{URL_BTG_API}/iaas-api-position/api/v1/position/partner"
+URL_POSICAO_REFRESH = f"{URL_BTG_API}/iaas-api-position/api/v1/position/refresh"
+URL_SALDO_CC        = f"{URL_BTG_API}/api-account-balance/api/v1/account-balance/list"
+URL_PERFORMANCE     = f"{URL_BTG_API}/iaas-profitability/api/v1/performance-report/account"
+URL_CARTEIRAS_RECOM = f"{URL_BTG_API}/iaas-recommended-equities/api/v1/recommended-equities-allocation"
+# Callback dos relatórios de performance — URL pública https do
+# /webhook/performance; obrigatória para /trigger/performance-lote
+URL_CALLBACK_PERFORMANCE = os.getenv("PERFORMANCE_CALLBACK_URL", "")
 
 SHAREPOINT_LINKS = [
     ("RODRIGO DE MELLO D’ELIA",         "https://netorg18892072-my.sharepoint.com/:x:/g/personal/joao_aquino_atriacm_com_br/IQBVuGicHybdRrC4d1MtFO8vAbY4Kw4m4_8gNo8EKu3BN4I?download=1"),
@@ -62,13 +96,46 @@ DOMINIOS_PERMITIDOS = {
     "api.btgpactual.com",
     "api.ipify.org"
 }
+# Hosts extras (host:porta, separados por vírgula) aceitos também via http —
+# só para simuladores locais do BTG/S3 em teste de carga. Nunca em produção.
+DOMINIOS_LOCAIS = {
+    d.strip() for d in os.getenv("DOMINIOS_DOWNLOAD_LOCAIS", "").split(",") if d.strip()
+}
 
 app.config["MAX_CONTENT_LENGTH"] = 50 * 1024 * 1024
 
+# Rotas com histograma de latência no /metrics
+PREFIXOS_ROTAS_MEDIDAS = ("/webhook/", "/trigger/")
+
+# Arquivo dos feeds brutos: "banco" (tabela arquivo_raw) ou "disco"
+ARQUIVO_RAW_DESTINO       = os.getenv("ARQUIVO_RAW_DESTINO", "banco")
+ARQUIVO_RAW_DIR           = os.getenv("ARQUIVO_RAW_DIR", "/var/data/arquivo_raw")
+ARQUIVO_RAW_RETENCAO_DIAS = int(os.getenv("ARQUIVO_RAW_RETENCAO_DIAS", "90"))
+
 # Janela curta da tabela de fatos NNM (dias relativos ao max do CSV)
 DIAS_FATO_NNM = 4
 JANELA_CAPTACAO_DIAS = 4
 
+# Históricos com layout particionado por mês + columnstore (só SQL Server;
+# migração e manutenção em /admin/particoes) → coluna de partição.
+# Desligado por padrão: o DDL (partition function/scheme, CCI, SWITCH) ainda
+# não rodou numa instância real — ligar com PARTICIONAMENTO_MSSQL=1 depois de
+# validar em homologação. Columnstore sobre NVARCHAR(max) (colunas texto do
+# to_sql) exige SQL Server 2017+; a migração recusa versões anteriores.
+PARTICIONAMENTO_ATIVO = os.getenv("PARTICIONAMENTO_MSSQL", "0") == "1"
+TABELAS_PARTICIONADAS = {
+    "pl_historico_diario":      "Data",
+    "base_btg_snapshot_diario": "Data",
+    "captacao_historico":       "DATA",
+}
+PARTICOES_FUTURAS = 2   # meses vazios mantidos à frente — o SPLIT nunca move dados
+VERSAO_MINIMA_COLUMNSTORE = 14   # SQL Server 2017 (CCI com colunas LOB)
+
+# Snapshot diário da base: "diario" grava o livro inteiro em
+# base_btg_snapshot_diario todo dia; "scd2" grava em base_btg_snapshot_scd só
+# as versões que mudaram (valid_from/valid_to) — PL do dia vem do pl_historico_diario
+SNAPSHOT_BASE_MODO = os.getenv("SNAPSHOT_BASE_MODO", "diario")
+
 # 2. CONSTANTES DE NEGÓCIO — centralizadas para facilitar manutenção
 
 # Mapeamento de colunas do CSV do BTG → padrão interno
@@ -86,19 +153,36 @@ COLUNAS_RENAME_BASE_BTG = {
 # Faixas consolidadas em "Ate 300k"
 FAIXAS_ATE_300K = {"Ate 50K", "Entre 50k e 100k", "Entre 100k e 300k"}
 
-# Correções de assessor conhecidas — aplicadas em todos os pontos da app
+# Correções de assessor conhecidas — aplicadas em todos os pontos da app,
+# exceto PL Base. Regras extras podem vir da tabela correcoes_assessor.
 CORRECOES_ASSESSOR = {
     "RODRIGO DE MELLO D?ELIA": "RODRIGO DE MELLO D’ELIA",
     "RODRIGO DE MELLO DELIA":  "RODRIGO DE MELLO D’ELIA",
     "MURILO LUIZ SILVA GINO":  "IZADORA VILLELA FREITAS",
 }
 
+# Correções próprias do PL Base — grafia canônica do histórico já gravado
+# (D'ELIA com apóstrofo ASCII); meses fechados não são reescritos
+CORRECOES_ASSESSOR_PL_BASE = {
+    "RODRIGO DE MELLO DELIA":    "RODRIGO DE MELLO D'ELIA",
+    "RODRIGO DE MELLO D?ELIA":   "RODRIGO DE MELLO D'ELIA",
+    "ROSANA PAVANI":             "ROSANA APARECIDA PAVANI DA SILVA",
+    "FERNANDO DOMINGUES":        "FERNANDO DOMINGUES DA SILVA",
+    "MURILO LUIZ SILVA GINO":    "IZADORA VILLELA FREITAS",
+}
+
 # Correções manuais por conta específica
 CORRECOES_CONTA_ASSESSOR = {
     "590732": "JOSE AUGUSTO ALVES DE PAULA FILHO",
     "299305": "JOSE AUGUSTO ALVES DE PAULA FILHO",
 }
 
+# Colunas da posição usadas para achar Setor/Subsetor, em ordem de preferência
+COLUNAS_MATCH_SETOR = ["Ativo", "Emissor"]
+
+# Tipo de captação dos débitos de saída de conta
+TIPO_SAIDA_CONTA = "Saída de conta"
+
 # Contas de controle interno — ignoradas no entradas/saídas
 CONTAS_IGNORAR = {"1983816", "1106619"}
 
@@ -114,6 +198,12 @@ COLUNAS_SNAPSHOT = [
     "nm_partner", "email", "email_assessor",
 ]
 
+# Colunas do snapshot levadas para Entradas_e_saidas_consolidado
+COLUNAS_MOVIMENTACAO = [
+    "Conta", "Nome", "Assessor", "PL Total", "PL Declarado",
+    "Faixa Cliente", "Data Vínculo",
+]
+
 # Colunas salvas no pl_historico_diario
 # Mapeamento: nome da API (base) → nome da coluna no banco
 COLUNAS_PL_HISTORICO = [
@@ -121,6 +211,7 @@ COLUNAS_PL_HISTORICO = [
     "Faixa Cliente", "Data Vínculo",
     "pl_conta_corrente", "pl_fundos", "pl_renda_fixa",
     "pl_renda_variavel", "pl_previdencia", "pl_derivativos",
+    "pl_valores_transito",
 ]
 RENAME_PL_HISTORICO = {
     "pl_conta_corrente": "Conta Corrente",
@@ -129,8 +220,90 @@ RENAME_PL_HISTORICO = {
     "pl_renda_variavel":  "Renda Variável",
     "pl_previdencia":    "Previdência",
     "pl_derivativos":    "Derivativos",
+    "pl_valores_transito": "Valores em Trânsito",
+}
+
+# Snapshot em modo SCD2 — valores de PL mudam todo dia e não abrem versão:
+# ficam só no pl_historico_diario e são recompostos de lá na leitura
+TABELA_SNAPSHOT_SCD = "base_btg_snapshot_scd"
+VIEW_SNAPSHOT_SCD   = "vw_base_btg_snapshot_scd"
+COLUNAS_SNAPSHOT_VALORES = [
+    "PL Total", "PL Declarado",
+    "pl_conta_corrente", "pl_fundos", "pl_renda_fixa",
+    "pl_renda_variavel", "pl_previdencia", "pl_derivativos",
+    "pl_valores_transito",
+]
+COLUNAS_SCD_RASTREADAS = [
+    c for c in COLUNAS_SNAPSHOT if c != "Conta" and c not in COLUNAS_SNAPSHOT_VALORES
+]
+COLUNAS_DATA_SNAPSHOT = ["Data Vínculo", "Data de Abertura", "dt_nascimento"]
+
+# Relatório de custódia — lido em blocos para não materializar o CSV inteiro
+CUSTODIA_LINHAS_BLOCO   = int(os.getenv("CUSTODIA_LINHAS_BLOCO", "50000"))
+COLUNAS_DATA_CUSTODIA   = ["referenceDate", "dataInicio", "fixingDate", "dataKnockIn"]
+# Colunas importadas do CSV de custódia (usecols) — coluna do cabeçalho fora
+# da lista não é importada (aviso no log)
+COLUNAS_CUSTODIA = [
+    "account", "referenceDate", "dataInicio", "fixingDate", "dataKnockIn",
+    "produto", "ativo", "emissor", "quantidade", "valorBruto", "valorLiquido",
+]
+# Tipo de cada coluna importada: "str" ou dtype numérico. Datas entram como
+# texto e são convertidas com %d/%m/%Y. Coluna importada sem tipo aqui é
+# decidida por uma varredura do arquivo antes da carga (só ela é lida)
+TIPOS_CUSTODIA = {
+    "account":      "str",
+    "produto":      "str",
+    "ativo":        "str",
+    "emissor":      "str",
+    "quantidade":   "float64",
+    "valorBruto":   "float64",
+    "valorLiquido": "float64",
 }
 
+# Relatórios de performance — ZIP acima disso vai para disco; PDFs gravados em lotes
+PERFORMANCE_ZIP_MEMORIA_MAX = 32 * 1024 * 1024
+PERFORMANCE_LOTE_BYTES      = int(os.getenv("PERFORMANCE_LOTE_BYTES", str(64 * 1024 * 1024)))
+# Download de PDF — bytes lidos do banco por SUBSTRING a cada passo do streaming
+PERFORMANCE_BLOCO_DOWNLOAD  = 512 * 1024
+
+# Disparo em lote de relatórios de performance — limite da API BTG: 50 req/min
+PERFORMANCE_REQ_POR_MINUTO = 50
+PERFORMANCE_LOTE_RODADAS   = int(os.getenv("PERFORMANCE_LOTE_RODADAS", "3"))
+# Espera pelos callbacks antes de pedir de novo as contas que não chegaram
+PERFORMANCE_LOTE_ESPERA    = int(os.getenv("PERFORMANCE_LOTE_ESPERA_SEGUNDOS", "600"))
+
+# Posição — tempo que o BTG leva para gerar o arquivo depois do refresh
+POSICAO_ESPERA_REFRESH = int(os.getenv("POSICAO_ESPERA_REFRESH_SEGUNDOS", "90"))
+
+# Jobs em background: intervalo do heartbeat e silêncio após o qual um job
+# "executando" é dado como abandonado (worker morto por timeout/redeploy)
+JOB_HEARTBEAT_SEGUNDOS = int(os.getenv("JOB_HEARTBEAT_SEGUNDOS", "30"))
+JOB_ABANDONADO_APOS    = JOB_HEARTBEAT_SEGUNDOS * 4
+
+# Instrumentação de memória por etapa (tracemalloc + RSS) — cara, só sob demanda
+MEMORIA_INSTRUMENTADA = os.getenv("MEMORIA_INSTRUMENTADA", "0") == "1"
+MEMORIA_LIMIAR_MB     = float(os.getenv("MEMORIA_LIMIAR_MB", "200"))
+MEMORIA_TOP_ALOCACOES = 10
+
+# Perfil de SQL por comando normalizado (por worker) — comandos acima do
+# limiar vão para o log e para a lista de lentos de /admin/sql
+SQL_PERFIL          = os.getenv("SQL_PERFIL", "1") == "1"
+SQL_LENTO_MS        = float(os.getenv("SQL_LENTO_MS", "2000"))
+SQL_PERFIL_MAX      = 500   # comandos distintos por worker; o excedente vai para "(outros)"
+SQL_LENTOS_RECENTES = 200
+
+# Aquecimento do worker logo após o fork (gunicorn post_fork), em background:
+# abre a conexão do pool com o banco e a sessão TLS com o BTG antes da
+# primeira requisição. Desligado por padrão — no plano free cada boot conecta.
+AQUECER_NO_BOOT = os.getenv("AQUECER_NO_BOOT", "0") == "1"
+
+# Profiling sob demanda (/admin/perfil). O diretório é compartilhado pelos
+# workers: o pedido "próxima execução" é um arquivo em PERFIL_DIR/pendentes
+PERFIL_DIR          = os.getenv("PERFIL_DIR", "/tmp/weebhook_btg_perfis")
+PERFIL_INTERVALO_MS = 5
+PERFIL_TOP          = 30
+PERFIL_RETENCAO     = 50    # artefatos mantidos; os mais antigos são apagados
+
 # 3. INFRAESTRUTURA
 
 CONN_STR = (
@@ -143,19 +316,256 @@ CONN_STR = (
 )
 
 
+# Deslocamento fixo usado por now_brasilia — para converter os horários
+# gravados (naive) de volta a UTC
+UTC_BRASILIA = timezone(timedelta(hours=-3))
+
+
 def now_brasilia() -> datetime:
     return datetime.utcnow() - timedelta(hours=3)
 
 
-def get_engine():
-    return create_engine(
-        f"mssql+pyodbc:///?odbc_connect={CONN_STR}",
-        fast_executemany=True
+def _inicio_processo() -> float:
+    """Epoch em que este processo nasceu (exec ou fork), via /proc; fora do Linux, agora."""
+    try:
+        with open("/proc/self/stat") as f:
+            inicio_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + inicio_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.time()
+
+
+# Partida deste processo — /healthz e log [BOOT]. Com preload_app o import
+# acontece no master e iniciar_worker() reinicia o relógio em cada worker.
+BOOT = {
+    "pid":                 os.getpid(),
+    "inicio":              _inicio_processo(),
+    "importacao_s":        None,
+    "primeira_resposta_s": None,
+    "aquecimento":         None,
+}
+
+
+# Métricas Prometheus — com PROMETHEUS_MULTIPROC_DIR (gunicorn.conf.py) cada
+# worker grava em arquivos próprios e /metrics agrega todos
+FAIXAS_LATENCIA = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+METRICA_HTTP = Histogram(
+    "webhook_btg_http_request_duration_seconds",
+    "Latência das rotas /webhook/* e /trigger/*",
+    ["rota", "metodo", "status"], buckets=FAIXAS_LATENCIA,
+)
+METRICA_JOB = Histogram(
+    "webhook_btg_job_duration_seconds",
+    "Duração dos pipelines (webhooks e jobs em background) por resultado",
+    ["pipeline", "status"], buckets=FAIXAS_LATENCIA,
+)
+METRICA_SQL = Histogram(
+    "webhook_btg_sql_duration_seconds",
+    "Latência dos comandos SQL por operação",
+    ["operacao"], buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30, 120),
+)
+METRICA_HTTP_SAIDA = Histogram(
+    "webhook_btg_outbound_request_duration_seconds",
+    "Latência das chamadas HTTP de saída (BTG, S3, SharePoint)",
+    ["destino", "status"], buckets=FAIXAS_LATENCIA,
+)
+METRICA_BYTES_BAIXADOS = Counter(
+    "webhook_btg_downloaded_bytes",
+    "Bytes baixados por destino",
+    ["destino"],
+)
+
+
+def _instrumentar_engine(engine):
+    """Conta e mede cada comando SQL executado pelo engine."""
+    @event.listens_for(engine, "before_cursor_execute")
+    def _antes(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("_inicio_sql", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _depois(conn, cursor, statement, parameters, context, executemany):
+        inicio = conn.info["_inicio_sql"].pop()
+        duracao = time.perf_counter() - inicio
+        operacao = (statement.lstrip().split(None, 1) or ["?"])[0].upper()
+        METRICA_SQL.labels(operacao=operacao[:12]).observe(duracao)
+        if SQL_PERFIL:
+            _perfil_sql.registrar(
+                statement, duracao, getattr(cursor, "rowcount", -1),
+                len(parameters) if executemany and parameters else 1,
+            )
+
+    @event.listens_for(engine, "handle_error")
+    def _erro(contexto):
+        pilha = contexto.connection.info.get("_inicio_sql") if contexto.connection else None
+        if pilha:
+            pilha.pop()
+
+
+_RE_SQL_LITERAL   = re.compile(r"N?'(?:[^']|'')*'")
+_RE_SQL_NUMERO    = re.compile(r"(?<![\w.@:])-?\d+(?:\.\d+)?\b")
+_RE_SQL_LISTA_IN  = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+_RE_SQL_VALUES    = re.compile(r"(\(\s*\?(?:\s*,\s*\?)*\s*\))(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))+")
+_RE_SQL_PARAMETRO = re.compile(r"(?<![:\w]):\w+|%\(\w+\)s")
+_RE_SQL_ESPACO    = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=4096)
+def normalizar_sql(comando: str) -> str:
+    """
+    Forma canônica do comando para agregação: literais e parâmetros viram ?,
+    listas IN (?, ?, …) e VALUES multi-linha colapsam — ler_por_chaves com
+    1000 ou 37 chaves cai na mesma linha do perfil.
+    """
+    sql = _RE_SQL_LITERAL.sub("?", comando)
+    sql = _RE_SQL_PARAMETRO.sub("?", sql)
+    sql = _RE_SQL_NUMERO.sub("?", sql)
+    sql = _RE_SQL_LISTA_IN.sub("IN (?…)", sql)
+    sql = _RE_SQL_VALUES.sub(r"\1, …", sql)
+    return _RE_SQL_ESPACO.sub(" ", sql).strip()[:2000]
+
+
+class PerfilSQL:
+    """
+    Tempo acumulado por (pipeline, etapa, comando normalizado) neste worker,
+    mais os últimos comandos acima de SQL_LENTO_MS. Pipeline e etapa vêm da
+    execução em andamento (@pipeline / etapa); fora dela ficam como "-".
+    """
+
+    def __init__(self):
+        self._lock   = threading.Lock()
+        self._inicio = now_brasilia()
+        self._stats  = {}
+        self._lentos = collections.deque(maxlen=SQL_LENTOS_RECENTES)
+
+    def registrar(self, comando: str, duracao: float, linhas: int, lote: int):
+        pipeline_nome, etapa_nome = _contexto_execucao()
+        sql    = normalizar_sql(comando)
+        linhas = linhas if linhas is not None and linhas >= 0 else None
+        with self._lock:
+            chave = (pipeline_nome, etapa_nome, sql)
+            if chave not in self._stats and len(self._stats) >= SQL_PERFIL_MAX:
+                chave = (pipeline_nome, etapa_nome, "(outros)")
+            s = self._stats.get(chave)
+            if s is None:
+                s = self._stats[chave] = {"execucoes": 0, "total_s": 0.0, "max_s": 0.0,
+                                          "linhas": 0, "lote": 0}
+            s["execucoes"] += 1
+            s["total_s"]   += duracao
+            s["max_s"]      = max(s["max_s"], duracao)
+            s["linhas"]    += linhas or 0
+            s["lote"]      += lote
+
+            if duracao * 1000 < SQL_LENTO_MS:
+                return
+            self._lentos.append({
+                "quando":   now_brasilia().isoformat(timespec="seconds"),
+                "pipeline": pipeline_nome,
+                "etapa":    etapa_nome,
+                "duracao_s": round(duracao, 3),
+                "linhas":   linhas,
+                "lote":     lote,
+                "sql":      sql,
+            })
+        print(
+            f"[SQL LENTO] {pipeline_nome}/{etapa_nome} {duracao:.2f}s | linhas {linhas} | "
+            f"lote {lote} | {sql[:300]}",
+            flush=True
+        )
+
+    def resumo(self, ordem: str = "total_s", limite: int = 50,
+               pipeline_nome: Optional[str] = None) -> dict:
+        with self._lock:
+            itens = [
+                {"pipeline": p, "etapa": e, "sql": sql, **s}
+                for (p, e, sql), s in self._stats.items()
+                if pipeline_nome is None or p == pipeline_nome
+            ]
+            lentos = list(self._lentos)
+        for item in itens:
+            item["media_ms"] = round(item["total_s"] / item["execucoes"] * 1000, 2)
+            item["total_s"]  = round(item["total_s"], 3)
+            item["max_s"]    = round(item["max_s"], 3)
+        itens.sort(key=lambda i: i[ordem], reverse=True)
+        if pipeline_nome is not None:
+            lentos = [l for l in lentos if l["pipeline"] == pipeline_nome]
+        return {
+            "desde":      self._inicio.isoformat(timespec="seconds"),
+            "limiar_ms":  SQL_LENTO_MS,
+            "distintos":  len(itens),
+            "comandos":   itens[:limite],
+            "lentos":     lentos[::-1],
+        }
+
+    def zerar(self):
+        with self._lock:
+            self._stats.clear()
+            self._lentos.clear()
+            self._inicio = now_brasilia()
+
+
+_perfil_sql = PerfilSQL()
+
+
+def criar_engine_sqlite(diretorio: str):
+    """
+    Engine SQLite que faz o papel do SQL Server: o schema dbo é um segundo
+    arquivo anexado, então dbo.tabela e [coluna com espaço] funcionam sem
+    alteração. WAL permite leitura concorrente entre threads e workers.
+    """
+    os.makedirs(diretorio, exist_ok=True)
+    caminho_dbo = os.path.join(diretorio, f"{SCHEMA_DEFAULT}.sqlite")
+    engine = create_engine(
+        f"sqlite:///{os.path.join(diretorio, 'main.sqlite')}",
+        connect_args={"timeout": 60, "check_same_thread": False},
     )
 
+    @event.listens_for(engine, "connect")
+    def _anexar_schema(conn_dbapi, _registro):
+        conn_dbapi.execute(f"ATTACH DATABASE '{caminho_dbo}' AS {SCHEMA_DEFAULT}")
+        conn_dbapi.execute(f"PRAGMA {SCHEMA_DEFAULT}.journal_mode=WAL")
+
+    return engine
+
+
+_engine      = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """
+    Engine único por worker — o pool reaproveita as conexões entre chamadas.
+    Criado sob lock: o aquecimento em background pode correr junto com a
+    primeira requisição. O driver (pyodbc) só é importado aqui.
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                if BANCO_BACKEND == "sqlite":
+                    engine = criar_engine_sqlite(BANCO_SQLITE_DIR)
+                else:
+                    engine = create_engine(
+                        f"mssql+pyodbc:///?odbc_connect={CONN_STR}",
+                        fast_executemany=True,
+                        pool_pre_ping=True,
+                    )
+                _instrumentar_engine(engine)
+                _engine = engine
+    return _engine
+
+
+def _intervalo_dia(dia) -> Tuple[datetime, datetime]:
+    """[início, fim) de um dia — filtro por intervalo aproveita índice em Data."""
+    inicio = pd.Timestamp(dia).normalize().to_pydatetime()
+    return inicio, inicio + timedelta(days=1)
+
 
 def registrar_log(atividade: str, status: str, linhas: int = 0, mensagem: str = ""):
     try:
+        garantir_tabela(TABELA_LOGS_ATIVIDADES)
         engine = get_engine()
         with engine.begin() as conn:
             conn.execute(text("""
@@ -174,6 +584,13 @@ def registrar_log(atividade: str, status: str, linhas: int = 0, mensagem: str =
         print(f"[AVISO] Falha ao gravar log no banco: {e}")
 
 
+def _chunksize_seguro(df: pd.DataFrame) -> int:
+    """Linhas por INSERT respeitando o limite de 2.100 parâmetros do pyodbc."""
+    num_colunas  = len(df.columns)
+    limit_params = math.floor(2090 / num_colunas) if num_colunas > 0 else 1000
+    return max(1, min(limit_params, 1000))
+
+
 def salvar_df_otimizado(
     df: pd.DataFrame,
     nome_tabela: str,
@@ -188,49 +605,1545 @@ def salvar_df_otimizado(
     if df.empty:
         return
 
-    num_colunas    = len(df.columns)
-    limit_params   = math.floor(2090 / num_colunas) if num_colunas > 0 else 1000
-    safe_chunksize = max(1, min(limit_params, 1000))
-
     engine = get_engine()
-    with engine.begin() as conn:
+    with etapa(f"gravar:{nome_tabela}", linhas=len(df)), engine.begin() as conn:
+        if if_exists == "replace":
+            travar_tabela(conn, nome_tabela, schema)
         df.to_sql(
             name=nome_tabela,
             con=conn,
             schema=schema,
             if_exists=if_exists,
             index=False,
-            chunksize=safe_chunksize,
+            chunksize=_chunksize_seguro(df),
             method="multi"
         )
 
         if col_pk and if_exists == "replace":
             try:
+                if conn.dialect.name == "sqlite":
+                    # SQLite não acrescenta PK a tabela existente — índice único
+                    conn.execute(text(
+                        f'CREATE UNIQUE INDEX {schema}."pk_{nome_tabela}" '
+                        f'ON "{nome_tabela}" ("{col_pk}")'
+                    ))
+                else:
+                    conn.execute(text(
+                        f'ALTER TABLE {schema}."{nome_tabela}" '
+                        f'ALTER COLUMN "{col_pk}" VARCHAR(450) NOT NULL'
+                    ))
+                    conn.execute(text(
+                        f'ALTER TABLE {schema}."{nome_tabela}" '
+                        f'ADD PRIMARY KEY ("{col_pk}")'
+                    ))
+            except Exception as e:
+                print(f"[AVISO] PK em {nome_tabela}: {e}")
+
+
+def salvar_particao(
+    df: pd.DataFrame,
+    nome_tabela: str,
+    coluna: str,
+    inicio,
+    fim=None,
+    schema: str = "dbo"
+):
+    """
+    Substitui só a faixa [inicio, fim) de `coluna` na tabela (sem `fim`, tudo
+    a partir de `inicio`): DELETE da faixa e append do DataFrame na mesma
+    transação. O restante da tabela não é lido nem reescrito. Se a tabela
+    ainda não existe, é criada pelo append. Históricos já migrados para o
+    layout particionado (TABELAS_PARTICIONADAS) são gravados por switch.
+    """
+    engine = get_engine()
+    with etapa(f"gravar:{nome_tabela}", linhas=len(df)), engine.begin() as conn:
+        travar_tabela(conn, nome_tabela, schema)
+        if _salvar_por_switch(conn, df, nome_tabela, coluna, inicio, fim, schema):
+            return
+        if inspect(conn).has_table(nome_tabela, schema=schema):
+            apagar_faixa(conn, nome_tabela, coluna, inicio, fim, schema=schema)
+
+        if not df.empty:
+            df.to_sql(
+                name=nome_tabela,
+                con=conn,
+                schema=schema,
+                if_exists="append",
+                index=False,
+                chunksize=_chunksize_seguro(df),
+                method="multi"
+            )
+
+
+# Operações de armazenamento portáveis entre SQL Server e SQLite — o SQL
+# específico de cada backend fica concentrado aqui; os pipelines usam só
+# estas funções e SQL padrão
+
+# Funções que mudam de nome entre os backends
+FUNCOES_SQL = {
+    "mssql":  {"tamanho_blob": "DATALENGTH", "fatia_blob": "SUBSTRING"},
+    "sqlite": {"tamanho_blob": "LENGTH",     "fatia_blob": "SUBSTR"},
+}
+
+
+def funcao_sql(conn, nome: str) -> str:
+    return FUNCOES_SQL[conn.dialect.name][nome]
+
+
+def travar_tabela(conn, nome_tabela: str, schema: str = "dbo"):
+    """
+    Serializa, entre threads e workers, quem reescreve a mesma tabela — sem
+    isso dois replace simultâneos intercalam DROP/CREATE/INSERT. Deve ser o
+    primeiro comando da transação; o lock é solto no commit/rollback.
+    SQL Server: applock exclusivo por tabela. SQLite: BEGIN IMMEDIATE (trava
+    o banco para escrita e torna o DDL do to_sql parte da transação).
+    """
+    if conn.dialect.name == "sqlite":
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+        return
+    # sp_getapplock não levanta erro em timeout/deadlock — devolve código < 0;
+    # sem o THROW a carga seguiria sem o lock
+    conn.execute(
+        text("""
+            SET NOCOUNT ON;
+            DECLARE @r int;
+            EXEC @r = sp_getapplock @Resource = :recurso, @LockMode = 'Exclusive',
+                 @LockOwner = 'Transaction', @LockTimeout = :espera_ms;
+            IF @r < 0
+            BEGIN
+                DECLARE @msg nvarchar(400) = CONCAT(
+                    'sp_getapplock falhou (', @r, ') para ', :recurso);
+                THROW 51000, @msg, 1;
+            END
+        """),
+        {"recurso": f"gravar:{schema}.{nome_tabela}", "espera_ms": 600_000},
+    )
+
+
+def apagar_faixa(conn, nome_tabela: str, coluna: str, inicio, fim=None, schema: str = "dbo") -> int:
+    """
+    DELETE de [inicio, fim) em `coluna` (sem `fim`, tudo a partir de `inicio`).
+    Comparação direta na coluna, sem função em volta — aproveita índice.
+    """
+    sql    = f'DELETE FROM {schema}."{nome_tabela}" WHERE "{coluna}" >= :inicio'
+    params = {"inicio": inicio}
+    if fim is not None:
+        sql += f' AND "{coluna}" < :fim'
+        params["fim"] = fim
+    return conn.execute(text(sql), params).rowcount
+
+
+def ler_por_chaves(conn, sql: str, chaves, params: Optional[dict] = None,
+                   lote: int = 1000) -> pd.DataFrame:
+    """
+    Executa `sql` (com `IN :chaves`) em lotes de `lote` chaves, com parâmetros
+    em vez de lista literal — respeita o limite de 2.100 parâmetros do pyodbc.
+    """
+    consulta = text(sql).bindparams(bindparam("chaves", expanding=True))
+    chaves   = list(chaves)
+    partes = [
+        pd.read_sql(consulta, conn, params={**(params or {}), "chaves": chaves[i:i + lote]})
+        for i in range(0, max(len(chaves), 1), lote)
+    ]
+    return pd.concat(partes, ignore_index=True) if len(partes) > 1 else partes[0]
+
+
+@functools.lru_cache(maxsize=None)
+def _sql_upsert(dialeto: str, nome_tabela: str, colunas: tuple, chaves: tuple, schema: str):
+    alvo      = f'{schema}."{nome_tabela}"'
+    lista     = ", ".join(f'"{c}"' for c in colunas)
+    atualizar = [c for c in colunas if c not in chaves]
+
+    if dialeto == "mssql":
+        origem = ", ".join(f':{c} AS "{c}"' for c in colunas)
+        casar  = " AND ".join(f'alvo."{c}" = origem."{c}"' for c in chaves)
+        sets   = ", ".join(f'"{c}" = origem."{c}"' for c in atualizar)
+        return text(f"""
+            MERGE {alvo} AS alvo
+            USING (SELECT {origem}) AS origem ON {casar}
+            WHEN MATCHED THEN UPDATE SET {sets}
+            WHEN NOT MATCHED THEN
+                INSERT ({lista}) VALUES ({", ".join(f'origem."{c}"' for c in colunas)});
+        """)
+
+    sets = ", ".join(f'"{c}" = excluded."{c}"' for c in atualizar)
+    return text(f"""
+        INSERT INTO {alvo} ({lista}) VALUES ({", ".join(f":{c}" for c in colunas)})
+        ON CONFLICT ({", ".join(f'"{c}"' for c in chaves)}) DO UPDATE SET {sets}
+    """)
+
+
+def upsert(conn, nome_tabela: str, linhas: list, chaves: list, schema: str = "dbo"):
+    """
+    Insere ou atualiza `linhas` (dicts com as mesmas colunas) casando por
+    `chaves`, num único executemany: MERGE no SQL Server, INSERT ... ON
+    CONFLICT no SQLite (exige PK ou índice único nas chaves).
+    """
+    if not linhas:
+        return
+    sql = _sql_upsert(conn.dialect.name, nome_tabela, tuple(linhas[0]), tuple(chaves), schema)
+    conn.execute(sql, linhas)
+
+
+# Particionamento mensal + columnstore dos históricos (só SQL Server). Cada
+# tabela tem função/esquema próprios (pf_mensal_<t>/ps_mensal_<t>, RANGE RIGHT
+# no 1º dia do mês, tipo igual ao da coluna) e um clustered columnstore
+# (cci_<t>) alinhado. A carga diária troca as partições do período por
+# SWITCH: as partições saem para uma tabela de carga, recebem o DELETE e o
+# INSERT, são recompactadas (REBUILD) e voltam — tudo na mesma transação.
+
+def _nomes_particao(nome_tabela: str) -> Tuple[str, str, str]:
+    return f"pf_mensal_{nome_tabela}", f"ps_mensal_{nome_tabela}", f"cci_{nome_tabela}"
+
+
+def _inicio_mes(valor) -> datetime:
+    return pd.Timestamp(valor).to_period("M").to_timestamp().to_pydatetime()
+
+
+def _meses(inicio, fim) -> list:
+    """1º dia de cada mês de `inicio` a `fim`, inclusive."""
+    return [p.to_timestamp().to_pydatetime()
+            for p in pd.period_range(_inicio_mes(inicio), _inicio_mes(fim), freq="M")]
+
+
+def estado_particionamento(conn, nome_tabela: str, schema: str = "dbo") -> dict:
+    """Se a tabela existe, se está particionada/columnstore e índices que impedem o SWITCH."""
+    indices = conn.execute(text("""
+        SELECT i.index_id, i.name, i.type_desc, ds.type_desc AS espaco
+        FROM sys.indexes i
+        JOIN sys.data_spaces ds ON ds.data_space_id = i.data_space_id
+        WHERE i.object_id = OBJECT_ID(:objeto)
+    """), {"objeto": f"{schema}.{nome_tabela}"}).mappings().all()
+    base = [i for i in indices if i["index_id"] in (0, 1)]
+    return {
+        "existe":       bool(base),
+        "particionada": any(i["espaco"] == "PARTITION_SCHEME" for i in base),
+        "columnstore":  any(i["type_desc"] == "CLUSTERED COLUMNSTORE" for i in base),
+        "clusterizado_rowstore": any(i["type_desc"] == "CLUSTERED" for i in base),
+        # O SWITCH exige os mesmos índices na tabela de carga — só o CCI é recriado
+        "outros_indices": [i["name"] for i in indices if i["index_id"] > 1],
+    }
+
+
+def _tipo_coluna_particao(conn, nome_tabela: str, coluna: str, schema: str) -> str:
+    tipo, precisao = conn.execute(text("""
+        SELECT DATA_TYPE, DATETIME_PRECISION FROM INFORMATION_SCHEMA.COLUMNS
+        WHERE TABLE_SCHEMA = :schema AND TABLE_NAME = :tabela AND COLUMN_NAME = :coluna
+    """), {"schema": schema, "tabela": nome_tabela, "coluna": coluna}).one()
+    if tipo == "datetime2":
+        return f"datetime2({precisao})"
+    if tipo not in ("date", "datetime", "smalldatetime"):
+        raise ValueError(f"{nome_tabela}.{coluna} é {tipo} — partição mensal exige data")
+    return tipo
+
+
+def garantir_particoes_futuras(conn, nome_tabela: str):
+    """SPLIT dos meses que faltam até PARTICOES_FUTURAS à frente (partições vazias — só metadado)."""
+    pf, ps, _ = _nomes_particao(nome_tabela)
+    ultimo = conn.execute(text("""
+        SELECT MAX(CAST(prv.value AS datetime2)) FROM sys.partition_range_values prv
+        JOIN sys.partition_functions f ON f.function_id = prv.function_id
+        WHERE f.name = :pf
+    """), {"pf": pf}).scalar()
+    alvo = _inicio_mes(now_brasilia() + pd.DateOffset(months=PARTICOES_FUTURAS))
+    novos = [m for m in _meses(ultimo or alvo, alvo) if ultimo is None or m > ultimo]
+    for mes in novos:
+        conn.execute(text(f"ALTER PARTITION SCHEME {ps} NEXT USED [PRIMARY]"))
+        conn.execute(text(f"ALTER PARTITION FUNCTION {pf}() SPLIT RANGE ('{mes:%Y%m%d}')"))
+    return [f"{m:%Y-%m}" for m in novos]
+
+
+def migrar_para_particionado(nome_tabela: str, schema: str = "dbo") -> dict:
+    """
+    Cria função/esquema mensais (do mês do dado mais antigo até
+    PARTICOES_FUTURAS à frente) e converte a tabela (heap criado pelo
+    to_sql) em clustered columnstore particionado. Pesado: reescreve a
+    tabela inteira — rodar fora do horário das cargas.
+    """
+    coluna = TABELAS_PARTICIONADAS[nome_tabela]
+    pf, ps, cci = _nomes_particao(nome_tabela)
+    with get_engine().begin() as conn:
+        travar_tabela(conn, nome_tabela, schema)
+        estado = estado_particionamento(conn, nome_tabela, schema)
+        if not estado["existe"]:
+            return {"tabela": nome_tabela, "status": "inexistente"}
+        if estado["particionada"] and estado["columnstore"]:
+            return {"tabela": nome_tabela, "status": "já particionada",
+                    "particoes_criadas": garantir_particoes_futuras(conn, nome_tabela)}
+        if estado["clusterizado_rowstore"]:
+            raise RuntimeError(f"{nome_tabela} tem índice clusterizado rowstore — migrar manualmente")
+
+        versao = conn.execute(text(
+            "SELECT CAST(SERVERPROPERTY('ProductMajorVersion') AS int)"
+        )).scalar()
+        if versao is None or versao < VERSAO_MINIMA_COLUMNSTORE:
+            raise RuntimeError(f"columnstore com NVARCHAR(max) exige SQL Server 2017+ (versão {versao})")
+
+        tipo = _tipo_coluna_particao(conn, nome_tabela, coluna, schema)
+        minimo = conn.execute(text(
+            f'SELECT MIN("{coluna}") FROM {schema}."{nome_tabela}"'
+        )).scalar()
+        agora = now_brasilia()
+        limites = _meses(minimo or agora, agora + pd.DateOffset(months=PARTICOES_FUTURAS))
+        valores = ", ".join(f"'{m:%Y%m%d}'" for m in limites)
+
+        conn.execute(text(f"""
+            IF NOT EXISTS (SELECT 1 FROM sys.partition_functions WHERE name = '{pf}')
+                CREATE PARTITION FUNCTION {pf} ({tipo}) AS RANGE RIGHT FOR VALUES ({valores})
+        """))
+        conn.execute(text(f"""
+            IF NOT EXISTS (SELECT 1 FROM sys.partition_schemes WHERE name = '{ps}')
+                CREATE PARTITION SCHEME {ps} AS PARTITION {pf} ALL TO ([PRIMARY])
+        """))
+        conn.execute(text(
+            f'CREATE CLUSTERED COLUMNSTORE INDEX {cci} ON {schema}."{nome_tabela}" '
+            f'ON {ps}("{coluna}")'
+        ))
+    return {"tabela": nome_tabela, "status": "migrada", "particoes": len(limites) + 1,
+            "indices_que_impedem_switch": estado["outros_indices"]}
+
+
+def manutencao_particoes(schema: str = "dbo") -> dict:
+    """
+    Rotina mensal/diária: cria as partições dos próximos meses e comprime
+    os rowgroups em delta store (appends fora do switch, ex.: débitos de
+    saída em captacao_historico) com REORGANIZE só nas partições afetadas.
+    """
+    resultado = {}
+    for nome_tabela in TABELAS_PARTICIONADAS:
+        _, _, cci = _nomes_particao(nome_tabela)
+        with get_engine().begin() as conn:
+            travar_tabela(conn, nome_tabela, schema)
+            estado = estado_particionamento(conn, nome_tabela, schema)
+            if not (estado["particionada"] and estado["columnstore"]):
+                resultado[nome_tabela] = {"status": "não particionada"}
+                continue
+            criadas = garantir_particoes_futuras(conn, nome_tabela)
+            abertas = [p for (p,) in conn.execute(text("""
+                SELECT DISTINCT partition_number
+                FROM sys.dm_db_column_store_row_group_physical_stats
+                WHERE object_id = OBJECT_ID(:objeto) AND state_desc IN ('OPEN', 'CLOSED')
+            """), {"objeto": f"{schema}.{nome_tabela}"})]
+            for particao in abertas:
                 conn.execute(text(
-                    f'ALTER TABLE {schema}."{nome_tabela}" '
-                    f'ALTER COLUMN "{col_pk}" VARCHAR(450) NOT NULL'
+                    f'ALTER INDEX {cci} ON {schema}."{nome_tabela}" REORGANIZE '
+                    f'PARTITION = {int(particao)} WITH (COMPRESS_ALL_ROW_GROUPS = ON)'
                 ))
+        resultado[nome_tabela] = {"particoes_criadas": criadas, "reorganizadas": abertas}
+    return resultado
+
+
+def _salvar_por_switch(conn, df: pd.DataFrame, nome_tabela: str, coluna: str,
+                       inicio, fim, schema: str) -> bool:
+    """
+    Carga de salvar_particao por SWITCH: as partições mensais que cobrem
+    [inicio, fim) saem (metadado) para <tabela>_carga, recebem DELETE da
+    faixa + INSERT do DataFrame, são recompactadas e voltam. Devolve False
+    quando a tabela não está no layout particionado (ou tem índices que
+    impedem o SWITCH) — o chamador segue com DELETE + INSERT direto.
+    Leitores da tabela esperam o commit (Sch-M do SWITCH). Só com
+    PARTICIONAMENTO_ATIVO.
+    """
+    if (not PARTICIONAMENTO_ATIVO or conn.dialect.name != "mssql"
+            or nome_tabela not in TABELAS_PARTICIONADAS):
+        return False
+    estado = estado_particionamento(conn, nome_tabela, schema)
+    if not (estado["particionada"] and estado["columnstore"]) or estado["outros_indices"]:
+        return False
+
+    pf, ps, cci = _nomes_particao(nome_tabela)
+    garantir_particoes_futuras(conn, nome_tabela)
+
+    # Última data atingida: fim da faixa, maior data do DataFrame ou — sem
+    # fim — a maior já gravada a partir de inicio
+    candidatos = [inicio]
+    if fim is not None:
+        candidatos.append(fim - timedelta(microseconds=1))
+    else:
+        candidatos.append(conn.execute(text(
+            f'SELECT MAX("{coluna}") FROM {schema}."{nome_tabela}" WHERE "{coluna}" >= :inicio'
+        ), {"inicio": inicio}).scalar() or inicio)
+    if not df.empty:
+        candidatos.append(pd.Timestamp(df[coluna].max()).to_pydatetime())
+    p_ini, p_fim = conn.execute(
+        text(f"SELECT $PARTITION.{pf}(:a), $PARTITION.{pf}(:b)"),
+        {"a": min(candidatos), "b": max(candidatos)},
+    ).one()
+    particoes = range(int(p_ini), int(p_fim) + 1)
+
+    carga = f"{nome_tabela}_carga"
+    conn.execute(text(f"DROP TABLE IF EXISTS {schema}.\"{carga}\""))
+    conn.execute(text(f'SELECT TOP (0) * INTO {schema}."{carga}" FROM {schema}."{nome_tabela}"'))
+    conn.execute(text(
+        f'CREATE CLUSTERED COLUMNSTORE INDEX cci_{carga} ON {schema}."{carga}" ON {ps}("{coluna}")'
+    ))
+    for p in particoes:
+        conn.execute(text(
+            f'ALTER TABLE {schema}."{nome_tabela}" SWITCH PARTITION {p} TO {schema}."{carga}" PARTITION {p}'
+        ))
+
+    apagar_faixa(conn, carga, coluna, inicio, fim, schema=schema)
+    if not df.empty:
+        df.to_sql(name=carga, con=conn, schema=schema, if_exists="append", index=False,
+                  chunksize=_chunksize_seguro(df), method="multi")
+
+    for p in particoes:
+        conn.execute(text(f'ALTER INDEX cci_{carga} ON {schema}."{carga}" REBUILD PARTITION = {p}'))
+        conn.execute(text(
+            f'ALTER TABLE {schema}."{carga}" SWITCH PARTITION {p} TO {schema}."{nome_tabela}" PARTITION {p}'
+        ))
+    conn.execute(text(f'DROP TABLE {schema}."{carga}"'))
+    return True
+
+
+def status_particoes(schema: str = "dbo") -> dict:
+    """Por tabela: layout e, se particionada, linhas/rowgroups/delta/tamanho por partição."""
+    resultado = {}
+    with get_engine().connect() as conn:
+        for nome_tabela in TABELAS_PARTICIONADAS:
+            pf, _, _ = _nomes_particao(nome_tabela)
+            estado = estado_particionamento(conn, nome_tabela, schema)
+            if estado["particionada"] and estado["columnstore"]:
+                estado["particoes"] = [dict(r) for r in conn.execute(text("""
+                    SELECT p.partition_number AS particao,
+                           CAST(prv.value AS date) AS inicio,
+                           p.rows AS linhas,
+                           SUM(CASE WHEN rg.state_desc = 'COMPRESSED' THEN 1 ELSE 0 END)
+                               AS rowgroups_comprimidos,
+                           SUM(CASE WHEN rg.state_desc IN ('OPEN', 'CLOSED')
+                               THEN rg.total_rows ELSE 0 END) AS linhas_delta,
+                           CAST(SUM(rg.size_in_bytes) / 1048576.0 AS decimal(12, 2)) AS tamanho_mb
+                    FROM sys.partitions p
+                    JOIN sys.indexes i ON i.object_id = p.object_id AND i.index_id = p.index_id
+                    LEFT JOIN sys.partition_range_values prv
+                      ON prv.function_id = (SELECT function_id FROM sys.partition_functions
+                                            WHERE name = :pf)
+                     AND prv.boundary_id = p.partition_number - 1
+                    LEFT JOIN sys.dm_db_column_store_row_group_physical_stats rg
+                      ON rg.object_id = p.object_id AND rg.index_id = p.index_id
+                     AND rg.partition_number = p.partition_number
+                    WHERE p.object_id = OBJECT_ID(:objeto) AND i.type = 5
+                    GROUP BY p.partition_number, prv.value, p.rows
+                    ORDER BY p.partition_number
+                """), {"pf": pf, "objeto": f"{schema}.{nome_tabela}"}).mappings()]
+            resultado[nome_tabela] = estado
+    return resultado
+
+
+# Tabelas de controle da própria aplicação — criadas sob demanda
+METADATA_APP = MetaData(schema=SCHEMA_DEFAULT)
+
+TABELA_ARQUIVO_RAW = Table(
+    "arquivo_raw", METADATA_APP,
+    Column("feed",             String(30), primary_key=True),
+    Column("data_recebimento", Date,       primary_key=True),
+    Column("sha256",           String(64), primary_key=True),
+    Column("compressao",       String(10), nullable=False),
+    Column("tamanho_original", BigInteger, nullable=False),
+    Column("recebido_em",      DateTime,   nullable=False),
+    Column("conteudo",         LargeBinary, nullable=False),
+)
+
+TABELA_PERFORMANCE_LOTE = Table(
+    "performance_lote", METADATA_APP,
+    Column("lote_id",       String(36), primary_key=True),
+    Column("conta",         String(20), primary_key=True),
+    Column("data_inicio",   Date,       nullable=False),
+    Column("data_fim",      Date,       nullable=False),
+    Column("status",        String(12), nullable=False),
+    Column("tentativas",    BigInteger, nullable=False),
+    Column("detalhe",       String(300)),
+    Column("solicitado_em", DateTime),
+    Column("entregue_em",   DateTime),
+)
+
+# Tabelas que já existem no SQL Server de produção — declaradas para que um
+# banco local (BANCO_BACKEND=sqlite) as crie na primeira utilização
+TABELA_LOGS_ATIVIDADES = Table(
+    "logs_atividades", METADATA_APP,
+    Column("atividade",          String(100)),
+    Column("status",             String(20)),
+    Column("linhas_processadas", Integer),
+    Column("mensagem_detalhe",   String(500)),
+    Column("data_hora",          DateTime),
+)
+
+TABELA_RELATORIOS_PERFORMANCE = Table(
+    "relatorios_performance_atual", METADATA_APP,
+    Column("conta",           String(20),  primary_key=True),
+    Column("arquivo_pdf",     LargeBinary),
+    Column("nome_arquivo",    String(300)),
+    Column("data_referencia", Date),
+    Column("hash_conteudo",   String(64)),
+    Column("data_upload",     DateTime),
+)
+
+# Jobs em background disparados por rota (ex.: inspecionar-posicao) — o
+# status fica no banco para ser consultado de qualquer worker
+TABELA_JOBS = Table(
+    "jobs_background", METADATA_APP,
+    Column("job_id",    String(36), primary_key=True),
+    Column("tipo",      String(50), nullable=False),
+    Column("status",    String(12), nullable=False),
+    Column("inicio",    DateTime,   nullable=False),
+    Column("fim",       DateTime),
+    Column("resultado", UnicodeText),
+    # Quem executa e último sinal de vida — job de worker morto fica parado
+    Column("host",      String(255)),
+    Column("pid",       Integer),
+    Column("heartbeat", DateTime),
+)
+
+_tabelas_criadas = set()
+_tabelas_lock    = threading.Lock()
+
+
+def garantir_tabela(tabela: Table):
+    """
+    Cria a tabela de controle na primeira utilização do processo. Sob lock
+    (threads do mesmo worker); se outro worker criar entre o check e o
+    CREATE, o erro é ignorado quando a tabela já existe. Tabela criada por
+    uma versão anterior ganha as colunas novas (anuláveis) da definição.
+    """
+    if tabela.name in _tabelas_criadas:
+        return
+    with _tabelas_lock:
+        if tabela.name in _tabelas_criadas:
+            return
+        try:
+            tabela.create(get_engine(), checkfirst=True)
+        except Exception:
+            if not inspect(get_engine()).has_table(tabela.name, schema=tabela.schema):
+                raise
+        _acrescentar_colunas(tabela)
+        _tabelas_criadas.add(tabela.name)
+
+
+def _colunas_existentes(tabela: Table) -> set:
+    return {
+        c["name"] for c in
+        inspect(get_engine()).get_columns(tabela.name, schema=tabela.schema)
+    }
+
+
+def _acrescentar_colunas(tabela: Table):
+    """
+    ALTER TABLE ... ADD das colunas anuláveis da definição que faltam no banco
+    — create(checkfirst=True) não mexe em tabela existente. Se outro worker
+    acrescentar ao mesmo tempo, o erro é ignorado quando a coluna já existe.
+    """
+    faltando = [
+        c for c in tabela.columns
+        if c.nullable and c.name not in _colunas_existentes(tabela)
+    ]
+    engine = get_engine()
+    for coluna in faltando:
+        tipo = coluna.type.compile(dialect=engine.dialect)
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(
+                    f'ALTER TABLE {tabela.schema}."{tabela.name}" '
+                    f'ADD "{coluna.name}" {tipo} NULL'
+                ))
+            print(f"[SCHEMA] {tabela.name}: coluna {coluna.name} acrescentada", flush=True)
+        except Exception:
+            if coluna.name not in _colunas_existentes(tabela):
+                raise
+
+
+def acrescentar_colunas_df(nome_tabela: str, df: pd.DataFrame, schema: str = "dbo"):
+    """
+    ALTER TABLE ... ADD (anulável) das colunas de `df` que a tabela criada
+    pelo to_sql ainda não tem — o append falharia com coluna a mais. Tabela
+    inexistente fica para o to_sql criar.
+    """
+    engine = get_engine()
+    if not inspect(engine).has_table(nome_tabela, schema=schema):
+        return
+
+    def existentes() -> set:
+        return {c["name"] for c in inspect(engine).get_columns(nome_tabela, schema=schema)}
+
+    for nome in [c for c in df.columns if c not in existentes()]:
+        if pd.api.types.is_datetime64_any_dtype(df[nome]):
+            tipo = DateTime()
+        elif pd.api.types.is_numeric_dtype(df[nome]):
+            tipo = Float()
+        else:
+            tipo = UnicodeText()
+        try:
+            with engine.begin() as conn:
                 conn.execute(text(
                     f'ALTER TABLE {schema}."{nome_tabela}" '
-                    f'ADD PRIMARY KEY ("{col_pk}")'
+                    f'ADD "{nome}" {tipo.compile(dialect=engine.dialect)} NULL'
                 ))
-            except Exception as e:
-                print(f"[AVISO] PK em {nome_tabela}: {e}")
+            print(f"[SCHEMA] {nome_tabela}: coluna {nome} acrescentada", flush=True)
+        except Exception:
+            if nome not in existentes():
+                raise
+
+
+# Telemetria por etapa — cada execução de pipeline acumula suas etapas em
+# memória e grava todas de uma vez em metricas_etapa ao terminar
+TABELA_METRICAS_ETAPA = Table(
+    "metricas_etapa", METADATA_APP,
+    Column("execucao_id", String(36),  primary_key=True),
+    Column("seq",         Integer,     primary_key=True),
+    Column("pipeline",    String(50),  nullable=False),
+    Column("etapa",       String(150), nullable=False),
+    Column("inicio",      DateTime,    nullable=False),
+    Column("duracao_ms",  Float,       nullable=False),
+    Column("linhas",      BigInteger),
+    Column("bytes",       BigInteger),
+    Column("status",      String(10),  nullable=False),
+    # Preenchidas só com MEMORIA_INSTRUMENTADA=1
+    Column("mem_pico_mb",  Float),
+    Column("mem_delta_mb", Float),
+    Column("rss_mb",       Float),
+)
 
+_execucao_atual = contextvars.ContextVar("execucao_atual", default=None)
+_perfil_pedido  = contextvars.ContextVar("perfil_pedido", default=None)
 
-def get_btg_token() -> Optional[str]:
-    url = (
-        "https://api.btgpactual.com/iaas-auth/api/v1/"
-        "authorization/oauth2/accesstoken"
+# Nomes dos @pipeline — os que podem ser pedidos em /admin/perfil
+PIPELINES_REGISTRADOS = set()
+
+MB = 1024 * 1024
+
+
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # Fora do Linux: pico de RSS do processo (KB)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _memoria_ativa() -> bool:
+    return MEMORIA_INSTRUMENTADA and tracemalloc.is_tracing()
+
+
+def _logar_top_alocacoes(pipeline_nome: str, nome: str, e: "etapa"):
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    print(
+        f"[MEMORIA {pipeline_nome}] {nome}: pico {e.mem_pico_mb:.0f} MB | "
+        f"delta {e.mem_delta_mb:.0f} MB | RSS {e.rss_mb:.0f} MB — maiores alocações vivas:",
+        flush=True
     )
+    for estat in snapshot.statistics("lineno")[:MEMORIA_TOP_ALOCACOES]:
+        print(f"   {estat}", flush=True)
+
+
+class etapa(contextlib.ContextDecorator):
+    """
+    Cronometra uma etapa do pipeline em andamento. Uso como bloco
+    (`with etapa("parse_csv") as e: ...; e.linhas = len(df)`) ou decorator
+    (`@etapa("arquivar_raw")`). Etapas aninhadas ficam como "pai/filho".
+    Fora de um pipeline (@pipeline) não registra nada.
+
+    Com MEMORIA_INSTRUMENTADA=1 mede também pico e delta do tracemalloc
+    desde o início da etapa e o RSS no fim; acima de MEMORIA_LIMIAR_MB loga
+    as maiores alocações. O pico do tracemalloc é global ao processo, então
+    com pipelines simultâneos os valores são aproximados.
+    """
+
+    def __init__(self, nome: str, linhas: Optional[int] = None, bytes: Optional[int] = None):
+        self.nome   = nome
+        self.linhas = linhas
+        self.bytes  = bytes
+        self.status = "ok"
+        self.mem_pico_mb  = None
+        self.mem_delta_mb = None
+        self.rss_mb       = None
+        self._pico_filhos = 0
+        self._alocacoes_logadas = False
+
+    def _recreate_cm(self):
+        # Cada chamada do decorator precisa do próprio cronômetro
+        return etapa(self.nome, self.linhas, self.bytes)
+
+    def __enter__(self):
+        self._execucao = _execucao_atual.get()
+        if self._execucao is not None:
+            pilha = self._execucao["pilha"]
+            if _memoria_ativa():
+                # reset_peak abaixo apagaria o pico que a etapa pai viu até aqui
+                if pilha:
+                    pilha[-1]._pico_filhos = max(
+                        pilha[-1]._pico_filhos, tracemalloc.get_traced_memory()[1]
+                    )
+                self._rss0 = _rss_bytes()
+                self._mem0 = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+            pilha.append(self)
+        self._inicio = now_brasilia()
+        self._t0     = time.perf_counter()
+        return self
+
+    def __exit__(self, tipo_exc, exc, tb):
+        execucao = self._execucao
+        if execucao is None:
+            return False
+        if tipo_exc is not None:
+            self.status = "erro"
+
+        pilha = execucao["pilha"]
+        # pilha[0] é a etapa "total" do pipeline — fica fora do caminho
+        nome  = "/".join(e.nome for e in pilha[1:]) or self.nome
+        if _memoria_ativa() and hasattr(self, "_mem0"):
+            self._medir_memoria(execucao["pipeline"], nome)
+
+        _registrar_etapa(execucao, nome, self)
+        pilha.pop()
+        if pilha and hasattr(self, "_pico_bytes"):
+            pai = pilha[-1]
+            pai._pico_filhos = max(pai._pico_filhos, self._pico_bytes)
+            pai._alocacoes_logadas |= self._alocacoes_logadas
+        return False
+
+    def _medir_memoria(self, pipeline_nome: str, nome: str):
+        atual, pico = tracemalloc.get_traced_memory()
+        rss = _rss_bytes()
+        self._pico_bytes  = max(pico, self._pico_filhos)
+        self.mem_pico_mb  = (self._pico_bytes - self._mem0) / MB
+        self.mem_delta_mb = (atual - self._mem0) / MB
+        self.rss_mb       = rss / MB
+
+        # Loga só na etapa mais interna que passou do limiar
+        if not self._alocacoes_logadas and max(
+            self.mem_pico_mb, (rss - self._rss0) / MB
+        ) >= MEMORIA_LIMIAR_MB:
+            _logar_top_alocacoes(pipeline_nome, nome, self)
+            self._alocacoes_logadas = True
+
+
+def _contexto_execucao() -> Tuple[str, str]:
+    """(pipeline, etapa) em andamento nesta thread — "-" fora de um pipeline."""
+    execucao = _execucao_atual.get()
+    if execucao is None:
+        return "-", "-"
+    pilha = execucao["pilha"]
+    return execucao["pipeline"], "/".join(e.nome for e in pilha[1:]) or "total"
+
+
+def _arredondar(valor: Optional[float]) -> Optional[float]:
+    return None if valor is None else round(valor, 2)
+
+
+def _registrar_etapa(execucao: dict, nome: str, e: etapa):
+    execucao["etapas"].append({
+        "execucao_id":  execucao["id"],
+        "seq":          len(execucao["etapas"]),
+        "pipeline":     execucao["pipeline"],
+        "etapa":        nome[:150],
+        "inicio":       e._inicio,
+        "duracao_ms":   (time.perf_counter() - e._t0) * 1000,
+        "linhas":       None if e.linhas is None else int(e.linhas),
+        "bytes":        None if e.bytes is None else int(e.bytes),
+        "status":       e.status,
+        "mem_pico_mb":  _arredondar(e.mem_pico_mb),
+        "mem_delta_mb": _arredondar(e.mem_delta_mb),
+        "rss_mb":       _arredondar(e.rss_mb),
+    })
+
+
+def _gravar_metricas(etapas: list):
+    if not etapas:
+        return
+    try:
+        garantir_tabela(TABELA_METRICAS_ETAPA)
+        with get_engine().begin() as conn:
+            conn.execute(TABELA_METRICAS_ETAPA.insert(), etapas)
+    except Exception as e:
+        print(f"[AVISO] Falha ao gravar métricas de etapa: {e}", flush=True)
+
+
+def pipeline(nome: str):
+    """
+    Decorator dos pipelines: abre uma execução, mede a etapa "total" e grava
+    todas as etapas em lote no fim. Rotas que devolvem status HTTP >= 400
+    ficam com status "erro". Chamado dentro de outro pipeline, vira etapa.
+    """
+    PIPELINES_REGISTRADOS.add(nome)
+
+    def decorador(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _execucao_atual.get() is not None:
+                with etapa(nome):
+                    return func(*args, **kwargs)
+
+            if MEMORIA_INSTRUMENTADA and not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+            execucao = {"id": str(uuid.uuid4()), "pipeline": nome,
+                        "pilha": [], "etapas": []}
+            token = _execucao_atual.set(execucao)
+            total = etapa("total")
+            perfil = _perfil_pedido.get() or _reivindicar_perfil(nome)
+            try:
+                with total, _perfilar(perfil):
+                    resultado = func(*args, **kwargs)
+                    if isinstance(resultado, tuple) and len(resultado) > 1 \
+                            and isinstance(resultado[1], int) and resultado[1] >= 400:
+                        total.status = "erro"
+                return resultado
+            finally:
+                _execucao_atual.reset(token)
+                METRICA_JOB.labels(pipeline=nome, status=total.status) \
+                    .observe(time.perf_counter() - total._t0)
+                _gravar_metricas(execucao["etapas"])
+        return wrapper
+    return decorador
+
+
+# Profiling sob demanda — amostragem de pilha (padrão, overhead baixo) ou
+# cProfile (determinístico, mais caro). Um perfil por vez em cada worker.
+_perfil_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=8192)
+def _rotulo_frame(codigo) -> str:
+    return f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{codigo.co_firstlineno})"
+
+
+class AmostradorPilhas(threading.Thread):
+    """Lê a pilha da thread alvo a cada `intervalo` s e conta as pilhas iguais."""
+
+    def __init__(self, thread_id: int, intervalo: float):
+        super().__init__(name="amostrador-perfil", daemon=True)
+        self.alvo      = thread_id
+        self.intervalo = intervalo
+        self.pilhas    = collections.Counter()
+        self._parar    = threading.Event()
+
+    def run(self):
+        while not self._parar.wait(self.intervalo):
+            frame = sys._current_frames().get(self.alvo)
+            pilha = []
+            while frame is not None:
+                pilha.append(_rotulo_frame(frame.f_code))
+                frame = frame.f_back
+            if pilha:
+                self.pilhas[tuple(reversed(pilha))] += 1
+
+    def parar(self):
+        self._parar.set()
+        self.join()
+
+
+def _top_amostras(pilhas: collections.Counter, n: int) -> list:
+    total = sum(pilhas.values()) or 1
+    proprio, inclusivo = collections.Counter(), collections.Counter()
+    for pilha, qtd in pilhas.items():
+        proprio[pilha[-1]] += qtd
+        for rotulo in set(pilha):
+            inclusivo[rotulo] += qtd
+    return [
+        {"funcao": rotulo, "amostras": qtd,
+         "proprio_pct": round(100 * qtd / total, 1),
+         "total_pct":   round(100 * inclusivo[rotulo] / total, 1)}
+        for rotulo, qtd in proprio.most_common(n)
+    ]
+
+
+def _top_cprofile(perfil: "cProfile.Profile", n: int) -> list:
+    import pstats
+
+    estatisticas = pstats.Stats(perfil).stats
+    maiores = sorted(estatisticas.items(), key=lambda kv: kv[1][2], reverse=True)[:n]
+    return [
+        {"funcao": f"{func} ({os.path.basename(arquivo)}:{linha})", "chamadas": nc,
+         "proprio_s": round(tt, 4), "acumulado_s": round(ct, 4)}
+        for (arquivo, linha, func), (_cc, nc, tt, ct, _chamadores) in maiores
+    ]
+
+
+def _caminho_perfil(*partes: str) -> str:
+    return os.path.join(PERFIL_DIR, *partes)
+
+
+def novo_pedido_perfil(pipeline_nome: str, modo: str, intervalo_ms: float) -> dict:
+    return {
+        "id":           f"{now_brasilia():%Y%m%d-%H%M%S}-{pipeline_nome}-{uuid.uuid4().hex[:6]}",
+        "pipeline":     pipeline_nome,
+        "modo":         modo,
+        "intervalo_ms": intervalo_ms,
+        "pedido_em":    now_brasilia().isoformat(timespec="seconds"),
+    }
+
+
+def marcar_proxima_execucao(pedido: dict):
+    """Grava o pedido; a próxima execução do pipeline em qualquer worker o consome."""
+    os.makedirs(_caminho_perfil("pendentes"), exist_ok=True)
+    caminho = _caminho_perfil("pendentes", pedido["pipeline"])
+    tmp = f"{caminho}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(pedido, f)
+    os.replace(tmp, caminho)
+
+
+def perfis_pendentes() -> list:
+    pasta = _caminho_perfil("pendentes")
+    if not os.path.isdir(pasta):
+        return []
+    pedidos = []
+    for nome in sorted(os.listdir(pasta)):
+        if "." in nome:
+            continue
+        try:
+            with open(os.path.join(pasta, nome), encoding="utf-8") as f:
+                pedidos.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return pedidos
+
+
+def _reivindicar_perfil(pipeline_nome: str) -> Optional[dict]:
+    caminho = _caminho_perfil("pendentes", pipeline_nome)
+    if _perfil_lock.locked() or not os.path.exists(caminho):
+        return None
+    # rename é atômico: com execuções simultâneas só uma fica com o pedido
+    meu = f"{caminho}.{os.getpid()}.{threading.get_ident()}"
+    try:
+        os.rename(caminho, meu)
+    except OSError:
+        return None
+    try:
+        with open(meu, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+    finally:
+        with contextlib.suppress(OSError):
+            os.remove(meu)
+
+
+@contextlib.contextmanager
+def _perfilar(pedido: Optional[dict]):
+    """Roda o bloco sob o profiler pedido e grava o artefato no fim."""
+    if pedido is None:
+        yield
+        return
+    if not _perfil_lock.acquire(blocking=False):
+        print(f"[AVISO PERFIL] {pedido['pipeline']}: outro perfil em andamento — "
+              f"execução sem profiling", flush=True)
+        yield
+        return
+
+    meta = {**pedido, "pid": os.getpid(), "status": "ok",
+            "inicio": now_brasilia().isoformat(timespec="seconds")}
+    perfil = amostrador = None
+    try:
+        if pedido["modo"] == "cprofile":
+            import cProfile
+
+            perfil = cProfile.Profile()
+            perfil.enable()
+        else:
+            amostrador = AmostradorPilhas(threading.get_ident(), pedido["intervalo_ms"] / 1000)
+            amostrador.start()
+    except Exception as e:
+        # Ex.: outro profiler ativo no processo (Python 3.12+)
+        print(f"[AVISO PERFIL] {pedido['pipeline']}: profiler não iniciou: {e}", flush=True)
+        _perfil_lock.release()
+        yield
+        return
+
+    t0 = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        meta["status"] = "erro"
+        raise
+    finally:
+        if perfil is not None:
+            perfil.disable()
+        if amostrador is not None:
+            amostrador.parar()
+        meta["duracao_s"] = round(time.perf_counter() - t0, 3)
+        try:
+            _gravar_perfil(meta, perfil, amostrador)
+        except Exception as e:
+            print(f"[AVISO PERFIL] Falha ao gravar perfil {meta['id']}: {e}", flush=True)
+        finally:
+            _perfil_lock.release()
+
+
+def _gravar_perfil(meta: dict, perfil: Optional["cProfile.Profile"],
+                   amostrador: Optional[AmostradorPilhas]):
+    """
+    Grava <id>.collapsed (amostragem — formato "a;b;c N" do flamegraph.pl,
+    speedscope e afins) ou <id>.prof (cProfile — snakeviz, gprof2dot), e por
+    último <id>.json com o top de funções.
+    """
+    os.makedirs(PERFIL_DIR, exist_ok=True)
+    base = _caminho_perfil(meta["id"])
+    if amostrador is not None:
+        meta["amostras"] = sum(amostrador.pilhas.values())
+        meta["top"] = _top_amostras(amostrador.pilhas, PERFIL_TOP * 4)
+        with open(f"{base}.collapsed", "w", encoding="utf-8") as f:
+            for pilha, qtd in amostrador.pilhas.most_common():
+                f.write(f"{';'.join(pilha)} {qtd}\n")
+    if perfil is not None:
+        perfil.dump_stats(f"{base}.prof")
+        meta["top"] = _top_cprofile(perfil, PERFIL_TOP * 4)
+    with open(f"{base}.json", "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    print(f"[PERFIL] {meta['pipeline']} ({meta['modo']}) em {meta['duracao_s']:.1f}s → {base}.*",
+          flush=True)
+    _limpar_perfis()
+
+
+def _limpar_perfis():
+    ids = sorted(f[:-len(".json")] for f in os.listdir(PERFIL_DIR) if f.endswith(".json"))
+    for antigo in ids[:-PERFIL_RETENCAO]:
+        for extensao in (".json", ".collapsed", ".prof"):
+            with contextlib.suppress(OSError):
+                os.remove(_caminho_perfil(antigo + extensao))
+
+
+def destino_http(url: str) -> str:
+    """Rótulo de baixa cardinalidade para o host de uma chamada de saída."""
+    host = (urlparse(url).hostname or "").lower()
+    if host.endswith("btgpactual.com") or url.startswith(URL_BTG_API):
+        return "btg"
+    if host.endswith("amazonaws.com"):
+        return "s3"
+    if host.endswith("sharepoint.com"):
+        return "sharepoint"
+    return "outro"
+
+
+class _SemCookies(DefaultCookiePolicy):
+    def set_ok(self, cookie, request):
+        return False
+
+
+_sessao = (None, None)
+
+
+def _sessao_http() -> requests.Session:
+    """
+    Sessão HTTP do processo: mantém as conexões TLS com BTG e S3 abertas entre
+    chamadas. Criada por PID — com preload_app o master não pode repassar
+    sockets aos workers. Cookies não são guardados (cada chamada é independente).
+    """
+    global _sessao
+    pid, sessao = _sessao
+    if pid != os.getpid():
+        sessao = requests.Session()
+        sessao.cookies.set_policy(_SemCookies())
+        adaptador = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=16)
+        sessao.mount("https://", adaptador)
+        sessao.mount("http://", adaptador)
+        _sessao = (os.getpid(), sessao)
+    return sessao
+
+
+def requisitar(metodo: str, url: str, **kwargs) -> requests.Response:
+    """
+    Chamada HTTP de saída com latência (até os cabeçalhos) e bytes do corpo
+    registrados no Prometheus. Com stream=True os bytes são contados por
+    quem consome o corpo (contar_bytes_baixados).
+    """
+    destino = destino_http(url)
+    inicio  = time.perf_counter()
+    try:
+        r = _sessao_http().request(metodo, url, **kwargs)
+    except requests.RequestException:
+        METRICA_HTTP_SAIDA.labels(destino=destino, status="falha") \
+            .observe(time.perf_counter() - inicio)
+        raise
+    if not kwargs.get("stream"):
+        contar_bytes_baixados(url, len(r.content))
+    METRICA_HTTP_SAIDA.labels(destino=destino, status=str(r.status_code)) \
+        .observe(time.perf_counter() - inicio)
+    return r
+
+
+def contar_bytes_baixados(url: str, n: int):
+    METRICA_BYTES_BAIXADOS.labels(destino=destino_http(url)).inc(n)
+
+
+def baixar(url: str, **kwargs) -> requests.Response:
+    """GET medido como etapa "download" (bytes do corpo, se não for stream)."""
+    with etapa("download") as e:
+        r = requisitar("GET", url, **kwargs)
+        if not kwargs.get("stream"):
+            e.bytes = len(r.content)
+    return r
+
+
+def _ler_csv_base_btg(conteudo: bytes) -> pd.DataFrame:
+    return pd.read_csv(io.BytesIO(conteudo), sep=";", encoding="utf-8")
+
+
+def _ler_csv_nnm(conteudo: bytes) -> pd.DataFrame:
+    return pd.read_csv(io.StringIO(conteudo.decode("utf-8")), sep=";")
+
+
+def _ler_zip_custodia(conteudo: bytes) -> pd.DataFrame:
+    with zipfile.ZipFile(io.BytesIO(conteudo)) as z:
+        with z.open(z.namelist()[0]) as f:
+            return pd.read_csv(f, sep=",", encoding="latin1", low_memory=False)
+
+
+# Leitor de cada feed arquivado — o mesmo parse usado na ingestão
+LEITORES_ARQUIVO_RAW = {
+    "base_btg": _ler_csv_base_btg,
+    "nnm":      _ler_csv_nnm,
+    "custodia": _ler_zip_custodia,
+}
+
+
+def _caminho_arquivo_raw(feed: str, dia: str, sha: str, compressao: str) -> str:
+    extensao = "zip" if compressao == "zip" else "gz"
+    return os.path.join(ARQUIVO_RAW_DIR, feed, dia, f"{sha}.{extensao}")
+
+
+@etapa("arquivar_raw")
+def arquivar_raw(feed: str, conteudo: bytes) -> Optional[str]:
+    """
+    Guarda os bytes originais do feed, comprimidos, chaveados por
+    feed + data de recebimento + SHA-256 do conteúdo. Reenvio do mesmo
+    arquivo no mesmo dia não duplica. Falha no arquivo não interrompe
+    a ingestão — só registra aviso.
+    """
+    try:
+        sha         = hashlib.sha256(conteudo).hexdigest()
+        recebido_em = now_brasilia()
+        dia         = recebido_em.strftime("%Y-%m-%d")
+
+        # ZIP já vem comprimido — guardado como recebido
+        if conteudo[:4] == b"PK\x03\x04":
+            compressao, dados = "zip", conteudo
+        else:
+            compressao, dados = "gzip", gzip.compress(conteudo, compresslevel=6)
+
+        if ARQUIVO_RAW_DESTINO == "disco":
+            caminho = _caminho_arquivo_raw(feed, dia, sha, compressao)
+            if not os.path.exists(caminho):
+                os.makedirs(os.path.dirname(caminho), exist_ok=True)
+                with open(caminho + ".tmp", "wb") as f:
+                    f.write(dados)
+                os.replace(caminho + ".tmp", caminho)
+        else:
+            garantir_tabela(TABELA_ARQUIVO_RAW)
+            t = TABELA_ARQUIVO_RAW
+            with get_engine().begin() as conn:
+                existe = conn.execute(
+                    t.select().with_only_columns(t.c.sha256).where(
+                        t.c.feed == feed,
+                        t.c.data_recebimento == recebido_em.date(),
+                        t.c.sha256 == sha,
+                    )
+                ).first()
+                if not existe:
+                    conn.execute(t.insert(), {
+                        "feed":             feed,
+                        "data_recebimento": recebido_em.date(),
+                        "sha256":           sha,
+                        "compressao":       compressao,
+                        "tamanho_original": len(conteudo),
+                        "recebido_em":      recebido_em,
+                        "conteudo":         dados,
+                    })
+
+        print(
+            f"[ARQUIVO_RAW] {feed} {dia} {sha[:12]} — "
+            f"{len(conteudo)} → {len(dados)} bytes ({compressao})",
+            flush=True
+        )
+        return sha
+
+    except Exception as e:
+        print(f"[AVISO] Falha ao arquivar raw de {feed}: {e}", flush=True)
+        return None
+
+
+def limpar_arquivo_raw(dias: int = ARQUIVO_RAW_RETENCAO_DIAS) -> int:
+    """
+    Remove arquivos raw recebidos há mais de `dias` dias. Retorna a quantidade.
+    Roda fora da ingestão, via /trigger/limpar-arquivo-raw.
+    """
+    corte = (now_brasilia() - timedelta(days=dias)).date()
+
+    if ARQUIVO_RAW_DESTINO == "disco":
+        removidos = 0
+        if not os.path.isdir(ARQUIVO_RAW_DIR):
+            return 0
+        for feed in os.listdir(ARQUIVO_RAW_DIR):
+            dir_feed = os.path.join(ARQUIVO_RAW_DIR, feed)
+            if not os.path.isdir(dir_feed):
+                continue
+            for dia in os.listdir(dir_feed):
+                dir_dia = os.path.join(dir_feed, dia)
+                if not os.path.isdir(dir_dia):
+                    continue
+                try:
+                    expirado = datetime.strptime(dia, "%Y-%m-%d").date() < corte
+                except ValueError:
+                    continue
+                if expirado:
+                    removidos += len(os.listdir(dir_dia))
+                    shutil.rmtree(dir_dia, ignore_errors=True)
+        return removidos
+
+    garantir_tabela(TABELA_ARQUIVO_RAW)
+    with get_engine().begin() as conn:
+        res = conn.execute(
+            TABELA_ARQUIVO_RAW.delete().where(
+                TABELA_ARQUIVO_RAW.c.data_recebimento < corte
+            )
+        )
+    return res.rowcount or 0
+
+
+def carregar_arquivo_raw(
+    feed: str,
+    data: Optional[str] = None,
+    sha256: Optional[str] = None
+) -> pd.DataFrame:
+    """
+    Recarrega um arquivo arquivado como DataFrame, com o mesmo parse da ingestão.
+    Sem `data`/`sha256`, devolve o arquivo mais recente do feed.
+    """
+    if feed not in LEITORES_ARQUIVO_RAW:
+        raise ValueError(f"Feed desconhecido: {feed}")
+
+    if ARQUIVO_RAW_DESTINO == "disco":
+        dir_feed = os.path.join(ARQUIVO_RAW_DIR, feed)
+        dias = sorted(os.listdir(dir_feed)) if os.path.isdir(dir_feed) else []
+        if data:
+            dias = [d for d in dias if d == data]
+        candidatos = [
+            os.path.join(dir_feed, d, f)
+            for d in dias
+            for f in os.listdir(os.path.join(dir_feed, d))
+            if not f.endswith(".tmp") and (not sha256 or f.startswith(sha256))
+        ]
+        if not candidatos:
+            raise FileNotFoundError(f"Nenhum arquivo raw para {feed} {data or ''} {sha256 or ''}")
+        caminho = max(candidatos, key=os.path.getmtime)
+        compressao = "zip" if caminho.endswith(".zip") else "gzip"
+        with open(caminho, "rb") as f:
+            dados = f.read()
+    else:
+        garantir_tabela(TABELA_ARQUIVO_RAW)
+        t = TABELA_ARQUIVO_RAW
+        consulta = t.select().with_only_columns(t.c.compressao, t.c.conteudo) \
+            .where(t.c.feed == feed)
+        if data:
+            consulta = consulta.where(t.c.data_recebimento == pd.Timestamp(data).date())
+        if sha256:
+            consulta = consulta.where(t.c.sha256 == sha256)
+        consulta = consulta.order_by(t.c.recebido_em.desc()).limit(1)
+
+        with get_engine().connect() as conn:
+            linha = conn.execute(consulta).first()
+        if not linha:
+            raise FileNotFoundError(f"Nenhum arquivo raw para {feed} {data or ''} {sha256 or ''}")
+        compressao, dados = linha
+
+    conteudo = dados if compressao == "zip" else gzip.decompress(dados)
+    return LEITORES_ARQUIVO_RAW[feed](conteudo)
+
+
+# Cache em memória de dados de referência (base_btg, times, offshore).
+# Cada conjunto tem uma versão no banco: quem grava a tabela de origem chama
+# invalidar_referencia(), que incrementa a versão — os outros workers veem a
+# versão nova na próxima leitura e recarregam.
+
+TABELA_CACHE_VERSAO = Table(
+    "cache_referencia_versao", METADATA_APP,
+    Column("nome",          String(50), primary_key=True),
+    Column("versao",        BigInteger, nullable=False),
+    Column("atualizado_em", DateTime,   nullable=False),
+)
+
+REF_CACHE_IDADE_MAXIMA = int(os.getenv("REF_CACHE_IDADE_MAXIMA_SEGUNDOS", "21600"))
+# Intervalo entre consultas de versão no banco — dentro dele o hit não toca o
+# banco; gravação em outro worker aparece aqui em até esse tempo
+REF_CACHE_VERIFICACAO = float(os.getenv("REF_CACHE_VERIFICACAO_SEGUNDOS", "5"))
+
+_ref_lock     = threading.Lock()
+_ref_cache    = {}
+_ref_metricas = {}
+
+
+def _carregar_ref_base_btg() -> dict:
+    with get_engine().connect() as conn:
+        df = pd.read_sql("SELECT Conta, Nome, Assessor FROM dbo.base_btg", conn)
+    df["Conta"] = df["Conta"].astype(str).str.strip()
+    df.drop_duplicates("Conta", inplace=True)
+    return {
+        "assessor": dict(zip(df["Conta"], df["Assessor"])),
+        "nome":     dict(zip(df["Conta"], df["Nome"])),
+    }
+
+
+def _carregar_ref_times() -> dict:
+    with get_engine().connect() as conn:
+        df = pd.read_sql(
+            "SELECT Assessor, [CGE OFFICER] FROM dbo.times_nova_empresa", conn
+        )
+    df.columns = [c.strip() for c in df.columns]
+    if "assessor" in df.columns and "Assessor" not in df.columns:
+        df.rename(columns={"assessor": "Assessor"}, inplace=True)
+    df["CGE OFFICER"] = df["CGE OFFICER"].astype(str).str.strip()
+    df.drop_duplicates("CGE OFFICER", inplace=True)
+    return dict(zip(df["CGE OFFICER"], df["Assessor"]))
+
+
+def _carregar_ref_pl_offshore() -> pd.DataFrame:
+    with get_engine().connect() as conn:
+        df = pd.read_sql(
+            "SELECT Conta, Nome, Assessor, [PL Total] FROM dbo.pl_offshore", conn
+        )
+    df["Conta"] = df["Conta"].astype(str).str.strip()
+    return df
+
+
+def _carregar_ref_auc_offshore() -> dict:
+    with get_engine().connect() as conn:
+        df = pd.read_sql("SELECT Conta, Assessor FROM dbo.auc_offshore", conn)
+    df["Conta"] = df["Conta"].astype(str).str.strip()
+    df.drop_duplicates("Conta", inplace=True)
+    return dict(zip(df["Conta"], df["Assessor"]))
+
+
+def _carregar_ref_setores() -> dict:
+    """Índices Ativo→(Setor, Subsetor) e Emissor→(Setor, Subsetor), sem chaves repetidas."""
+    with get_engine().connect() as conn:
+        df = pd.read_sql("SELECT * FROM dbo.setores_ativos", conn)
+    indices = {}
+    for col_match in COLUNAS_MATCH_SETOR:
+        if col_match not in df.columns:
+            continue
+        idx = df.dropna(subset=[col_match])
+        idx = idx.assign(**{col_match: idx[col_match].astype(str).str.strip()})
+        idx = idx.drop_duplicates(col_match).set_index(col_match)[["Setor", "Subsetor"]]
+        if not idx.empty:
+            indices[col_match] = idx
+    return indices
+
+
+TABELA_CORRECOES_ASSESSOR = Table(
+    "correcoes_assessor", METADATA_APP,
+    Column("tipo",  String(10),  primary_key=True),
+    Column("chave", String(200), primary_key=True),
+    Column("valor", String(200), nullable=False),
+)
+
+
+# Conjunto de referência → função que o carrega do banco
+CARREGADORES_REFERENCIA = {
+    "base_btg":           _carregar_ref_base_btg,
+    "times_nova_empresa": _carregar_ref_times,
+    "pl_offshore":        _carregar_ref_pl_offshore,
+    "auc_offshore":       _carregar_ref_auc_offshore,
+    "correcoes_assessor": lambda: _compilar_correcoes_assessor(),
+    "setores_ativos":     _carregar_ref_setores,
+}
+
+
+def _versao_referencia(nome: str) -> int:
+    garantir_tabela(TABELA_CACHE_VERSAO)
+    t = TABELA_CACHE_VERSAO
+    with get_engine().connect() as conn:
+        versao = conn.execute(
+            t.select().with_only_columns(t.c.versao).where(t.c.nome == nome)
+        ).scalar()
+    return versao or 0
+
+
+def _metricas_ref(nome: str) -> dict:
+    # Chamar com _ref_lock
+    return _ref_metricas.setdefault(nome, {"hits": 0, "misses": 0, "invalidacoes": 0})
+
+
+def obter_referencia(nome: str):
+    """
+    Devolve o conjunto de referência `nome` do cache, recarregando do banco
+    se a versão mudou (gravação em qualquer worker) ou se passou da idade
+    máxima. A versão no banco é consultada no máximo a cada
+    REF_CACHE_VERIFICACAO segundos. O valor é compartilhado entre threads —
+    não modificar.
+    """
+    with _ref_lock:
+        entrada = _ref_cache.get(nome)
+        agora   = time.monotonic()
+        if (
+            entrada
+            and agora - entrada["verificado_em"] < REF_CACHE_VERIFICACAO
+            and agora - entrada["carregado_em"] < REF_CACHE_IDADE_MAXIMA
+        ):
+            _metricas_ref(nome)["hits"] += 1
+            return entrada["valor"]
+
+    versao = _versao_referencia(nome)
+
+    with _ref_lock:
+        entrada = _ref_cache.get(nome)
+        agora   = time.monotonic()
+        if (
+            entrada
+            and entrada["versao"] == versao
+            and agora - entrada["carregado_em"] < REF_CACHE_IDADE_MAXIMA
+        ):
+            entrada["verificado_em"] = agora
+            _metricas_ref(nome)["hits"] += 1
+            return entrada["valor"]
+
+    valor = CARREGADORES_REFERENCIA[nome]()
+
+    with _ref_lock:
+        _metricas_ref(nome)["misses"] += 1
+        agora = time.monotonic()
+        _ref_cache[nome] = {
+            "valor":         valor,
+            "versao":        versao,
+            "carregado_em":  agora,
+            "verificado_em": agora,
+        }
+    return valor
+
+
+def invalidar_referencia(*nomes: str):
+    """Incrementa a versão dos conjuntos no banco e descarta a cópia local."""
+    t = TABELA_CACHE_VERSAO
+    for nome in nomes:
+        try:
+            garantir_tabela(TABELA_CACHE_VERSAO)
+            with get_engine().begin() as conn:
+                res = conn.execute(
+                    t.update()
+                    .where(t.c.nome == nome)
+                    .values(versao=t.c.versao + 1, atualizado_em=now_brasilia())
+                )
+                if not res.rowcount:
+                    conn.execute(t.insert(), {
+                        "nome": nome, "versao": 1, "atualizado_em": now_brasilia()
+                    })
+        except Exception as e:
+            print(f"[AVISO] Falha ao invalidar cache {nome}: {e}", flush=True)
+
+        with _ref_lock:
+            _ref_cache.pop(nome, None)
+            _metricas_ref(nome)["invalidacoes"] += 1
+
+
+def _tamanho_referencia(valor) -> int:
+    # base_btg guarda dois mapas (assessor/nome); correções, nomes + contas
+    if isinstance(valor, dict) and "assessor" in valor:
+        return len(valor["assessor"])
+    if isinstance(valor, dict) and "nomes" in valor:
+        return len(valor["nomes"]) + len(valor["contas"])
+    # setores_ativos: um índice por coluna de match
+    if isinstance(valor, dict) and valor and all(
+        isinstance(v, pd.DataFrame) for v in valor.values()
+    ):
+        return sum(len(v) for v in valor.values())
+    return len(valor)
+
+
+def metricas_referencia() -> dict:
+    with _ref_lock:
+        agora = time.monotonic()
+        return {
+            nome: {
+                **metricas,
+                "versao":         _ref_cache[nome]["versao"] if nome in _ref_cache else None,
+                "idade_segundos": round(agora - _ref_cache[nome]["carregado_em"], 1)
+                                  if nome in _ref_cache else None,
+                "entradas":       _tamanho_referencia(_ref_cache[nome]["valor"])
+                                  if nome in _ref_cache else 0,
+            }
+            for nome, metricas in _ref_metricas.items()
+        }
+
+
+TABELA_LIMITE_TAXA = Table(
+    "limite_taxa", METADATA_APP,
+    Column("nome",       String(50), primary_key=True),
+    # Próximo horário livre, em segundos desde a época (time.time())
+    Column("proximo_em", Float,      nullable=False),
+)
+
+# Reserva local, usada só se a tabela limite_taxa estiver indisponível
+_limite_local_lock = threading.Lock()
+_limite_local      = {}
+
+
+class LimitadorTaxa:
+    """
+    Espaça as chamadas em `por_minuto` por minuto somando todos os lotes,
+    threads e workers que usam o mesmo `nome`: o próximo horário livre fica
+    numa linha de limite_taxa e cada chamada reserva o seu com um UPDATE
+    atômico. Sem rajada — os disparos saem espaçados exatamente no limite,
+    sem estourar a janela deslizante da API.
+    """
+
+    def __init__(self, nome: str, por_minuto: float):
+        self.nome      = nome
+        self.intervalo = 60.0 / por_minuto
+
+    def _reservar(self) -> float:
+        garantir_tabela(TABELA_LIMITE_TAXA)
+        t = TABELA_LIMITE_TAXA
+        while True:
+            agora = time.time()
+            try:
+                with get_engine().begin() as conn:
+                    res = conn.execute(
+                        t.update().where(t.c.nome == self.nome).values(
+                            proximo_em=case(
+                                (t.c.proximo_em > agora, t.c.proximo_em), else_=agora
+                            ) + self.intervalo
+                        )
+                    )
+                    if not res.rowcount:
+                        conn.execute(t.insert(), {
+                            "nome": self.nome, "proximo_em": agora + self.intervalo
+                        })
+                        return agora
+                    proximo = conn.execute(
+                        t.select().with_only_columns(t.c.proximo_em)
+                        .where(t.c.nome == self.nome)
+                    ).scalar()
+                return proximo - self.intervalo
+            except IntegrityError:
+                # Outro worker criou a linha ao mesmo tempo — reserva de novo
+                continue
+
+    def aguardar(self):
+        try:
+            horario = self._reservar()
+        except Exception as e:
+            print(f"[AVISO] limite_taxa indisponível — limite só neste processo: {e}",
+                  flush=True)
+            with _limite_local_lock:
+                horario = max(time.time(), _limite_local.get(self.nome, 0.0))
+                _limite_local[self.nome] = horario + self.intervalo
+        espera = horario - time.time()
+        if espera > 0:
+            time.sleep(espera)
+
+
+def get_btg_token() -> Optional[str]:
     headers = {
         "x-id-partner-request": str(uuid.uuid4()),
         "Content-Type": "application/x-www-form-urlencoded",
         "Accept": "application/json"
     }
     try:
-        r = requests.post(
-            url,
+        r = requisitar(
+            "POST", URL_BTG_TOKEN,
             data={"grant_type": "client_credentials"},
             headers=headers,
             auth=(BTG_CLIENT_ID, BTG_CLIENT_SECRET)
@@ -241,6 +2154,44 @@ def get_btg_token() -> Optional[str]:
         return None
 
 
+def aquecer_conexoes() -> dict:
+    """Abre uma conexão do pool com o banco e a sessão TLS com o BTG, medindo cada uma."""
+    resultado = {}
+    t0 = time.perf_counter()
+    try:
+        with get_engine().connect() as conn:
+            conn.execute(text("SELECT 1"))
+        resultado["banco_s"] = round(time.perf_counter() - t0, 3)
+    except Exception as e:
+        resultado["banco_erro"] = str(e)[:200]
+
+    t0 = time.perf_counter()
+    try:
+        requisitar("HEAD", URL_BTG_API, timeout=10)
+        resultado["btg_s"] = round(time.perf_counter() - t0, 3)
+    except requests.RequestException as e:
+        resultado["btg_erro"] = str(e)[:200]
+
+    BOOT["aquecimento"] = resultado
+    print(f"[BOOT] pid {os.getpid()} aquecido: {resultado}", flush=True)
+    return resultado
+
+
+def iniciar_worker(aquecer: bool = AQUECER_NO_BOOT):
+    """
+    Chamado no post_fork do gunicorn: reinicia o relógio de partida do
+    worker, descarta conexões herdadas do master e, se pedido, aquece em
+    background.
+    """
+    BOOT.update(pid=os.getpid(), inicio=_inicio_processo(),
+                primeira_resposta_s=None, aquecimento=None)
+    if _engine is not None:
+        # Sockets do master não podem ser usados pelo filho
+        _engine.dispose(close=False)
+    if aquecer:
+        threading.Thread(target=aquecer_conexoes, name="aquecimento", daemon=True).start()
+
+
 def extrair_conta_do_nome(nome_arquivo: str) -> Optional[str]:
     match = re.search(r"(\d+)", nome_arquivo)
     return match.group(1) if match else None
@@ -261,6 +2212,8 @@ def validar_token(req) -> bool:
 def validar_url_download(url: str) -> bool:
     try:
         parsed = urlparse(url)
+        if parsed.netloc in DOMINIOS_LOCAIS and parsed.scheme in ("http", "https"):
+            return True
         if parsed.scheme != "https":
             return False
         if parsed.netloc not in DOMINIOS_PERMITIDOS:
@@ -291,49 +2244,636 @@ def erro_interno(atividade: str, e: Exception, conta: str = "") -> tuple:
     return jsonify({"erro": "Erro interno — consulte os logs"}), 500
 
 
-def aplicar_correcoes_assessor(df: pd.DataFrame, coluna: str = "Assessor") -> pd.DataFrame:
+def _normalizar_nome_assessor(valor) -> str:
+    return str(valor).upper().strip()
+
+
+def _compilar_correcoes_assessor() -> dict:
+    """
+    Junta as correções fixas do código com as da tabela correcoes_assessor
+    (tipo 'nome' ou 'conta'; a tabela prevalece) em dois mapas de lookup.
+    `memo` guarda valor bruto → nome final, preenchido sob demanda.
+    """
+    nomes  = {_normalizar_nome_assessor(k): v for k, v in CORRECOES_ASSESSOR.items()}
+    contas = dict(CORRECOES_CONTA_ASSESSOR)
+
+    garantir_tabela(TABELA_CORRECOES_ASSESSOR)
+    with get_engine().connect() as conn:
+        linhas = conn.execute(TABELA_CORRECOES_ASSESSOR.select()).all()
+
+    for tipo, chave, valor in linhas:
+        if str(tipo).lower() == "conta":
+            contas[str(chave).strip()] = valor
+        else:
+            nomes[_normalizar_nome_assessor(chave)] = valor
+
+    return {"nomes": nomes, "contas": contas, "memo": {}}
+
+
+def _regras_assessor() -> dict:
+    try:
+        return obter_referencia("correcoes_assessor")
+    except Exception as e:
+        print(f"[AVISO] correcoes_assessor indisponível — usando só as fixas: {e}", flush=True)
+        return {
+            "nomes":  {_normalizar_nome_assessor(k): v for k, v in CORRECOES_ASSESSOR.items()},
+            "contas": dict(CORRECOES_CONTA_ASSESSOR),
+            "memo":   {},
+        }
+
+
+def aplicar_correcoes_assessor(
+    df: pd.DataFrame,
+    coluna: str = "Assessor",
+    coluna_conta: str = "Conta"
+) -> pd.DataFrame:
+    """
+    Normaliza o nome do assessor (upper/strip + correções por nome) e aplica
+    as correções por conta, em uma passada vetorizada: cada nome distinto é
+    normalizado uma vez (factorize + memo), e as contas são um único map.
+    Pode ser chamada em qualquer ponto que manipule assessores.
+    """
+    regras = _regras_assessor()
+
+    if coluna in df.columns:
+        nomes, memo = regras["nomes"], regras["memo"]
+        codigos, unicos = pd.factorize(df[coluna], use_na_sentinel=False)
+        normalizados = np.empty(len(unicos), dtype=object)
+        for i, valor in enumerate(unicos):
+            chave = str(valor)
+            if chave not in memo:
+                nome = _normalizar_nome_assessor(chave)
+                memo[chave] = nomes.get(nome, nome)
+            normalizados[i] = memo[chave]
+        df[coluna] = normalizados[codigos]
+
+    if coluna_conta in df.columns and regras["contas"]:
+        por_conta = df[coluna_conta].astype(str).map(regras["contas"])
+        mask = por_conta.notna()
+        if mask.any():
+            df.loc[mask, coluna] = por_conta[mask]
+
+    return df
+
+
+def adicionar_setores(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Acrescenta Setor e Subsetor à posição com um único lookup no índice em cache
+    (setores_ativos), casando por Ativo ou, na falta dele, por Emissor.
+    Sem mapeamento carregado, devolve o df sem as colunas.
+    """
+    try:
+        indices = obter_referencia("setores_ativos")
+    except Exception as e:
+        print(f"[POSICAO] Aviso: nao foi possivel carregar setores — {e}", flush=True)
+        return df
+
+    for col_match in COLUNAS_MATCH_SETOR:
+        if col_match in df.columns and col_match in indices:
+            chave = df[col_match].astype(str).str.strip()
+            encontrados = indices[col_match].reindex(chave.to_numpy())
+            df["Setor"]    = encontrados["Setor"].to_numpy()
+            df["Subsetor"] = encontrados["Subsetor"].to_numpy()
+            return df
+    return df
+
+
+def _tipos_custodia(z: zipfile.ZipFile, nome_csv: str) -> Tuple[list, dict]:
+    """
+    Colunas importadas (COLUNAS_CUSTODIA presentes no cabeçalho) e o dtype de
+    cada coluna numérica, de TIPOS_CUSTODIA. Só coluna importada sem tipo no
+    mapa leva a uma varredura do CSV — em blocos, como texto, lendo apenas
+    essas colunas: numérica é a que tem todo valor preenchido conversível
+    (int64 se todos inteiros e sem vazios, senão float64); texto em qualquer
+    linha a mantém texto.
+    """
+    with z.open(nome_csv) as f:
+        cabecalho = pd.read_csv(f, sep=",", encoding="latin1", nrows=0)
+
+    colunas   = [c for c in cabecalho.columns if c in COLUNAS_CUSTODIA]
+    ignoradas = [c for c in cabecalho.columns if c not in COLUNAS_CUSTODIA]
+    if ignoradas:
+        print(f"[AVISO CUSTODIA] colunas fora de COLUNAS_CUSTODIA não importadas: {ignoradas}",
+              flush=True)
+
+    tipos = {
+        c: TIPOS_CUSTODIA[c] for c in colunas
+        if TIPOS_CUSTODIA.get(c, "str") != "str"
+    }
+    pendentes = [
+        c for c in colunas
+        if c not in TIPOS_CUSTODIA and c not in COLUNAS_DATA_CUSTODIA
+    ]
+    if not pendentes:
+        return colunas, tipos
+
+    print(f"[AVISO CUSTODIA] sem tipo em TIPOS_CUSTODIA, varrendo o arquivo: {pendentes}",
+          flush=True)
+    numericas = set(pendentes)
+    inteiras  = set(pendentes)
+    with z.open(nome_csv) as f:
+        leitor = pd.read_csv(
+            f, sep=",", encoding="latin1",
+            usecols=pendentes,
+            dtype={c: str for c in pendentes},
+            chunksize=CUSTODIA_LINHAS_BLOCO,
+        )
+        for bloco in leitor:
+            for c in list(numericas):
+                preenchidos = bloco[c].dropna()
+                valores = pd.to_numeric(preenchidos, errors="coerce")
+                if valores.isna().any():
+                    numericas.discard(c)
+                    inteiras.discard(c)
+                elif len(preenchidos) < len(bloco) or not (valores % 1 == 0).all():
+                    inteiras.discard(c)
+
+    tipos.update({
+        c: ("int64" if c in inteiras else "float64")
+        for c in pendentes if c in numericas
+    })
+    return colunas, tipos
+
+# 4. FUNÇÕES AUXILIARES DO BASEBTG
+
+def _atualizar_tipo_clientes(base: pd.DataFrame, engine):
+    """
+    Deriva tipo_clientes diretamente da base_btg.
+    Replace a cada atualização — sempre reflete o estado atual.
+    Contas sem tipo_cliente recebem 'Offshore' por padrão.
+    """
+    try:
+        if "tipo_cliente" not in base.columns:
+            print("[AVISO] tipo_cliente ausente na base — tipo_clientes não atualizado")
+            return
+
+        tipo = base[["Conta", "tipo_cliente"]].copy()
+        tipo.rename(columns={"tipo_cliente": "Tipo"}, inplace=True)
+        tipo["Tipo"].fillna("Offshore", inplace=True)
+
+        salvar_df_otimizado(
+            tipo, "tipo_clientes",
+            col_pk="Conta", if_exists="replace"
+        )
+        print(f"[tipo_clientes] {len(tipo)} registros atualizados", flush=True)
+
+    except Exception as e:
+        print(f"[AVISO] Falha ao atualizar tipo_clientes: {e}", flush=True)
+
+# Snapshot em modo SCD2 (SNAPSHOT_BASE_MODO=scd2): base_btg_snapshot_scd guarda
+# uma linha por versão de conta — valid_from no dia em que a versão passou a
+# valer, valid_to no dia em que deixou de valer (NULL enquanto vigente). Só
+# conta nova, alterada nas colunas rastreadas ou que saiu da base gera escrita.
+
+def _hash_versao(df: pd.DataFrame) -> pd.Series:
+    """
+    md5 das COLUNAS_SCD_RASTREADAS de cada linha (coluna ausente conta como
+    vazia). Valores normalizados para texto — data como AAAA-MM-DD, número
+    inteiro sem ".0", nulo vazio — para a mesma conta dar o mesmo hash vinda
+    do CSV ou lida de volta do banco.
+    """
+    partes = []
+    for c in COLUNAS_SCD_RASTREADAS:
+        if c not in df.columns:
+            partes.append(pd.Series("", index=df.index, dtype="string"))
+            continue
+        if c in COLUNAS_DATA_SNAPSHOT:
+            valores = pd.to_datetime(df[c], errors="coerce").dt.strftime("%Y-%m-%d")
+        else:
+            valores = df[c].astype("string").str.replace(r"\.0$", "", regex=True)
+        partes.append(valores.astype("string").fillna(""))
+    texto = partes[0].str.cat(partes[1:], sep="\x1f")
+    return texto.map(lambda t: hashlib.md5(t.encode("utf-8")).hexdigest())
+
+
+def _inserir_versoes_scd(conn, versoes: pd.DataFrame, schema: str = "dbo"):
+    """Append das versões; na criação da tabela, tipa as colunas de controle e cria os índices."""
+    if versoes.empty:
+        return
+    criar = not inspect(conn).has_table(TABELA_SNAPSHOT_SCD, schema=schema)
+    versoes.to_sql(
+        name=TABELA_SNAPSHOT_SCD,
+        con=conn,
+        schema=schema,
+        if_exists="append",
+        index=False,
+        chunksize=_chunksize_seguro(versoes),
+        method="multi",
+        dtype={
+            "Conta":      String(450),
+            "valid_from": DateTime(),
+            "valid_to":   DateTime(),
+            "hash_linha": String(32),
+        },
+    )
+    if not criar:
+        return
+    for nome, colunas in {
+        "conta":      ("Conta", "valid_to"),
+        "valid_from": ("valid_from",),
+        "valid_to":   ("valid_to",),
+    }.items():
+        lista  = ", ".join(f'"{c}"' for c in colunas)
+        indice = f"ix_{TABELA_SNAPSHOT_SCD}_{nome}"
+        if conn.dialect.name == "sqlite":
+            conn.execute(text(
+                f'CREATE INDEX {schema}."{indice}" ON "{TABELA_SNAPSHOT_SCD}" ({lista})'
+            ))
+        else:
+            conn.execute(text(
+                f'CREATE INDEX "{indice}" ON {schema}."{TABELA_SNAPSHOT_SCD}" ({lista})'
+            ))
+
+
+def _semear_snapshot_scd2(conn, inicio: datetime, schema: str = "dbo") -> pd.DataFrame:
+    """
+    Primeira carga em SCD2: abre uma versão por conta do último snapshot da
+    base_btg_snapshot_diario anterior a `inicio` (valid_from = data dele), para
+    a comparação do dia e o entradas/saídas partirem do estado já conhecido.
+    Devolve Conta/hash_linha das versões abertas (vazio sem snapshot anterior).
+    """
+    vazio = pd.DataFrame({"Conta": pd.Series(dtype=object), "hash_linha": pd.Series(dtype=object)})
+    if not inspect(conn).has_table("base_btg_snapshot_diario", schema=schema):
+        return vazio
+    ultimo = conn.execute(text(
+        f"SELECT MAX(Data) FROM {schema}.base_btg_snapshot_diario WHERE Data < :dia"
+    ), {"dia": inicio}).scalar()
+    if ultimo is None:
+        return vazio
+
+    presentes = {
+        c["name"] for c in
+        inspect(conn).get_columns("base_btg_snapshot_diario", schema=schema)
+    }
+    colunas = ", ".join(
+        f"[{c}]" for c in ["Conta"] + COLUNAS_SCD_RASTREADAS if c in presentes
+    )
+    ini_ultimo, fim_ultimo = _intervalo_dia(ultimo)
+    semente = pd.read_sql(text(
+        f"SELECT {colunas} FROM {schema}.base_btg_snapshot_diario "
+        f"WHERE Data >= :ini AND Data < :fim"
+    ), conn, params={"ini": ini_ultimo, "fim": fim_ultimo})
+
+    semente["Conta"] = semente["Conta"].astype(str).str.strip()
+    semente.drop_duplicates(subset="Conta", keep="first", inplace=True)
+    for c in COLUNAS_DATA_SNAPSHOT:
+        if c in semente.columns:
+            semente[c] = pd.to_datetime(semente[c], errors="coerce")
+    semente["hash_linha"] = _hash_versao(semente)
+    semente["valid_from"] = ini_ultimo
+    semente["valid_to"]   = None
+
+    _inserir_versoes_scd(conn, semente, schema)
+    print(f"[SNAPSHOT SCD2] {len(semente)} versões semeadas do snapshot de "
+          f"{ini_ultimo:%Y-%m-%d}", flush=True)
+    return semente[["Conta", "hash_linha"]]
+
+
+def _recriar_view_snapshot_scd(conn, schema: str = "dbo"):
+    """
+    vw_base_btg_snapshot_scd: o snapshot de cada dia do pl_historico_diario
+    (a partir do início do SCD2) recomposto — versão vigente na data + PL do
+    dia — com as colunas da base_btg_snapshot_diario.
+    """
+    if not all(inspect(conn).has_table(t, schema=schema)
+               for t in ("pl_historico_diario", TABELA_SNAPSHOT_SCD)):
+        return
+    presentes_scd = {
+        c["name"] for c in inspect(conn).get_columns(TABELA_SNAPSHOT_SCD, schema=schema)
+    }
+    presentes_pl = {
+        c["name"] for c in inspect(conn).get_columns("pl_historico_diario", schema=schema)
+    }
+    campos = []
+    for c in COLUNAS_SNAPSHOT:
+        origem = RENAME_PL_HISTORICO.get(c, c)
+        if c in COLUNAS_SNAPSHOT_VALORES:
+            if origem in presentes_pl:
+                campos.append(f"p.[{origem}] AS [{c}]")
+        elif c in presentes_scd:
+            campos.append(f"s.[{c}]")
+    campos += [f"p.[{c}]" for c in ("Data", "Mês") if c in presentes_pl]
+
+    # SQLite: view num banco anexado só enxerga tabelas do próprio banco, sem prefixo
+    prefixo = "" if conn.dialect.name == "sqlite" else f"{schema}."
+    corpo = f"""
+        SELECT {", ".join(campos)}
+        FROM {prefixo}pl_historico_diario p
+        JOIN {prefixo}{TABELA_SNAPSHOT_SCD} s
+          ON s.Conta = p.Conta
+         AND s.valid_from <= p.Data
+         AND (s.valid_to IS NULL OR s.valid_to > p.Data)
+    """
+    if conn.dialect.name == "sqlite":
+        conn.execute(text(f'DROP VIEW IF EXISTS {schema}."{VIEW_SNAPSHOT_SCD}"'))
+        conn.execute(text(f'CREATE VIEW {schema}."{VIEW_SNAPSHOT_SCD}" AS {corpo}'))
+    else:
+        conn.execute(text(f"CREATE OR ALTER VIEW {schema}.{VIEW_SNAPSHOT_SCD} AS {corpo}"))
+
+
+def salvar_snapshot_scd2(df_snapshot: pd.DataFrame, dia, schema: str = "dbo") -> dict:
     """
-    Aplica CORRECOES_ASSESSOR e CORRECOES_CONTA_ASSESSOR de forma centralizada.
-    Pode ser chamada em qualquer ponto que manipule assessores.
+    Grava o snapshot de `dia` em base_btg_snapshot_scd: conta nova ou com
+    colunas rastreadas diferentes da versão aberta abre versão (valid_from =
+    dia); a versão alterada e a de conta que sumiu da base são fechadas
+    (valid_to = dia). Idempotente: reprocessar o dia desfaz antes o que a
+    carga anterior dele abriu e fechou. Não aceita dia anterior à última carga.
+    Versão cujo hash só difere por mudança em COLUNAS_SCD_RASTREADAS tem o
+    hash regravado, não é versionada de novo.
     """
-    if coluna in df.columns:
-        df[coluna] = df[coluna].astype(str).str.upper().str.strip()
-        df[coluna].replace(CORRECOES_ASSESSOR, inplace=True)
+    inicio = _intervalo_dia(dia)[0]
+    atual  = df_snapshot[
+        ["Conta"] + [c for c in COLUNAS_SCD_RASTREADAS if c in df_snapshot.columns]
+    ].copy()
+    atual["Conta"] = atual["Conta"].astype(str).str.strip()
+    atual.drop_duplicates(subset="Conta", keep="first", inplace=True)
+    atual["hash_linha"] = _hash_versao(atual)
+
+    tabela = f'{schema}."{TABELA_SNAPSHOT_SCD}"'
+    engine = get_engine()
+    with etapa(f"gravar:{TABELA_SNAPSHOT_SCD}", linhas=len(atual)) as e, engine.begin() as conn:
+        travar_tabela(conn, TABELA_SNAPSHOT_SCD, schema)
+        if inspect(conn).has_table(TABELA_SNAPSHOT_SCD, schema=schema):
+            cargas = [
+                pd.Timestamp(d) for d in conn.execute(text(
+                    f"SELECT MAX(valid_from), MAX(valid_to) FROM {tabela}"
+                )).one() if d is not None
+            ]
+            if cargas and max(cargas) > pd.Timestamp(inicio):
+                raise ValueError(
+                    f"{TABELA_SNAPSHOT_SCD} já tem carga de {max(cargas):%Y-%m-%d}, "
+                    f"posterior a {inicio:%Y-%m-%d}"
+                )
+            # Reprocessamento do dia: volta ao estado da véspera
+            conn.execute(text(f"DELETE FROM {tabela} WHERE valid_from >= :dia"), {"dia": inicio})
+            conn.execute(text(f"UPDATE {tabela} SET valid_to = NULL WHERE valid_to >= :dia"),
+                         {"dia": inicio})
+            abertas = pd.read_sql(text(
+                f"SELECT Conta, hash_linha FROM {tabela} WHERE valid_to IS NULL"
+            ), conn)
+            abertas["Conta"] = abertas["Conta"].astype(str)
+        else:
+            abertas = _semear_snapshot_scd2(conn, inicio, schema)
 
-    if "Conta" in df.columns:
-        for conta, assessor in CORRECOES_CONTA_ASSESSOR.items():
-            df.loc[df["Conta"] == conta, coluna] = assessor
+        comparacao = atual[["Conta", "hash_linha"]].merge(
+            abertas, on="Conta", how="outer", suffixes=("", "_aberta"), indicator=True
+        )
+        novas      = comparacao.loc[comparacao["_merge"] == "left_only", "Conta"]
+        alteradas  = comparacao.loc[
+            (comparacao["_merge"] == "both")
+            & (comparacao["hash_linha"] != comparacao["hash_linha_aberta"]),
+            "Conta"
+        ]
+        encerradas = comparacao.loc[comparacao["_merge"] == "right_only", "Conta"]
+
+        # Hash gravado com outra definição de COLUNAS_SCD_RASTREADAS (ex.: coluna
+        # que passou a valor): recalcula o da versão aberta antes de tratá-la
+        # como alterada e, se bater, só regrava o hash — sem versão nova
+        if len(alteradas):
+            gravadas = ler_por_chaves(
+                conn, f"SELECT * FROM {tabela} WHERE valid_to IS NULL AND Conta IN :chaves",
+                alteradas.tolist(),
+            )
+            gravadas["Conta"] = gravadas["Conta"].astype(str)
+            for c in COLUNAS_DATA_SNAPSHOT:
+                if c in gravadas.columns:
+                    gravadas[c] = pd.to_datetime(gravadas[c], errors="coerce")
+            gravadas["hash_linha"] = _hash_versao(gravadas)
+            rehash = gravadas[["Conta", "hash_linha"]].merge(
+                atual[["Conta", "hash_linha"]], on=["Conta", "hash_linha"]
+            )
+            if not rehash.empty:
+                conn.execute(
+                    text(f"UPDATE {tabela} SET hash_linha = :hash_linha "
+                         f"WHERE valid_to IS NULL AND Conta = :Conta"),
+                    rehash.to_dict(orient="records"),
+                )
+                alteradas = alteradas[~alteradas.isin(set(rehash["Conta"]))]
+
+        fechar = alteradas.tolist() + encerradas.tolist()
+        # DateTime explícito: no SQLite grava valid_to no mesmo formato do to_sql
+        sql_fechar = text(
+            f"UPDATE {tabela} SET valid_to = :dia "
+            f"WHERE valid_to IS NULL AND Conta IN :chaves"
+        ).bindparams(bindparam("chaves", expanding=True), bindparam("dia", type_=DateTime()))
+        for i in range(0, len(fechar), 1000):
+            conn.execute(sql_fechar, {"dia": inicio, "chaves": fechar[i:i + 1000]})
+
+        versoes = atual[atual["Conta"].isin(set(novas) | set(alteradas))].copy()
+        versoes["valid_from"] = inicio
+        versoes["valid_to"]   = None
+        _inserir_versoes_scd(conn, versoes, schema)
+        _recriar_view_snapshot_scd(conn, schema)
+        e.linhas = len(versoes) + len(fechar)
+
+    resumo = {"novas": len(novas), "alteradas": len(alteradas), "encerradas": len(encerradas)}
+    print(f"[SNAPSHOT SCD2] {inicio:%Y-%m-%d}: {resumo['novas']} novas, "
+          f"{resumo['alteradas']} alteradas, {resumo['encerradas']} encerradas "
+          f"({len(atual)} contas na base)", flush=True)
+    return resumo
+
+
+def ler_snapshot_base(dia, schema: str = "dbo") -> pd.DataFrame:
+    """
+    Snapshot da base em `dia`, com as colunas da base_btg_snapshot_diario, nos
+    dois modos: dia coberto pelo SCD2 vem da vw_base_btg_snapshot_scd; dia
+    anterior ao início do SCD2 (ou modo diário) da base_btg_snapshot_diario.
+    """
+    inicio, fim = _intervalo_dia(dia)
+    engine = get_engine()
+    with engine.connect() as conn:
+        inspetor = inspect(conn)
+        origem   = "base_btg_snapshot_diario"
+        if VIEW_SNAPSHOT_SCD in inspetor.get_view_names(schema=schema):
+            primeira = conn.execute(text(
+                f'SELECT MIN(valid_from) FROM {schema}."{TABELA_SNAPSHOT_SCD}"'
+            )).scalar()
+            if primeira is not None and pd.Timestamp(primeira) <= pd.Timestamp(inicio):
+                origem = VIEW_SNAPSHOT_SCD
+        if origem != VIEW_SNAPSHOT_SCD and not inspetor.has_table(origem, schema=schema):
+            return pd.DataFrame(columns=COLUNAS_SNAPSHOT + ["Data", "Mês"])
+        return pd.read_sql(text(
+            f'SELECT * FROM {schema}."{origem}" WHERE Data >= :inicio AND Data < :fim'
+        ), conn, params={"inicio": inicio, "fim": fim})
+
+# 4b. FUNÇÕES AUXILIARES DO NNM
+
+def _calcular_debitos_saida(contas_inativas: pd.DataFrame, pl_hist: pd.DataFrame) -> pd.DataFrame:
+    """
+    Monta o débito de saída de cada conta inativa com o último PL conhecido.
+    Um único sort + drop_duplicates pega a última linha de PL por conta;
+    contas sem histórico de PL ficam de fora. Mantém a ordem de contas_inativas.
+    """
+    colunas = [
+        "CONTA", "CAPTAÇÃO", "Assessor", "Situacao",
+        "TIPO DE CAPTACAO", "MERCADO", "_data_pl",
+    ]
+    if contas_inativas.empty or pl_hist.empty:
+        return pd.DataFrame(columns=colunas)
+
+    ultimo_pl = (
+        pl_hist[["CONTA", "PL Total", "Data"]]
+        .sort_values("Data", kind="stable")
+        .drop_duplicates(subset="CONTA", keep="last")
+        .rename(columns={"Data": "_data_pl"})
+    )
 
-    return df
+    debitos = contas_inativas[["CONTA", "Assessor"]].merge(
+        ultimo_pl, on="CONTA", how="inner"
+    )
+    debitos["CAPTAÇÃO"]         = debitos["PL Total"].astype(float) * -1
+    debitos["Situacao"]         = "Inativo"
+    debitos["TIPO DE CAPTACAO"] = "Saída de conta"
+    debitos["MERCADO"]          = "Saída de conta"
+    return debitos[colunas]
+
+# Contas gravadas com espaço nas pontas antes de a carga fazer strip() — as
+# consultas de entradas/saídas comparam Conta direto (seek no índice), então
+# as linhas antigas são acertadas uma vez por tabela e registradas aqui
+TABELA_CONTAS_NORMALIZADAS = Table(
+    "contas_normalizadas", METADATA_APP,
+    Column("tabela",      String(128), primary_key=True),
+    Column("linhas",      BigInteger,  nullable=False),
+    Column("aplicada_em", DateTime,    nullable=False),
+)
+COLUNAS_CONTA_NORMALIZAR = {
+    "base_btg":                 "Conta",
+    "base_btg_snapshot_diario": "Conta",
+    "pl_historico_diario":      "Conta",
+    "captacao_historico":       "CONTA",
+}
+_contas_normalizadas = False
 
-# 4. FUNÇÕES AUXILIARES DO BASEBTG
 
-def _atualizar_tipo_clientes(base: pd.DataFrame, engine):
+def normalizar_contas_gravadas(schema: str = "dbo"):
     """
-    Deriva tipo_clientes diretamente da base_btg.
-    Replace a cada atualização — sempre reflete o estado atual.
-    Contas sem tipo_cliente recebem 'Offshore' por padrão.
+    UPDATE ... SET Conta = LTRIM(RTRIM(Conta)) das linhas com espaço, uma vez
+    por tabela de COLUNAS_CONTA_NORMALIZAR (varre a tabela só nessa vez). No
+    SQL Server "<>" ignora espaço à direita — só o da esquerda muda alguma
+    comparação, e é o que o UPDATE pega. Depois, uma leitura por processo.
     """
-    try:
-        if "tipo_cliente" not in base.columns:
-            print("[AVISO] tipo_cliente ausente na base — tipo_clientes não atualizado")
-            return
+    global _contas_normalizadas
+    if _contas_normalizadas:
+        return
+    t = TABELA_CONTAS_NORMALIZADAS
+    garantir_tabela(t)
+    engine = get_engine()
+    for nome_tabela, coluna in COLUNAS_CONTA_NORMALIZAR.items():
+        with engine.begin() as conn:
+            travar_tabela(conn, nome_tabela, schema)
+            if conn.execute(
+                t.select().with_only_columns(t.c.tabela).where(t.c.tabela == nome_tabela)
+            ).first():
+                continue
+            linhas = 0
+            if inspect(conn).has_table(nome_tabela, schema=schema):
+                linhas = conn.execute(text(
+                    f'UPDATE {schema}."{nome_tabela}" SET "{coluna}" = LTRIM(RTRIM("{coluna}")) '
+                    f'WHERE "{coluna}" <> LTRIM(RTRIM("{coluna}"))'
+                )).rowcount
+            conn.execute(t.insert().values(
+                tabela=nome_tabela, linhas=max(linhas, 0), aplicada_em=now_brasilia()
+            ))
+        if linhas:
+            print(f"[CONTAS] {nome_tabela}: {linhas} contas sem espaço nas pontas", flush=True)
+    _contas_normalizadas = True
+
+
+# Contas do histórico de captação que saíram da base_btg, ainda sem
+# lançamento de saída, com o último PL conhecido — tudo resolvido no banco.
+# Conta comparada direto (gravada com strip(); ver normalizar_contas_gravadas)
+# para os índices de Conta servirem.
+SQL_NOVAS_SAIDAS = """
+    WITH inativas AS (
+        SELECT DISTINCT h.CONTA AS nr_conta
+        FROM dbo.captacao_historico h
+        WHERE NOT EXISTS (
+                SELECT 1 FROM dbo.base_btg b
+                WHERE b.Conta = h.CONTA
+            )
+          AND NOT EXISTS (
+                SELECT 1 FROM dbo.captacao_historico s
+                WHERE s.CONTA = h.CONTA
+                  AND s.[TIPO DE CAPTACAO] = :tipo_saida
+            )
+    ),
+    ultima_data AS (
+        SELECT i.nr_conta, MAX(p.Data) AS Data
+        FROM inativas i
+        JOIN dbo.pl_historico_diario p ON p.Conta = i.nr_conta
+        GROUP BY i.nr_conta
+    )
+    -- GROUP BY só desempata linhas duplicadas na mesma data
+    SELECT u.nr_conta, MAX(p.[PL Total]) AS [PL Total], u.Data
+    FROM ultima_data u
+    JOIN dbo.pl_historico_diario p
+      ON p.Conta = u.nr_conta AND p.Data = u.Data
+    GROUP BY u.nr_conta, u.Data
+"""
+
+
+def _buscar_novas_saidas(conn) -> pd.DataFrame:
+    """Último PL (nr_conta, PL Total, Data) de cada saída ainda não registrada."""
+    return pd.read_sql(
+        text(SQL_NOVAS_SAIDAS), conn, params={"tipo_saida": TIPO_SAIDA_CONTA}
+    )
 
-        tipo = base[["Conta", "tipo_cliente"]].copy()
-        tipo.rename(columns={"tipo_cliente": "Tipo"}, inplace=True)
-        tipo["Tipo"].fillna("Offshore", inplace=True)
+# 5. FUNÇÕES DE PROCESSOS ASSÍNCRONOS
+
+def iniciar_job(tipo: str, func, *args) -> str:
+    """
+    Roda func(*args) numa thread em background — a requisição não segura o
+    worker durante esperas de I/O — e registra status e resultado (dict
+    devolvido por func, ou a exceção) em jobs_background.
+    """
+    job_id = str(uuid.uuid4())
+    agora  = now_brasilia()
+    garantir_tabela(TABELA_JOBS)
+    with get_engine().begin() as conn:
+        conn.execute(TABELA_JOBS.insert().values(
+            job_id=job_id, tipo=tipo, status="executando", inicio=agora,
+            host=os.uname().nodename, pid=os.getpid(), heartbeat=agora,
+        ))
+    threading.Thread(target=_executar_job, args=(job_id, tipo, func, args), daemon=True).start()
+    return job_id
+
+
+def _heartbeat_job(job_id: str, parar: threading.Event):
+    while not parar.wait(JOB_HEARTBEAT_SEGUNDOS):
+        try:
+            with get_engine().begin() as conn:
+                conn.execute(
+                    TABELA_JOBS.update().where(TABELA_JOBS.c.job_id == job_id)
+                    .values(heartbeat=now_brasilia())
+                )
+        except Exception as e:
+            print(f"[AVISO] Falha no heartbeat do job {job_id}: {e}", flush=True)
 
-        salvar_df_otimizado(
-            tipo, "tipo_clientes",
-            col_pk="Conta", if_exists="replace"
-        )
-        print(f"[tipo_clientes] {len(tipo)} registros atualizados", flush=True)
 
+def _executar_job(job_id: str, tipo: str, func, args: tuple):
+    parar = threading.Event()
+    threading.Thread(target=_heartbeat_job, args=(job_id, parar), daemon=True).start()
+    try:
+        resultado, status = func(*args), "concluido"
     except Exception as e:
-        print(f"[AVISO] Falha ao atualizar tipo_clientes: {e}", flush=True)
+        print(f"[ERRO JOB {tipo}] {job_id}: {e}", flush=True)
+        registrar_log(tipo, "Erro", 0, str(e))
+        resultado, status = {"erro": str(e)[:1000]}, "erro"
+    finally:
+        parar.set()
+    try:
+        with get_engine().begin() as conn:
+            conn.execute(
+                TABELA_JOBS.update().where(TABELA_JOBS.c.job_id == job_id).values(
+                    status=status, fim=now_brasilia(),
+                    resultado=json.dumps(resultado, ensure_ascii=False, default=str),
+                )
+            )
+    except Exception as e:
+        print(f"[AVISO] Falha ao gravar status do job {job_id}: {e}", flush=True)
 
-# 5. FUNÇÕES DE PROCESSOS ASSÍNCRONOS
 
+@pipeline("CALCULO_SAIDAS")
 def _executar_calculo_saidas():
     """
     Detecta contas que constam no histórico de captação mas saíram da base_btg
@@ -344,158 +2884,211 @@ def _executar_calculo_saidas():
     atividade = "CALCULO_SAIDAS"
     try:
         engine = get_engine()
+        normalizar_contas_gravadas()
 
-        with engine.connect() as conn:
-            contas_historico = pd.read_sql(
-                "SELECT DISTINCT CONTA AS nr_conta FROM dbo.captacao_historico", conn
-            )
-            contas_historico["nr_conta"] = contas_historico["nr_conta"].astype(str).str.strip()
+        with etapa("buscar_novas_saidas") as e, engine.connect() as conn:
+            ultimo_pl = _buscar_novas_saidas(conn)
+            e.linhas = len(ultimo_pl)
 
-            contas_ativas = pd.read_sql("SELECT Conta FROM dbo.base_btg", conn)
-            contas_ativas["Conta"] = contas_ativas["Conta"].astype(str).str.strip()
+        if ultimo_pl.empty:
+            registrar_log(atividade, "Sucesso", 0, "Nenhuma saída nova a registrar")
+            return
 
-            inativas = contas_historico[
-                ~contas_historico["nr_conta"].isin(contas_ativas["Conta"])
-            ]["nr_conta"].tolist()
+        debitos = pd.DataFrame({
+            "DATA":             pd.to_datetime(ultimo_pl["Data"]),
+            "CONTA":            ultimo_pl["nr_conta"].astype(str).str.strip(),
+            "CAPTAÇÃO":         ultimo_pl["PL Total"] * -1,
+            # Conta fora da base_btg — não há assessor/nome atual para herdar
+            "Assessor":         "",
+            "TIPO DE CAPTACAO": TIPO_SAIDA_CONTA,
+            "MERCADO":          TIPO_SAIDA_CONTA,
+            "Situacao":         "Inativo",
+            "Nome":             None,
+        })
+
+        # SQL_NOVAS_SAIDAS já exclui contas com saída registrada — basta inserir
+        salvar_df_otimizado(debitos, "captacao_historico", if_exists="append")
 
-            if not inativas:
-                registrar_log(atividade, "Sucesso", 0, "Nenhuma saída detectada")
-                return
+        msg = f"{len(debitos)} saídas registradas"
+        registrar_log(atividade, "Sucesso", len(debitos), msg)
+        print(f"[SUCESSO CALCULO_SAIDAS] {msg}")
 
-            saidas_existentes = pd.read_sql(
-                "SELECT DISTINCT CONTA AS nr_conta FROM dbo.captacao_historico "
-                "WHERE [TIPO DE CAPTACAO] = 'Saída de conta'",
-                conn
-            )
-            saidas_existentes["nr_conta"] = saidas_existentes["nr_conta"].astype(str)
+    except Exception as e:
+        registrar_log(atividade, "Erro", 0, str(e))
+        print(f"[ERRO CRÍTICO CALCULO_SAIDAS] {e}")
 
-            novas_saidas = [
-                c for c in inativas
-                if c not in saidas_existentes["nr_conta"].tolist()
-            ]
 
-            if not novas_saidas:
-                registrar_log(atividade, "Sucesso", 0, "Nenhuma saída nova a registrar")
-                return
+def _movimentacoes_snapshot_diario(engine) -> Optional[tuple]:
+    """
+    (hoje, ontem, saíram, entraram) pelos dois últimos dias da
+    base_btg_snapshot_diario — anti-joins no servidor, só as contas que
+    entraram/saíram trafegam. None com menos de 2 snapshots.
+    """
+    # Datas dos dois últimos snapshots (sem carregar as linhas)
+    with engine.connect() as conn:
+        ultimo = conn.execute(text(
+            "SELECT MAX(Data) FROM dbo.base_btg_snapshot_diario"
+        )).scalar()
+        penultimo = None
+        if ultimo is not None:
+            penultimo = conn.execute(text(
+                "SELECT MAX(Data) FROM dbo.base_btg_snapshot_diario "
+                "WHERE Data < :hoje"
+            ), {"hoje": _intervalo_dia(ultimo)[0]}).scalar()
+
+    if penultimo is None:
+        return None
 
-            placeholders = ", ".join([f"'{c}'" for c in novas_saidas])
-            pl_historico = pd.read_sql(f"""
-                SELECT Conta AS nr_conta, [PL Total], Data
-                FROM dbo.pl_historico_diario
-                WHERE Conta IN ({placeholders})
-                ORDER BY Data
-            """, conn)
-
-        pl_historico["nr_conta"] = pl_historico["nr_conta"].astype(str)
-        pl_historico["Data"]     = pd.to_datetime(pl_historico["Data"])
-
-        ultimo_pl = (
-            pl_historico
-            .sort_values("Data")
-            .groupby("nr_conta")
-            .last()
-            .reset_index()
-        )
+    data_hoje  = pd.Timestamp(ultimo).date()
+    data_ontem = pd.Timestamp(penultimo).date()
 
-        debitos = ultimo_pl.copy()
-        debitos["CAPTAÇÃO"]         = debitos["PL Total"] * -1
-        debitos["DATA"]             = debitos["Data"]
-        debitos["TIPO DE CAPTACAO"] = "Saída de conta"
-        debitos["MERCADO"]          = "Saída de conta"
-        debitos["Situacao"]         = "Inativo"
-
-        # Assessor atual
-        with engine.connect() as conn:
-            base_ref = pd.read_sql("SELECT Conta, Nome, Assessor FROM dbo.base_btg", conn)
-        base_ref["Conta"] = base_ref["Conta"].astype(str).str.strip()
-
-        debitos["nr_conta"] = debitos["nr_conta"].astype(str).str.strip()
-        debitos = debitos.merge(
-            base_ref.rename(columns={"Conta": "nr_conta", "Assessor": "Assessor_ref"}),
-            on="nr_conta", how="left"
+    with etapa("anti_join_snapshots"), engine.connect() as conn:
+        colunas_snapshot = {
+            c["name"] for c in
+            inspect(conn).get_columns("base_btg_snapshot_diario", schema=SCHEMA_DEFAULT)
+        }
+        colunas = ", ".join(
+            f"a.[{c}]" for c in COLUNAS_MOVIMENTACAO if c in colunas_snapshot
         )
-        debitos["Assessor"] = debitos["Assessor_ref"].fillna("")
-        debitos["CONTA"]    = debitos["nr_conta"]
+        # Conta comparada direto (seek em Data, Conta) — gravada com strip(),
+        # linhas antigas acertadas por normalizar_contas_gravadas, como no SCD2
+        sql_anti_join = text(f"""
+            SELECT {colunas}
+            FROM dbo.base_btg_snapshot_diario a
+            WHERE a.Data >= :ini_a AND a.Data < :fim_a
+              AND NOT EXISTS (
+                  SELECT 1 FROM dbo.base_btg_snapshot_diario b
+                  WHERE b.Data >= :ini_b AND b.Data < :fim_b
+                    AND b.Conta = a.Conta
+              )
+        """)
+        intervalo_hoje  = _intervalo_dia(data_hoje)
+        intervalo_ontem = _intervalo_dia(data_ontem)
 
-        colunas_saida = ["DATA", "CONTA", "CAPTAÇÃO", "Assessor", "TIPO DE CAPTACAO", "MERCADO", "Situacao", "Nome"]
-        debitos = debitos[[c for c in colunas_saida if c in debitos.columns]]
+        # Contas que existiam ontem e não existem hoje = SAÍRAM
+        contas_sairam = pd.read_sql(sql_anti_join, conn, params={
+            "ini_a": intervalo_ontem[0], "fim_a": intervalo_ontem[1],
+            "ini_b": intervalo_hoje[0],  "fim_b": intervalo_hoje[1],
+        })
+        # Contas que não existiam ontem e existem hoje = ENTRARAM
+        contas_entraram = pd.read_sql(sql_anti_join, conn, params={
+            "ini_a": intervalo_hoje[0],  "fim_a": intervalo_hoje[1],
+            "ini_b": intervalo_ontem[0], "fim_b": intervalo_ontem[1],
+        })
 
-        if debitos.empty:
-            registrar_log(atividade, "Sucesso", 0, "Nenhuma saída com PL histórico encontrada")
-            return
+    return data_hoje, data_ontem, contas_sairam, contas_entraram
 
-        with engine.begin() as conn:
-            placeholders = ", ".join([f"'{c}'" for c in debitos["CONTA"].tolist()])
-            conn.execute(text(f"""
-                DELETE FROM dbo.captacao_historico
-                WHERE CONTA IN ({placeholders})
-                AND [TIPO DE CAPTACAO] = 'Saída de conta'
-            """))
 
-        salvar_df_otimizado(debitos, "captacao_historico", if_exists="append")
+def _movimentacoes_snapshot_scd2(engine) -> Optional[tuple]:
+    """
+    (hoje, ontem, saíram, entraram) pela base_btg_snapshot_scd — só as versões
+    abertas ou fechadas no dia são lidas. Entrou: versão aberta hoje sem outra
+    da conta fechada hoje; saiu: fechada hoje sem outra aberta hoje. Dias de
+    carga e PL vêm do pl_historico_diario (PL de quem saiu é o da véspera).
+    None sem carga anterior coberta pelo SCD2.
+    """
+    with engine.connect() as conn:
+        if not inspect(conn).has_table(TABELA_SNAPSHOT_SCD, schema=SCHEMA_DEFAULT):
+            return None
+        primeira = conn.execute(text(
+            "SELECT MIN(valid_from) FROM dbo.base_btg_snapshot_scd"
+        )).scalar()
+        ultimo = conn.execute(text(
+            "SELECT MAX(Data) FROM dbo.pl_historico_diario"
+        )).scalar()
+        if primeira is None or ultimo is None:
+            return None
+        intervalo_hoje = _intervalo_dia(ultimo)
+        penultimo = conn.execute(text(
+            "SELECT MAX(Data) FROM dbo.pl_historico_diario WHERE Data < :hoje"
+        ), {"hoje": intervalo_hoje[0]}).scalar()
+        if penultimo is None or pd.Timestamp(primeira) > pd.Timestamp(penultimo):
+            return None
+        intervalo_ontem = _intervalo_dia(penultimo)
+
+    with etapa("versoes_scd2"), engine.connect() as conn:
+        inspetor = inspect(conn)
+        colunas_scd = {
+            c["name"] for c in inspetor.get_columns(TABELA_SNAPSHOT_SCD, schema=SCHEMA_DEFAULT)
+        }
+        colunas_pl = {
+            c["name"] for c in inspetor.get_columns("pl_historico_diario", schema=SCHEMA_DEFAULT)
+        }
+        colunas = ", ".join(
+            f"a.[{c}]" for c in COLUNAS_MOVIMENTACAO
+            if c in colunas_scd and c not in COLUNAS_SNAPSHOT_VALORES
+        )
+        valores = [
+            c for c in COLUNAS_MOVIMENTACAO
+            if c in COLUNAS_SNAPSHOT_VALORES and c in colunas_pl
+        ]
 
-        msg = f"{len(debitos)} saídas registradas"
-        registrar_log(atividade, "Sucesso", len(debitos), msg)
-        print(f"[SUCESSO CALCULO_SAIDAS] {msg}")
+        def versoes(marca: str, oposta: str, intervalo_pl: tuple) -> pd.DataFrame:
+            contas = pd.read_sql(text(f"""
+                SELECT {colunas}
+                FROM dbo.base_btg_snapshot_scd a
+                WHERE a.{marca} >= :ini AND a.{marca} < :fim
+                  AND NOT EXISTS (
+                      SELECT 1 FROM dbo.base_btg_snapshot_scd b
+                      WHERE b.Conta = a.Conta
+                        AND b.{oposta} >= :ini AND b.{oposta} < :fim
+                  )
+            """), conn, params={"ini": intervalo_hoje[0], "fim": intervalo_hoje[1]})
+            if contas.empty or not valores:
+                return contas
+            contas["Conta"] = contas["Conta"].astype(str).str.strip()
+            pl = ler_por_chaves(
+                conn,
+                f"SELECT Conta, {', '.join(f'[{c}]' for c in valores)} "
+                f"FROM dbo.pl_historico_diario "
+                f"WHERE Data >= :ini AND Data < :fim AND Conta IN :chaves",
+                contas["Conta"].tolist(),
+                params={"ini": intervalo_pl[0], "fim": intervalo_pl[1]},
+            )
+            pl["Conta"] = pl["Conta"].astype(str).str.strip()
+            pl.drop_duplicates(subset="Conta", keep="first", inplace=True)
+            return contas.merge(pl, on="Conta", how="left")
 
-    except Exception as e:
-        registrar_log(atividade, "Erro", 0, str(e))
-        print(f"[ERRO CRÍTICO CALCULO_SAIDAS] {e}")
+        # Versão fechada hoje sem sucessora = SAIU (PL do último dia na base)
+        contas_sairam   = versoes("valid_to", "valid_from", intervalo_ontem)
+        # Versão aberta hoje sem antecessora fechada hoje = ENTROU
+        contas_entraram = versoes("valid_from", "valid_to", intervalo_hoje)
+
+    return (pd.Timestamp(ultimo).date(), pd.Timestamp(penultimo).date(),
+            contas_sairam, contas_entraram)
 
 
+@pipeline("ENTRADAS_SAIDAS")
 def _executar_entradas_saidas():
     """
-    Compara o snapshot de hoje com o de ontem na base_btg_snapshot_diario
-    para detectar entradas e saídas de clientes.
+    Compara o snapshot de hoje com o de ontem para detectar entradas e saídas
+    de clientes — base_btg_snapshot_diario ou, em SNAPSHOT_BASE_MODO=scd2, só
+    as versões que mudaram na base_btg_snapshot_scd.
     Deve rodar APÓS webhook/basebtg (que gera o snapshot).
     Idempotente: deleta e recria os registros do dia atual antes de inserir.
     """
     atividade = "ENTRADAS_SAIDAS"
     try:
         engine = get_engine()
+        normalizar_contas_gravadas()
 
-        with engine.connect() as conn:
-            datas_query = pd.read_sql("""
-                SELECT DISTINCT CONVERT(DATE, Data) AS Data
-                FROM dbo.base_btg_snapshot_diario
-                ORDER BY Data DESC
-                OFFSET 0 ROWS FETCH NEXT 2 ROWS ONLY
-            """, conn)
+        if SNAPSHOT_BASE_MODO == "scd2":
+            comparacao = _movimentacoes_snapshot_scd2(engine)
+        else:
+            comparacao = _movimentacoes_snapshot_diario(engine)
 
-        if len(datas_query) < 2:
+        if comparacao is None:
             registrar_log(atividade, "Aviso", 0,
                           "Snapshot insuficiente — menos de 2 dias disponíveis")
             return
 
-        data_hoje  = datas_query["Data"].iloc[0]
-        data_ontem = datas_query["Data"].iloc[1]
-
+        data_hoje, data_ontem, contas_sairam, contas_entraram = comparacao
         print(f"[ENTRADAS_SAIDAS] Comparando {data_ontem} → {data_hoje}")
 
-        with engine.connect() as conn:
-            snap_hoje  = pd.read_sql(f"""
-                SELECT * FROM dbo.base_btg_snapshot_diario
-                WHERE CONVERT(DATE, Data) = '{data_hoje}'
-            """, conn)
-
-            snap_ontem = pd.read_sql(f"""
-                SELECT * FROM dbo.base_btg_snapshot_diario
-                WHERE CONVERT(DATE, Data) = '{data_ontem}'
-            """, conn)
-
-        for df in [snap_hoje, snap_ontem]:
+        for df in [contas_sairam, contas_entraram]:
             df["Conta"] = df["Conta"].astype(str).str.strip()
 
-        # Contas que existiam ontem e não existem hoje = SAÍRAM
-        contas_sairam = snap_ontem[
-            ~snap_ontem["Conta"].isin(snap_hoje["Conta"])
-        ].copy()
         contas_sairam["Situação"] = "Saiu"
-
-        # Contas que não existiam ontem e existem hoje = ENTRARAM
-        contas_entraram = snap_hoje[
-            ~snap_hoje["Conta"].isin(snap_ontem["Conta"])
-        ].copy()
         contas_entraram["Situação"] = "Entrou"
         contas_entraram.drop(columns=["Faixa Cliente"], errors="ignore", inplace=True)
 
@@ -525,23 +3118,15 @@ def _executar_entradas_saidas():
         # Nome já está no snapshot — não precisa de merge externo
         movimentacoes.drop_duplicates(subset=["Conta"], keep="last", inplace=True)
 
-        # Idempotência: remove registros do dia atual antes de reinserir
-        with engine.begin() as conn:
-            conn.execute(text("""
-                DELETE FROM dbo.Entradas_e_saidas_consolidado
-                WHERE CONVERT(DATE, [Mês de entrada/saída]) = :hoje
-            """), {"hoje": str(data_hoje)})
-
-        colunas_alvo = [
-            "Conta", "Nome", "Assessor", "PL Total", "PL Declarado",
-            "Faixa Cliente", "Data Vínculo", "Situação", "Mês de entrada/saída"
-        ]
+        colunas_alvo = COLUNAS_MOVIMENTACAO + ["Situação", "Mês de entrada/saída"]
         movimentacoes = movimentacoes[
             [c for c in colunas_alvo if c in movimentacoes.columns]
         ]
 
-        salvar_df_otimizado(
-            movimentacoes, "Entradas_e_saidas_consolidado", if_exists="append"
+        # Idempotência: substitui os registros do dia atual
+        salvar_particao(
+            movimentacoes, "Entradas_e_saidas_consolidado", "Mês de entrada/saída",
+            *_intervalo_dia(data_hoje)
         )
 
         # ── MIGRACOES_BTG: somente contas que ENTRARAM ────────────────────────
@@ -565,8 +3150,10 @@ def _executar_entradas_saidas():
 
             # Não insere contas que já existem em migracoes_btg
             with engine.connect() as conn:
-                existentes = pd.read_sql(
-                    "SELECT DISTINCT CONTA FROM dbo.migracoes_btg", conn
+                existentes = ler_por_chaves(
+                    conn,
+                    "SELECT DISTINCT CONTA FROM dbo.migracoes_btg WHERE CONTA IN :chaves",
+                    entradas_mig["CONTA"].tolist()
                 )
             existentes["CONTA"] = existentes["CONTA"].astype(str)
             entradas_mig = entradas_mig[
@@ -595,7 +3182,7 @@ def _executar_entradas_saidas():
 def _load_previa_assessor(advisor_name: str, link: str) -> pd.DataFrame:
     """Baixa e parseia a aba 'Meta' do Excel de um assessor."""
     try:
-        response = requests.get(link, params={"downloadformat": "excel"}, timeout=15)
+        response = baixar(link, params={"downloadformat": "excel"}, timeout=15)
         response.raise_for_status()
 
         df = pd.read_excel(io.BytesIO(response.content), sheet_name="Meta")
@@ -629,7 +3216,13 @@ def _load_previa_assessor(advisor_name: str, link: str) -> pd.DataFrame:
         return pd.DataFrame()
 
 
+@pipeline("PREVIA_RECEITA")
 def _executar_previa_receita():
+    """
+    Atualiza a prévia de receita do mês vigente a partir das planilhas dos
+    assessores. Só a partição do mês é lida (META - ROA salva) e reescrita —
+    meses anteriores ficam intocados.
+    """
     atividade = "PREVIA_RECEITA"
     try:
         primeiro_dia_mes = pd.Timestamp(
@@ -637,36 +3230,33 @@ def _executar_previa_receita():
                 day=1, hour=0, minute=0, second=0, microsecond=0, tzinfo=None
             )
         )
+        inicio_mes  = primeiro_dia_mes.to_pydatetime()
+        proximo_mes = (primeiro_dia_mes + pd.DateOffset(months=1)).to_pydatetime()
+        params_mes  = {"inicio": inicio_mes, "fim": proximo_mes}
 
         engine = get_engine()
 
-        # --- Carrega histórico e salva META - ROA do mês atual ---
+        # --- Salva META - ROA do mês atual (só as linhas do mês) ---
         try:
-            hist = pd.read_sql(
-                f"SELECT * FROM {SCHEMA_DEFAULT}.previa_receita_nova", engine
-            )
-            if not hist.empty:
-                hist["Data"] = pd.to_datetime(hist["Data"], errors="coerce")
-
-                # Salva META - ROA antes de remover o mês atual
-                metas_mes_atual = hist[hist["Data"] == primeiro_dia_mes][
-                    ["Assessor", "Categoria - Acompanhamento Next", "META - ROA"]
-                ].copy()
-
-                hist = hist[hist["Data"] != primeiro_dia_mes]
-            else:
-                metas_mes_atual = pd.DataFrame()
+            with engine.connect() as conn:
+                metas_mes_atual = pd.read_sql(text(f"""
+                    SELECT Assessor, [Categoria - Acompanhamento Next], [META - ROA]
+                    FROM {SCHEMA_DEFAULT}.previa_receita_nova
+                    WHERE Data >= :inicio AND Data < :fim
+                """), conn, params=params_mes)
         except Exception as e:
-            registrar_log(atividade, "Erro", 0, f"Falha ao carregar histórico previa_receita_nova — abortando para não destruir dados: {e}")
+            registrar_log(atividade, "Erro", 0, f"Falha ao carregar META - ROA de previa_receita_nova — abortando para não destruir dados: {e}")
             return
 
         # --- Coleta dos assessores ---
         lista_dfs = []
-        for nome, link in SHAREPOINT_LINKS:
-            df_temp = _load_previa_assessor(nome, link)
-            if not df_temp.empty:
-                lista_dfs.append(df_temp)
-                print(f"   [OK] {nome}")
+        with etapa("coleta_planilhas") as e:
+            for nome, link in SHAREPOINT_LINKS:
+                df_temp = _load_previa_assessor(nome, link)
+                if not df_temp.empty:
+                    lista_dfs.append(df_temp)
+                    print(f"   [OK] {nome}")
+            e.linhas = sum(len(d) for d in lista_dfs)
 
         if not lista_dfs:
             registrar_log(atividade, "Erro", 0, "Nenhum dado coletado dos assessores.")
@@ -688,22 +3278,20 @@ def _executar_previa_receita():
             previa_receita.drop(columns=["META - ROA_salva"], inplace=True)
             print(f"   -> META - ROA restaurada para {mask.sum()} linhas.")
 
-        previa_final = pd.concat([hist, previa_receita], axis=0, ignore_index=True)
-
         # Zera nulos só em colunas numéricas — não destrói datas
-        previa_final.loc[previa_final["META - VOLUME"] == "-", "META - VOLUME"] = 0
-        colunas_num = previa_final.select_dtypes(include="number").columns
-        previa_final[colunas_num] = previa_final[colunas_num].fillna(0)
+        previa_receita.loc[previa_receita["META - VOLUME"] == "-", "META - VOLUME"] = 0
+        colunas_num = previa_receita.select_dtypes(include="number").columns
+        previa_receita[colunas_num] = previa_receita[colunas_num].fillna(0)
 
         # Cast correto para SQL Server não salvar como string
-        previa_final["Data"] = pd.to_datetime(previa_final["Data"]).astype("datetime64[ms]")
-        previa_final["Hora Atualizado"] = pd.to_datetime(
-            previa_final["Hora Atualizado"], errors="coerce"
+        previa_receita["Data"] = pd.to_datetime(previa_receita["Data"]).astype("datetime64[ms]")
+        previa_receita["Hora Atualizado"] = pd.to_datetime(
+            previa_receita["Hora Atualizado"], errors="coerce"
         ).astype("datetime64[ms]")
 
-        salvar_df_otimizado(
-            previa_final, "previa_receita_nova",
-            if_exists="replace", schema=SCHEMA_DEFAULT
+        salvar_particao(
+            previa_receita, "previa_receita_nova", "Data",
+            inicio_mes, proximo_mes, schema=SCHEMA_DEFAULT
         )
 
         # --- Agregado por assessor ---
@@ -717,63 +3305,49 @@ def _executar_previa_receita():
             .sum()
             .reset_index()
         )
-        previa_agg["Data"] = pd.to_datetime(previa_agg["Data"])
 
         try:
-            hist_agg = pd.read_sql(
-                f"SELECT * FROM {SCHEMA_DEFAULT}.previa_receita_assessor_historico",
-                engine
-            )
-            if not hist_agg.empty:
-                hist_agg["Data"] = pd.to_datetime(hist_agg["Data"], errors="coerce")
-
-                # Salva e restaura META - ROA agregada do mês atual
-                metas_agg_mes_atual = hist_agg[
-                    hist_agg["Data"] == primeiro_dia_mes
-                ][["Assessor", "META - ROA"]].copy().rename(
-                    columns={"META - ROA": "META - ROA_salva"}
+            # Salva e restaura META - ROA agregada do mês atual
+            with engine.connect() as conn:
+                metas_agg_mes_atual = pd.read_sql(text(f"""
+                    SELECT Assessor, [META - ROA] AS [META - ROA_salva]
+                    FROM {SCHEMA_DEFAULT}.previa_receita_assessor_historico
+                    WHERE Data >= :inicio AND Data < :fim
+                """), conn, params=params_mes)
+
+            if not metas_agg_mes_atual.empty:
+                previa_agg = previa_agg.merge(
+                    metas_agg_mes_atual, on="Assessor", how="left"
                 )
-
-                hist_agg = hist_agg[hist_agg["Data"] != primeiro_dia_mes]
-
-                if not metas_agg_mes_atual.empty:
-                    previa_agg = previa_agg.merge(
-                        metas_agg_mes_atual, on="Assessor", how="left"
-                    )
-                    mask_agg = previa_agg["META - ROA_salva"].notna()
-                    previa_agg.loc[mask_agg, "META - ROA"] = (
-                        previa_agg.loc[mask_agg, "META - ROA_salva"]
-                    )
-                    previa_agg.drop(columns=["META - ROA_salva"], inplace=True)
-
-            previa_final_agg = pd.concat(
-                [hist_agg, previa_agg], axis=0, ignore_index=True
-            )
+                mask_agg = previa_agg["META - ROA_salva"].notna()
+                previa_agg.loc[mask_agg, "META - ROA"] = (
+                    previa_agg.loc[mask_agg, "META - ROA_salva"]
+                )
+                previa_agg.drop(columns=["META - ROA_salva"], inplace=True)
         except Exception as e:
             registrar_log(atividade, "Erro", 0, str(e))
             return
 
         # Cast correto para o agregado também
-        previa_final_agg["Data"] = pd.to_datetime(
-            previa_final_agg["Data"]
-        ).astype("datetime64[ms]")
+        previa_agg["Data"] = pd.to_datetime(previa_agg["Data"]).astype("datetime64[ms]")
 
-        salvar_df_otimizado(
-            previa_final_agg, "previa_receita_assessor_historico",
-            if_exists="replace", schema=SCHEMA_DEFAULT
+        salvar_particao(
+            previa_agg, "previa_receita_assessor_historico", "Data",
+            inicio_mes, proximo_mes, schema=SCHEMA_DEFAULT
         )
 
         msg = (
-            f"Detalhado: {len(previa_final)} linhas | "
-            f"Agregado: {len(previa_final_agg)} linhas"
+            f"Detalhado: {len(previa_receita)} linhas | "
+            f"Agregado: {len(previa_agg)} linhas (mês {primeiro_dia_mes:%Y-%m})"
         )
         print(f"[SUCESSO PREVIA_RECEITA] {msg}")
-        registrar_log(atividade, "Sucesso", len(previa_final), msg)
+        registrar_log(atividade, "Sucesso", len(previa_receita), msg)
 
     except Exception as e:
         registrar_log(atividade, "Erro", 0, str(e))
         print(f"[ERRO CRÍTICO PREVIA_RECEITA] {e}")
 
+
 def _parse_posicao_zip(zip_bytes: bytes) -> pd.DataFrame:
     """
     Faz parse do ZIP de posições BTG (1 JSON por conta) e retorna DataFrame
@@ -923,6 +3497,7 @@ def _parse_posicao_zip(zip_bytes: bytes) -> pd.DataFrame:
     return df[COLUNAS]
 
 
+@pipeline("POSICAO")
 def _executar_posicao():
     """
     Busca posições de todas as contas via API BTG (síncrono via /partner).
@@ -942,15 +3517,18 @@ def _executar_posicao():
         }
 
         # 1. Dispara atualização do cache no BTG (async — fire & forget)
-        r_refresh = requests.get(URL_POSICAO_REFRESH, headers=headers_btg, timeout=30)
+        with etapa("btg_refresh"):
+            r_refresh = requisitar("GET", URL_POSICAO_REFRESH, headers=headers_btg, timeout=30)
         print(f"[POSICAO] Refresh status: {r_refresh.status_code}", flush=True)
 
         # 2. Aguarda geração do arquivo (BTG leva ~60-90s)
-        time.sleep(90)
+        with etapa("aguardar_btg"):
+            time.sleep(POSICAO_ESPERA_REFRESH)
 
         # 3. Busca URL do ZIP (síncrono — lê do cache atualizado)
         headers_btg["x-id-partner-request"] = str(uuid.uuid4())
-        r_partner = requests.get(URL_POSICAO_PARTNER, headers=headers_btg, timeout=30)
+        with etapa("btg_partner"):
+            r_partner = requisitar("GET", URL_POSICAO_PARTNER, headers=headers_btg, timeout=30)
         r_partner.raise_for_status()
         dados = r_partner.json()
         url_zip = (dados.get("response") or {}).get("url") or dados.get("url")
@@ -964,36 +3542,25 @@ def _executar_posicao():
             return
 
         # 4. Baixa ZIP e faz parse dos JSONs (1 por conta)
-        r_zip = requests.get(url_zip, timeout=120)
+        r_zip = baixar(url_zip, timeout=120)
         r_zip.raise_for_status()
 
-        df = _parse_posicao_zip(r_zip.content)
+        with etapa("parse_zip", bytes=len(r_zip.content)) as e:
+            df = _parse_posicao_zip(r_zip.content)
+            e.linhas = len(df)
 
         if df.empty:
             registrar_log(atividade, "Erro", 0, "ZIP sem posicoes parseáveis")
             return
 
-        # 5. Merge com base_btg para adicionar Assessor
-        engine = get_engine()
-        with engine.connect() as conn:
-            base_ref = pd.read_sql("SELECT Conta, Assessor FROM dbo.base_btg", conn)
-        base_ref["Conta"] = base_ref["Conta"].astype(str)
+        # 5. Assessor via base_btg (cache de referência)
         if "Conta" in df.columns:
-            df["Conta"] = df["Conta"].astype(str)
-            df = df.merge(base_ref, on="Conta", how="left")
+            df["Conta"]    = df["Conta"].astype(str)
+            df["Assessor"] = df["Conta"].map(obter_referencia("base_btg")["assessor"])
 
-        # 8. Adiciona Setor e Subsetor via setores.xlsx
-        try:
-            setores = pd.read_excel(r"C:\Scripts\setores_ativos\setores.xlsx")
-            for col_match in ["Ativo", "Emissor"]:
-                if col_match in df.columns and col_match in setores.columns:
-                    df = df.merge(
-                        setores[[col_match, "Setor", "Subsetor"]].drop_duplicates(col_match),
-                        on=col_match, how="left"
-                    )
-                    break
-        except Exception as e_set:
-            print(f"[POSICAO] Aviso: nao foi possivel carregar setores — {e_set}")
+        # 8. Adiciona Setor e Subsetor (cache de setores_ativos)
+        with etapa("setores", linhas=len(df)):
+            df = adicionar_setores(df)
 
         # 9. Grava no banco (REPLACE total — snapshot D0)
         salvar_df_otimizado(df, "posicao", if_exists="replace")
@@ -1007,6 +3574,139 @@ def _executar_posicao():
         print(f"[ERRO CRITICO POSICAO] {e}")
 
 
+def _contas_pendentes_lote(lote_id: str) -> list:
+    with get_engine().connect() as conn:
+        return [c for (c,) in conn.execute(
+            TABELA_PERFORMANCE_LOTE.select()
+            .with_only_columns(TABELA_PERFORMANCE_LOTE.c.conta)
+            .where(TABELA_PERFORMANCE_LOTE.c.lote_id == lote_id)
+            .where(TABELA_PERFORMANCE_LOTE.c.status != "entregue")
+        )]
+
+
+def _marcar_lote(lote_id: str, conta: str, status: str, detalhe: str = ""):
+    t = TABELA_PERFORMANCE_LOTE
+    with get_engine().begin() as conn:
+        conn.execute(
+            t.update()
+            .where(t.c.lote_id == lote_id, t.c.conta == conta, t.c.status != "entregue")
+            .values(status=status, detalhe=detalhe[:300],
+                    tentativas=t.c.tentativas + 1, solicitado_em=now_brasilia())
+        )
+
+
+def marcar_performance_entregue(contas: list, data_ref):
+    """Chamada pelo webhook/performance: dá baixa nas contas dos lotes em aberto."""
+    contas = [c for c in contas if c]
+    if not contas:
+        return
+    t = TABELA_PERFORMANCE_LOTE
+    try:
+        garantir_tabela(t)
+        filtro = [t.c.conta.in_(contas), t.c.status != "entregue"]
+        data_fim = pd.to_datetime(data_ref, errors="coerce")
+        if pd.notna(data_fim):
+            filtro.append(t.c.data_fim == data_fim.date())
+        with get_engine().begin() as conn:
+            conn.execute(
+                t.update().where(*filtro)
+                .values(status="entregue", entregue_em=now_brasilia())
+            )
+    except Exception as e:
+        print(f"[AVISO PERFORMANCE] Falha ao dar baixa no lote: {e}", flush=True)
+
+
+def _solicitar_performance(conta: str, token: str, data_inicio: str,
+                           data_fim: str, callback: str) -> requests.Response:
+    headers = {
+        "x-id-partner-request": str(uuid.uuid4()),
+        "access_token": token,
+        "Content-Type": "application/json"
+    }
+    body = {
+        "accountNumber":  conta,
+        "startDate":      data_inicio,
+        "endDate":        data_fim,
+        "webhookService": "performance-report",
+        "callbackUrl":    callback,
+    }
+    return requisitar("POST", URL_PERFORMANCE, headers=headers, json=body, timeout=30)
+
+
+@pipeline("PERFORMANCE_LOTE")
+def _executar_performance_lote(lote_id: str, data_inicio: str, data_fim: str, callback: str):
+    """
+    Pede o relatório de performance de cada conta do lote no ritmo máximo
+    permitido pela API. Ao fim de cada rodada espera os callbacks e pede
+    de novo só as contas que ainda não foram entregues.
+    """
+    atividade  = "PERFORMANCE_LOTE"
+    # Um só limite para todos os lotes e workers — a cota da API é da conta
+    limitador  = LimitadorTaxa("btg_performance", PERFORMANCE_REQ_POR_MINUTO)
+
+    try:
+        for rodada in range(1, PERFORMANCE_LOTE_RODADAS + 1):
+            pendentes = _contas_pendentes_lote(lote_id)
+            if not pendentes:
+                break
+
+            token = get_btg_token()
+            if not token:
+                registrar_log(atividade, "Erro", 0, f"Lote {lote_id}: falha ao obter token BTG")
+                return
+
+            print(f"[{atividade}] Lote {lote_id} | Rodada {rodada} | "
+                  f"{len(pendentes)} contas", flush=True)
+
+            falhas = 0
+            for conta in pendentes:
+                for _ in range(3):
+                    limitador.aguardar()
+                    try:
+                        r = _solicitar_performance(conta, token, data_inicio, data_fim, callback)
+                    except requests.RequestException as e:
+                        status, detalhe = "falha", str(e)
+                        break
+
+                    if r.status_code == 401:
+                        token = get_btg_token() or token
+                        continue
+                    if r.status_code == 429:
+                        time.sleep(int(r.headers.get("Retry-After") or 60))
+                        continue
+
+                    ok = r.status_code in (200, 202)
+                    status  = "solicitado" if ok else "falha"
+                    detalhe = "" if ok else f"HTTP {r.status_code}: {r.text[:200]}"
+                    break
+                else:
+                    status, detalhe = "falha", f"HTTP {r.status_code} após novas tentativas"
+
+                falhas += status == "falha"
+                _marcar_lote(lote_id, conta, status, detalhe)
+
+            registrar_log(
+                atividade, "Sucesso", len(pendentes) - falhas,
+                f"Lote {lote_id} rodada {rodada}: {len(pendentes) - falhas} solicitadas, "
+                f"{falhas} falhas"
+            )
+
+            # Aguarda os callbacks; sai antes se todas as contas chegarem
+            if rodada < PERFORMANCE_LOTE_RODADAS:
+                limite = time.monotonic() + PERFORMANCE_LOTE_ESPERA
+                while time.monotonic() < limite and _contas_pendentes_lote(lote_id):
+                    time.sleep(30)
+
+        faltando = len(_contas_pendentes_lote(lote_id))
+        msg = f"Lote {lote_id} encerrado — {faltando} contas sem relatório"
+        print(f"[{atividade}] {msg}", flush=True)
+        registrar_log(atividade, "Sucesso" if not faltando else "Aviso", faltando, msg)
+
+    except Exception as e:
+        registrar_log(atividade, "Erro", 0, f"Lote {lote_id}: {e}")
+        print(f"[ERRO CRITICO {atividade}] {e}", flush=True)
+
+
 # 6. ROTAS DE GATILHO
 
 def _trigger_generico(url_relatorio: str, nome_log: str):
@@ -1022,7 +3722,7 @@ def _trigger_generico(url_relatorio: str, nome_log: str):
         "Content-Type": "application/json"
     }
     try:
-        r = requests.get(url_relatorio, headers=headers)
+        r = requisitar("GET", url_relatorio, headers=headers)
         if r.status_code == 202:
             registrar_log(nome_log, "Sucesso", 0, "Solicitação aceita pelo BTG")
             return jsonify({"status": "Solicitado", "http_code": 202}), 202
@@ -1058,90 +3758,151 @@ def trigger_inspecionar_posicao():
     Endpoint de inspeção: baixa o ZIP de posição do BTG e retorna
     as colunas e uma amostra das primeiras linhas do CSV.
     Usar apenas para mapear a estrutura antes de implementar o ETL.
+    Roda em background (refresh → espera → download); o resultado sai em
+    /trigger/jobs/<job_id>.
     """
     if not validar_token(request):
         return jsonify({"erro": "Acesso negado"}), 403
 
     try:
-        token = get_btg_token()
+        job_id = iniciar_job("INSPECIONAR_POSICAO", _inspecionar_posicao)
+        return jsonify({
+            "status": "iniciado",
+            "job_id": job_id,
+            "acompanhar": f"/trigger/jobs/{job_id}",
+        }), 202
+    except Exception as e:
+        return erro_interno("INSPECIONAR_POSICAO", e)
 
-        headers_btg = {
-            "x-id-partner-request": str(uuid.uuid4()),
-            "access_token": token,
-            "Content-Type": "application/json"
-        }
 
-        # Solicita atualização do cache antes de baixar
-        r_refresh = requests.get(
-            URL_POSICAO_REFRESH,
-            headers=headers_btg,
-            timeout=30
-        )
-        print(f"[POSICAO] Refresh status: {r_refresh.status_code} | Body: {r_refresh.text[:300]}", flush=True)
+def _inspecionar_posicao() -> dict:
+    token = get_btg_token()
+
+    headers_btg = {
+        "x-id-partner-request": str(uuid.uuid4()),
+        "access_token": token,
+        "Content-Type": "application/json"
+    }
 
-        if r_refresh.status_code not in (200, 202):
-            return jsonify({"erro": "Refresh falhou", "status": r_refresh.status_code, "body": r_refresh.text[:300]}), 502
+    # Solicita atualização do cache antes de baixar
+    r_refresh = requisitar(
+        "GET", URL_POSICAO_REFRESH,
+        headers=headers_btg,
+        timeout=30
+    )
+    print(f"[POSICAO] Refresh status: {r_refresh.status_code} | Body: {r_refresh.text[:300]}", flush=True)
 
-        time.sleep(90)
+    if r_refresh.status_code not in (200, 202):
+        raise RuntimeError(f"Refresh falhou: status {r_refresh.status_code} | {r_refresh.text[:300]}")
 
-        # Obtém URL do ZIP
-        headers_btg["x-id-partner-request"] = str(uuid.uuid4())
-        r = requests.get(
-            URL_POSICAO_PARTNER,
-            headers=headers_btg,
-            timeout=30
-        )
-        r.raise_for_status()
-        dados = r.json()
-        url_zip = (dados.get("response") or {}).get("url") or dados.get("url")
+    time.sleep(POSICAO_ESPERA_REFRESH)
 
-        if not url_zip:
-            return jsonify({"erro": "URL do ZIP não retornada", "resposta_btg": dados}), 400
+    # Obtém URL do ZIP
+    headers_btg["x-id-partner-request"] = str(uuid.uuid4())
+    r = requisitar(
+        "GET", URL_POSICAO_PARTNER,
+        headers=headers_btg,
+        timeout=30
+    )
+    r.raise_for_status()
+    dados = r.json()
+    url_zip = (dados.get("response") or {}).get("url") or dados.get("url")
+
+    if not url_zip:
+        raise RuntimeError(f"URL do ZIP não retornada: {str(dados)[:300]}")
+
+    if not validar_url_download(url_zip):
+        raise RuntimeError("URL não autorizada")
+
+    # Baixa e abre o ZIP
+    r_zip = baixar(url_zip, timeout=60)
+    r_zip.raise_for_status()
+
+    with zipfile.ZipFile(io.BytesIO(r_zip.content)) as z:
+        arquivos = z.namelist()
+        resultado = {}
+        for nome_arquivo in arquivos:
+            with z.open(nome_arquivo) as f:
+                # Tenta diferentes encodings e separadores
+                conteudo = f.read()
+                for encoding in ["utf-8", "latin1", "cp1252"]:
+                    try:
+                        df = pd.read_csv(
+                            io.BytesIO(conteudo),
+                            sep=None, engine="python",
+                            encoding=encoding,
+                            nrows=3
+                        )
+                        resultado[nome_arquivo] = {
+                            "encoding": encoding,
+                            "colunas": list(df.columns),
+                            "amostra": df.head(2).to_dict(orient="records")
+                        }
+                        break
+                    except Exception:
+                        continue
+                else:
+                    resultado[nome_arquivo] = {"erro": "Não foi possível parsear o arquivo"}
+
+    return {
+        "arquivos_no_zip": arquivos,
+        "conteudo": resultado,
+        "metadata_btg": {k: v for k, v in dados.items() if k != "url"}
+    }
 
-        if not validar_url_download(url_zip):
-            return jsonify({"erro": "URL não autorizada"}), 400
 
-        # Baixa e abre o ZIP
-        r_zip = requests.get(url_zip, timeout=60)
-        r_zip.raise_for_status()
+@app.route("/trigger/jobs/<job_id>", methods=["GET"])
+def status_job(job_id):
+    """
+    Status (executando | concluido | erro | abandonado) e resultado de um job
+    em background. Job "executando" sem heartbeat há mais de
+    JOB_ABANDONADO_APOS segundos (worker morto) passa a "abandonado".
+    """
+    if not validar_token(request):
+        return jsonify({"erro": "Acesso negado"}), 403
 
-        with zipfile.ZipFile(io.BytesIO(r_zip.content)) as z:
-            arquivos = z.namelist()
-            resultado = {}
-            for nome_arquivo in arquivos:
-                with z.open(nome_arquivo) as f:
-                    # Tenta diferentes encodings e separadores
-                    conteudo = f.read()
-                    for encoding in ["utf-8", "latin1", "cp1252"]:
-                        try:
-                            df = pd.read_csv(
-                                io.BytesIO(conteudo),
-                                sep=None, engine="python",
-                                encoding=encoding,
-                                nrows=3
-                            )
-                            resultado[nome_arquivo] = {
-                                "encoding": encoding,
-                                "colunas": list(df.columns),
-                                "amostra": df.head(2).to_dict(orient="records")
-                            }
-                            break
-                        except Exception:
-                            continue
-                    else:
-                        resultado[nome_arquivo] = {"erro": "Não foi possível parsear o arquivo"}
+    try:
+        garantir_tabela(TABELA_JOBS)
+        t = TABELA_JOBS
+        with get_engine().begin() as conn:
+            job = dict(conn.execute(
+                t.select().where(t.c.job_id == job_id)
+            ).mappings().first() or {})
+            if not job:
+                return jsonify({"erro": "Job não encontrado"}), 404
+
+            sinal = job["heartbeat"] or job["inicio"]
+            if (
+                job["status"] == "executando"
+                and now_brasilia() - sinal > timedelta(seconds=JOB_ABANDONADO_APOS)
+            ):
+                job["status"]    = "abandonado"
+                job["resultado"] = json.dumps({
+                    "erro": f"sem heartbeat desde {sinal.isoformat()} "
+                            f"(worker {job['host']}:{job['pid']})"
+                }, ensure_ascii=False)
+                conn.execute(
+                    t.update()
+                    .where(t.c.job_id == job_id, t.c.status == "executando")
+                    .values(status=job["status"], resultado=job["resultado"])
+                )
 
         return jsonify({
-            "arquivos_no_zip": arquivos,
-            "conteudo": resultado,
-            "metadata_btg": {k: v for k, v in dados.items() if k != "url"}
+            "job_id":    job["job_id"],
+            "tipo":      job["tipo"],
+            "status":    job["status"],
+            "inicio":    job["inicio"].isoformat() if job["inicio"] else None,
+            "fim":       job["fim"].isoformat() if job["fim"] else None,
+            "heartbeat": job["heartbeat"].isoformat() if job["heartbeat"] else None,
+            "worker":    f"{job['host']}:{job['pid']}" if job["pid"] else None,
+            "resultado": json.loads(job["resultado"]) if job["resultado"] else None,
         }), 200
-
     except Exception as e:
-        return erro_interno("INSPECIONAR_POSICAO", e)
+        return erro_interno("STATUS_JOB", e)
 
 
 @app.route("/trigger/saldo-cc", methods=["GET"])
+@pipeline("SALDO_CC")
 def trigger_saldo_cc():
     """
     Busca saldo de todas as contas em tempo real via API BTG e grava saldo_conta_corrente.
@@ -1163,7 +3924,7 @@ def trigger_saldo_cc():
             "Content-Type": "application/json"
         }
 
-        r = requests.get(URL_SALDO_CC, headers=headers_btg, timeout=30)
+        r = baixar(URL_SALDO_CC, headers=headers_btg, timeout=30)
         r.raise_for_status()
 
         payload = r.json()
@@ -1177,12 +3938,8 @@ def trigger_saldo_cc():
         df["Conta"] = df["Conta"].astype(str).str.strip().str.lstrip("0")
         df["SALDO"] = pd.to_numeric(df["SALDO"], errors="coerce")
 
-        # Adiciona Assessor via base_btg
-        engine = get_engine()
-        with engine.connect() as conn:
-            base_ref = pd.read_sql("SELECT Conta, Assessor FROM dbo.base_btg", conn)
-        base_ref["Conta"] = base_ref["Conta"].astype(str)
-        df = df.merge(base_ref, on="Conta", how="left")
+        # Adiciona Assessor via base_btg (cache de referência)
+        df["Assessor"] = df["Conta"].map(obter_referencia("base_btg")["assessor"])
 
         # Mantém apenas colunas da tabela destino
         df = df[["Conta", "SALDO", "Assessor"]]
@@ -1249,7 +4006,127 @@ def trigger_calcular_saidas():
     return jsonify({"status": "iniciado"}), 202
 
 
+@app.route("/trigger/limpar-arquivo-raw", methods=["GET"])
+def trigger_limpar_arquivo_raw():
+    """
+    Aplica a retenção do arquivo raw (ARQUIVO_RAW_RETENCAO_DIAS) — agendado à
+    parte (.github/workflows/gatilho_limpar_arquivo_raw.yml, diário às 3:00
+    BRT), fora do caminho da ingestão.
+    Roda em background; o resultado sai em /trigger/jobs/<job_id>.
+    """
+    if not validar_token(request):
+        return jsonify({"erro": "Acesso negado"}), 403
+
+    def limpar() -> dict:
+        removidos = limpar_arquivo_raw()
+        registrar_log("LIMPAR_ARQUIVO_RAW", "Sucesso", removidos,
+                      f"{removidos} arquivos com mais de {ARQUIVO_RAW_RETENCAO_DIAS} dias")
+        return {"removidos": removidos, "retencao_dias": ARQUIVO_RAW_RETENCAO_DIAS}
+
+    try:
+        job_id = iniciar_job("LIMPAR_ARQUIVO_RAW", limpar)
+        return jsonify({
+            "status": "iniciado",
+            "job_id": job_id,
+            "acompanhar": f"/trigger/jobs/{job_id}",
+        }), 202
+    except Exception as e:
+        return erro_interno("LIMPAR_ARQUIVO_RAW", e)
+
+
+@app.route("/trigger/performance-lote", methods=["GET"])
+def trigger_performance_lote():
+    """
+    Solicita ao BTG o relatório de performance de todas as contas da base_btg
+    (ou das informadas em ?contas=1,2,3) para o período ?inicio=&fim=
+    (padrão: mês anterior). As entregas chegam pelo webhook/performance;
+    contas que não chegarem são pedidas de novo automaticamente.
+    """
+    if not validar_token(request):
+        return jsonify({"erro": "Acesso negado"}), 403
+
+    try:
+        hoje = now_brasilia().date()
+        fim_padrao    = hoje.replace(day=1) - timedelta(days=1)
+        data_inicio   = pd.Timestamp(request.args.get("inicio") or fim_padrao.replace(day=1)).date()
+        data_fim      = pd.Timestamp(request.args.get("fim") or fim_padrao).date()
+    except ValueError:
+        return jsonify({"erro": "Datas inválidas — use AAAA-MM-DD"}), 400
+
+    try:
+        if request.args.get("contas"):
+            contas = [c.strip() for c in request.args["contas"].split(",") if c.strip()]
+        else:
+            contas = sorted(obter_referencia("base_btg")["assessor"])
+        contas = [c for c in dict.fromkeys(contas) if c.lower() != "nan"]
+        if not contas:
+            return jsonify({"erro": "Nenhuma conta para solicitar"}), 400
+
+        # Sem derivar do host da requisição: atrás do proxy do Render ele chega
+        # como http://, e o BTG precisa do endereço público configurado
+        callback = URL_CALLBACK_PERFORMANCE
+        if not callback:
+            return jsonify({"erro": "PERFORMANCE_CALLBACK_URL não configurada"}), 503
+        destino = urlparse(callback)
+        if destino.scheme != "https" and destino.netloc not in DOMINIOS_LOCAIS:
+            return jsonify({"erro": "PERFORMANCE_CALLBACK_URL deve ser https"}), 503
+        lote_id  = str(uuid.uuid4())
+
+        garantir_tabela(TABELA_PERFORMANCE_LOTE)
+        with get_engine().begin() as conn:
+            conn.execute(TABELA_PERFORMANCE_LOTE.insert(), [
+                {"lote_id": lote_id, "conta": c, "data_inicio": data_inicio,
+                 "data_fim": data_fim, "status": "pendente", "tentativas": 0}
+                for c in contas
+            ])
+
+        thread = threading.Thread(
+            target=_executar_performance_lote,
+            args=(lote_id, data_inicio.isoformat(), data_fim.isoformat(), callback),
+            daemon=True
+        )
+        thread.start()
+        return jsonify({
+            "status":  "iniciado",
+            "lote_id": lote_id,
+            "contas":  len(contas),
+            "periodo": [data_inicio.isoformat(), data_fim.isoformat()],
+        }), 202
+
+    except Exception as e:
+        return erro_interno("PERFORMANCE_LOTE", e)
+
+
+@app.route("/trigger/performance-lote/<lote_id>", methods=["GET"])
+def status_performance_lote(lote_id):
+    """Quantidade de contas do lote por status (pendente/solicitado/entregue/falha)."""
+    if not validar_token(request):
+        return jsonify({"erro": "Acesso negado"}), 403
+
+    try:
+        garantir_tabela(TABELA_PERFORMANCE_LOTE)
+        with get_engine().connect() as conn:
+            df = pd.read_sql(
+                TABELA_PERFORMANCE_LOTE.select()
+                .where(TABELA_PERFORMANCE_LOTE.c.lote_id == lote_id),
+                conn
+            )
+        if df.empty:
+            return jsonify({"erro": "Lote não encontrado"}), 404
+
+        return jsonify({
+            "lote_id":   lote_id,
+            "total":     len(df),
+            "status":    df["status"].value_counts().to_dict(),
+            "faltando":  df.loc[df["status"] != "entregue", "conta"].tolist()[:500],
+        }), 200
+
+    except Exception as e:
+        return erro_interno("PERFORMANCE_LOTE", e)
+
+
 @app.route("/trigger/carteiras-recomendadas", methods=["GET"])
+@pipeline("CARTEIRAS_RECOM")
 def trigger_carteiras_recomendadas():
     if not validar_token(request):
         return jsonify({"erro": "Acesso negado"}), 403
@@ -1266,11 +4143,7 @@ def trigger_carteiras_recomendadas():
     }
 
     try:
-        url = (
-            "https://api.btgpactual.com/iaas-recommended-equities/api/v1/"
-            "recommended-equities-allocation"
-        )
-        r = requests.get(url, headers=headers)
+        r = baixar(URL_CARTEIRAS_RECOM, headers=headers)
 
         if r.status_code != 200:
             erro_msg = f"Erro BTG: {r.status_code}"
@@ -1323,6 +4196,7 @@ def trigger_carteiras_recomendadas():
 # 7. WEBHOOKS
 
 @app.route("/webhook/basebtg", methods=["POST"])
+@pipeline("BASE_BTG")
 def webhook_base_btg():
     if not validar_token(request):
         return jsonify({"erro": "Acesso negado"}), 403
@@ -1339,22 +4213,15 @@ def webhook_base_btg():
             return jsonify({"erro": "URL não autorizada"}), 400
 
         # ── 1. DOWNLOAD E PARSE ───────────────────────────────────────────────
-        r = requests.get(url_download)
+        r = baixar(url_download)
         r.raise_for_status()
 
-        base = pd.read_csv(io.BytesIO(r.content), sep=";", encoding="utf-8")
+        # ── 2. BACKUP RAW (bytes originais comprimidos) ───────────────────────
+        arquivar_raw("base_btg", r.content)
 
-        # ── 2. BACKUP RAW ─────────────────────────────────────────────────────
-        df_raw = base.copy()
-        df_raw["data_recebimento_webhook"] = now_brasilia()
-        salvar_df_otimizado(df_raw, "backup_base_btg_raw", if_exists="append")
-
-        # TTL: remove registros com mais de 90 dias
-        with engine.begin() as conn:
-            conn.execute(text("""
-                DELETE FROM dbo.backup_base_btg_raw
-                WHERE data_recebimento_webhook < DATEADD(DAY, -90, GETDATE())
-            """))
+        with etapa("parse_csv", bytes=len(r.content)) as e:
+            base = _ler_csv_base_btg(r.content)
+            e.linhas = len(base)
 
         # ── 3. RENAME ─────────────────────────────────────────────────────────
         renomear_presentes = {
@@ -1376,58 +4243,55 @@ def webhook_base_btg():
             registrar_log("BASE_BTG", "Erro", 0, msg)
             return jsonify({"erro": msg}), 400
 
-        # ── 5. TIPAGEM ────────────────────────────────────────────────────────
-        base["Conta"]    = base["Conta"].astype(str).str.strip()
-        base["Assessor"] = base["Assessor"].astype(str).str.upper().str.strip()
+        with etapa("transformacao", linhas=len(base)):
+            # ── 5. TIPAGEM ────────────────────────────────────────────────────
+            base["Conta"]    = base["Conta"].astype(str).str.strip()
 
-        for col_data in [
-            "Data Vínculo", "Data de Abertura", "dt_nascimento",
-            "dt_primeiro_investimento", "dt_ultimo_aporte", "dt_vinculo_escritorio"
-        ]:
-            if col_data in base.columns:
-                base[col_data] = pd.to_datetime(base[col_data], errors="coerce")
+            for col_data in [
+                "Data Vínculo", "Data de Abertura", "dt_nascimento",
+                "dt_primeiro_investimento", "dt_ultimo_aporte", "dt_vinculo_escritorio"
+            ]:
+                if col_data in base.columns:
+                    base[col_data] = pd.to_datetime(base[col_data], errors="coerce")
 
-        # ── 6. REGRAS DE NEGÓCIO ──────────────────────────────────────────────
-        if "Faixa Cliente" in base.columns:
-            base.loc[
-                base["Faixa Cliente"].isin(FAIXAS_ATE_300K),
-                "Faixa Cliente"
-            ] = "Ate 300k"
+            # ── 6. REGRAS DE NEGÓCIO ──────────────────────────────────────────
+            if "Faixa Cliente" in base.columns:
+                base.loc[
+                    base["Faixa Cliente"].isin(FAIXAS_ATE_300K),
+                    "Faixa Cliente"
+                ] = "Ate 300k"
 
-        base = aplicar_correcoes_assessor(base)
+            base = aplicar_correcoes_assessor(base)
 
         # ── 7. MERGE COM OFFSHORE ─────────────────────────────────────────────
         engine = get_engine()
-        try:
-            with engine.connect() as conn:
-                offshore = pd.read_sql(
-                    "SELECT Conta, Nome, Assessor, [PL Total] FROM dbo.pl_offshore",
-                    conn
-                )
-            offshore["Conta"] = offshore["Conta"].astype(str).str.strip()
+        with etapa("merge_offshore") as etapa_offshore:
+            try:
+                offshore = obter_referencia("pl_offshore")
 
-            # Offshore entra no topo — keep='first' no drop_duplicates preserva offshore
-            base = pd.concat([offshore, base], axis=0, ignore_index=True)
-            print(f"[BASE_BTG] Offshore mesclado: {len(offshore)} contas", flush=True)
+                # Offshore entra no topo — keep='first' no drop_duplicates preserva offshore
+                base = pd.concat([offshore, base], axis=0, ignore_index=True)
+                print(f"[BASE_BTG] Offshore mesclado: {len(offshore)} contas", flush=True)
 
-        except Exception as e:
-            print(f"[AVISO BASE_BTG] Offshore não carregado (tabela ausente?): {e}",
-                  flush=True)
+            except Exception as e:
+                print(f"[AVISO BASE_BTG] Offshore não carregado (tabela ausente?): {e}",
+                      flush=True)
 
-        # ── 8. DEDUPLICAÇÃO ───────────────────────────────────────────────────
-        base.drop_duplicates(subset="Conta", keep="first", inplace=True)
+            # ── 8. DEDUPLICAÇÃO ───────────────────────────────────────────────
+            base.drop_duplicates(subset="Conta", keep="first", inplace=True)
+            etapa_offshore.linhas = len(base)
 
         # ── 9. SALVA BASE_BTG ─────────────────────────────────────────────────
         salvar_df_otimizado(
             base, "base_btg",
             col_pk="Conta", if_exists="replace"
         )
+        invalidar_referencia("base_btg")
 
         # ── 10. SNAPSHOT DIÁRIO ───────────────────────────────────────────────
         hoje = now_brasilia().replace(
             hour=0, minute=0, second=0, microsecond=0
         )
-        str_hoje = hoje.strftime("%Y-%m-%d")
 
         df_snapshot = base[
             [c for c in COLUNAS_SNAPSHOT if c in base.columns]
@@ -1435,16 +4299,14 @@ def webhook_base_btg():
         df_snapshot["Data"] = hoje
         df_snapshot["Mês"]  = hoje.strftime("%Y/%m")
 
-        # Idempotência: remove snapshot do dia atual antes de reinserir
-        with engine.begin() as conn:
-            conn.execute(text("""
-                DELETE FROM dbo.base_btg_snapshot_diario
-                WHERE CONVERT(DATE, Data) = :hoje
-            """), {"hoje": str_hoje})
-
-        salvar_df_otimizado(
-            df_snapshot, "base_btg_snapshot_diario", if_exists="append"
-        )
+        if SNAPSHOT_BASE_MODO == "scd2":
+            # Só contas novas, alteradas ou que saíram geram escrita
+            salvar_snapshot_scd2(df_snapshot, hoje)
+        else:
+            # Idempotência: substitui o snapshot do dia atual
+            salvar_particao(
+                df_snapshot, "base_btg_snapshot_diario", "Data", *_intervalo_dia(hoje)
+            )
 
         # ── 11. PL HISTÓRICO DIÁRIO ───────────────────────────────────────────
         df_pl_hist = base[
@@ -1454,23 +4316,29 @@ def webhook_base_btg():
         df_pl_hist["Data"] = hoje
         df_pl_hist["Mês"]  = hoje.strftime("%Y/%m")
 
-        with engine.begin() as conn:
-            conn.execute(text("""
-                DELETE FROM dbo.pl_historico_diario
-                WHERE CONVERT(DATE, Data) = :hoje
-            """), {"hoje": str_hoje})
-
-        salvar_df_otimizado(
-            df_pl_hist, "pl_historico_diario", if_exists="append"
+        # "Valores em Trânsito" entrou depois da criação da tabela
+        acrescentar_colunas_df("pl_historico_diario", df_pl_hist)
+        salvar_particao(
+            df_pl_hist, "pl_historico_diario", "Data", *_intervalo_dia(hoje)
         )
+        if SNAPSHOT_BASE_MODO == "scd2":
+            # A view segue as colunas do pl_historico_diario — recria depois
+            # dele existir / ganhar coluna (na 1ª carga ainda não existia)
+            with engine.begin() as conn:
+                _recriar_view_snapshot_scd(conn)
 
         # ── 12. TABELAS DERIVADAS ─────────────────────────────────────────────
-        _atualizar_tipo_clientes(base, engine)
+        with etapa("tipo_clientes"):
+            _atualizar_tipo_clientes(base, engine)
 
         # ── 12b. PL BASE (histórico mensal) ───────────────────────────────────
+        # Só o mês vigente é reescrito — meses fechados não são lidos nem tocados
         pl_base_linhas = 0
         try:
-            primeiro_dia_mes = hoje.strftime("%Y-%m-01")
+            inicio_mes  = hoje.replace(day=1)
+            proximo_mes = (inicio_mes + timedelta(days=32)).replace(day=1)
+            str_inicio_mes  = inicio_mes.strftime("%Y-%m-%d")
+            str_proximo_mes = proximo_mes.strftime("%Y-%m-%d")
 
             # Onshore: extrai Assessor, CONTA, PL do base atual
             pl_hoje = base[["Assessor", "Conta", "PL Total"]].copy()
@@ -1479,60 +4347,29 @@ def webhook_base_btg():
             pl_hoje["PL"] = pl_hoje["PL"].fillna(0)
             pl_hoje["Assessor"] = pl_hoje["Assessor"].astype(str).str.upper()
 
-            # Histórico anterior (preserva meses fechados)
-            with engine.connect() as conn:
-                pl_base_hist = pd.read_sql("SELECT * FROM dbo.[PL Base]", conn)
-            pl_base_hist = pl_base_hist[pl_base_hist["Mês"] < primeiro_dia_mes]
-
-            pl_onshore = pd.concat([pl_base_hist, pl_hoje], axis=0, ignore_index=True)
-
-            # Offshore
-            with engine.connect() as conn:
-                pl_offshore_hist = pd.read_sql(
-                    "SELECT * FROM dbo.offshore_adicionar_pl_mes_vigente", conn
-                )
-                pl_offshore = pd.read_sql(
-                    "SELECT Conta, [PL Total], Assessor FROM dbo.pl_offshore", conn
-                )
-
-            pl_offshore_hist = pl_offshore_hist[
-                pl_offshore_hist["Mês"] < primeiro_dia_mes
-            ]
-            pl_offshore_hist["Mês"] = pd.to_datetime(
-                pl_offshore_hist["Mês"]
-            ).dt.strftime("%Y-%m-%d")
-
+            # Offshore do mês vigente (coluna Mês gravada como texto)
+            pl_offshore = obter_referencia("pl_offshore")[
+                ["Conta", "PL Total", "Assessor"]
+            ].copy()
             pl_offshore["Mês"] = hoje.strftime("%Y-%m-%d")
             pl_offshore.rename(
                 columns={"Conta": "CONTA", "PL Total": "PL"}, inplace=True
             )
-
-            offshore_mes_vigente = pd.concat(
-                [pl_offshore, pl_offshore_hist], axis=0, ignore_index=True
-            )
-            salvar_df_otimizado(
-                offshore_mes_vigente, "offshore_adicionar_pl_mes_vigente",
-                if_exists="replace"
+            salvar_particao(
+                pl_offshore, "offshore_adicionar_pl_mes_vigente", "Mês",
+                str_inicio_mes, str_proximo_mes
             )
 
-            # Concat final onshore + offshore
-            pl_final = pd.concat([pl_onshore, offshore_mes_vigente], axis=0, ignore_index=True)
+            # Mês vigente onshore + offshore
+            pl_final = pd.concat([pl_hoje, pl_offshore], axis=0, ignore_index=True)
 
-            # Correções de assessor
-            correcoes_pl = {
-                "RODRIGO DE MELLO DELIA":    "RODRIGO DE MELLO D'ELIA",
-                "RODRIGO DE MELLO D?ELIA":   "RODRIGO DE MELLO D'ELIA",
-                "ROSANA PAVANI":             "ROSANA APARECIDA PAVANI DA SILVA",
-                "FERNANDO DOMINGUES":        "FERNANDO DOMINGUES DA SILVA",
-                "MURILO LUIZ SILVA GINO":    "IZADORA VILLELA FREITAS",
-            }
-            pl_final["Assessor"] = pl_final["Assessor"].replace(correcoes_pl)
+            pl_final["Assessor"] = pl_final["Assessor"].replace(CORRECOES_ASSESSOR_PL_BASE)
 
             pl_final["CONTA"] = pl_final["CONTA"].astype(str)
             pl_final["Mês"] = pd.to_datetime(pl_final["Mês"])
             pl_final.drop_duplicates(subset=["CONTA", "Mês"], keep="first", inplace=True)
 
-            salvar_df_otimizado(pl_final, "PL Base", if_exists="replace")
+            salvar_particao(pl_final, "PL Base", "Mês", inicio_mes, proximo_mes)
             pl_base_linhas = len(pl_final)
             print(f"[BASE_BTG] PL Base atualizado: {pl_base_linhas} linhas", flush=True)
 
@@ -1568,6 +4405,7 @@ def webhook_base_btg():
 
 
 @app.route("/webhook/nnm", methods=["POST"])
+@pipeline("NNM")
 def webhook_nnm():
     if not validar_token(request):
         return jsonify({"erro": "Acesso negado"}), 403
@@ -1583,10 +4421,15 @@ def webhook_nnm():
                           f"URL bloqueada por política SSRF: {url_download}")
             return jsonify({"erro": "URL não autorizada"}), 400
 
-        r = requests.get(url_download)
+        r = baixar(url_download)
         r.raise_for_status()
 
-        df = pd.read_csv(io.StringIO(r.content.decode("utf-8")), sep=";")
+        # ── 1. BACKUP RAW (bytes originais comprimidos) ───────────────────────
+        sha_raw = arquivar_raw("nnm", r.content)
+
+        with etapa("parse_csv", bytes=len(r.content)) as e:
+            df = _ler_csv_nnm(r.content)
+            e.linhas = len(df)
         df.rename(columns={"dt_captacao": "data_captacao"}, inplace=True)
 
         # Remove lançamentos do tipo RS (estorno de saldo — não representa captação)
@@ -1607,26 +4450,6 @@ def webhook_nnm():
 
         engine = get_engine()
 
-        # ── 1. BACKUP RAW (janela 10 dias) ────────────────────────────────────
-        df_raw = df.copy()
-        df_raw["data_recebimento_webhook"] = now_brasilia()
-        str_corte_backup = (data_max_csv - timedelta(days=10)).strftime("%Y-%m-%d")
-
-        with engine.begin() as conn:
-            conn.execute(text("""
-                DELETE FROM dbo.backup_nnm_raw
-                WHERE data_captacao > :corte
-            """), {"corte": str_corte_backup})
-
-        salvar_df_otimizado(df_raw, "backup_nnm_raw", if_exists="append")
-
-        # TTL: remove registros com mais de 90 dias
-        with engine.begin() as conn:
-            conn.execute(text("""
-                DELETE FROM dbo.backup_nnm_raw
-                WHERE data_recebimento_webhook < DATEADD(DAY, -90, GETDATE())
-            """))
-
         # ── 2. MONTA NNM PADRÃO ───────────────────────────────────────────────
         # Corte = D-2 em relação ao max do CSV para garantir que dias parciais
         # (CSV enviado às 15h) sejam reprocessados por completo nas execuções seguintes.
@@ -1647,15 +4470,11 @@ def webhook_nnm():
         df_nnm["CONTA"]           = df_nnm["CONTA"].astype(str).str.strip()
         df_nnm["TIPO DE CAPTACAO"] = "Padrão"
 
-        # Assessor via cge_officer → times_nova_empresa
-        with engine.connect() as conn:
-            times_df  = pd.read_sql(
-                "SELECT Assessor, [CGE OFFICER] FROM dbo.times_nova_empresa", conn
-            )
-            times_df.columns = [c.strip() for c in times_df.columns]
-            if "assessor" in times_df.columns and "Assessor" not in times_df.columns:
-                times_df.rename(columns={"assessor": "Assessor"}, inplace=True)
-            base_ref  = pd.read_sql("SELECT Conta, Nome, Assessor FROM dbo.base_btg", conn)
+        # Referências em cache: assessor por cge_officer e base_btg atual
+        ref_times = obter_referencia("times_nova_empresa")
+        ref_base  = obter_referencia("base_btg")
+
+        with etapa("ler_referencias"), engine.connect() as conn:
             migracoes = pd.read_sql(
                 text("SELECT CONTA, DATA, [CAPTAÇÃO], Assessor FROM dbo.migracoes_btg "
                      "WHERE DATA >= :corte"),
@@ -1672,20 +4491,13 @@ def webhook_nnm():
                 conn
             )
 
-        times_df["CGE OFFICER"] = times_df["CGE OFFICER"].astype(str).str.strip()
-
+        # Assessor via cge_officer → times_nova_empresa
         if "cge_officer" in df_nnm.columns:
             df_nnm["cge_officer"] = df_nnm["cge_officer"].astype(str).str.strip()
-            df_nnm = df_nnm.merge(
-                times_df, left_on="cge_officer", right_on="CGE OFFICER", how="left"
-            )
-            df_nnm.drop(columns=["CGE OFFICER"], errors="ignore", inplace=True)
+            df_nnm["Assessor"] = df_nnm["cge_officer"].map(ref_times)
         else:
             df_nnm["Assessor"] = None
 
-        if "Assessor" not in df_nnm.columns:
-            df_nnm["Assessor"] = None
-
         colunas_nnm = ["DATA", "CONTA", "CAPTAÇÃO", "Assessor", "TIPO DE CAPTACAO", "MERCADO"]
         df_nnm = df_nnm[[c for c in colunas_nnm if c in df_nnm.columns]].copy()
         for c in colunas_nnm:
@@ -1725,50 +4537,31 @@ def webhook_nnm():
         captacao_hoje["CAPTAÇÃO"] = pd.to_numeric(captacao_hoje["CAPTAÇÃO"], errors="coerce").fillna(0)
 
         # ── 6. SITUAÇÃO ATIVO/INATIVO ─────────────────────────────────────────
-        base_ref["Conta"] = base_ref["Conta"].astype(str).str.strip()
-        contas_ativas_set = set(base_ref["Conta"])
-
-        captacao_hoje["Situacao"] = captacao_hoje["CONTA"].apply(
-            lambda x: "Ativo" if x in contas_ativas_set else "Inativo"
-        )
+        captacao_hoje["Situacao"] = captacao_hoje["CONTA"].isin(ref_base["assessor"].keys()) \
+            .map({True: "Ativo", False: "Inativo"})
 
         # ── 7. DÉBITOS DE SAÍDA (contas inativas) ─────────────────────────────
         contas_inativas = captacao_hoje[captacao_hoje["Situacao"] == "Inativo"] \
             .drop_duplicates(subset="CONTA")
 
         # Busca PL apenas das contas inativas — evita carregar tabela inteira
-        pl_hist = pd.DataFrame()
+        pl_hist = pd.DataFrame(columns=["CONTA", "PL Total", "Data"])
         if not contas_inativas.empty:
-            lista_inativas = "', '".join(contas_inativas["CONTA"].tolist())
-            with engine.connect() as conn:
-                pl_hist = pd.read_sql(
-                    text(f"SELECT Conta AS CONTA, [PL Total], Data "
-                         f"FROM dbo.pl_historico_diario "
-                         f"WHERE Conta IN ('{lista_inativas}')"),
-                    conn
+            with etapa("ler:pl_historico_diario", linhas=len(contas_inativas)), \
+                    engine.connect() as conn:
+                pl_hist = ler_por_chaves(
+                    conn,
+                    "SELECT Conta AS CONTA, [PL Total], Data "
+                    "FROM dbo.pl_historico_diario WHERE Conta IN :chaves",
+                    contas_inativas["CONTA"].tolist()
                 )
             pl_hist["CONTA"] = pl_hist["CONTA"].astype(str).str.strip()
             pl_hist["Data"]  = pd.to_datetime(pl_hist["Data"], errors="coerce")
 
-        debitos = []
-        for _, row in contas_inativas.iterrows():
-            conta = row["CONTA"]
-            pl_conta = pl_hist[pl_hist["CONTA"] == conta].sort_values("Data")
-            if pl_conta.empty:
-                continue
-            ultimo = pl_conta.iloc[-1]
-            debitos.append({
-                "CONTA":            conta,
-                "CAPTAÇÃO":         float(ultimo["PL Total"]) * -1,
-                "Assessor":         row["Assessor"],
-                "Situacao":         "Inativo",
-                "TIPO DE CAPTACAO": "Saída de conta",
-                "MERCADO":          "Saída de conta",
-                "_data_pl":         ultimo["Data"],
-            })
+        with etapa("debitos_saida", linhas=len(pl_hist)):
+            df_debitos = _calcular_debitos_saida(contas_inativas, pl_hist)
 
-        if debitos:
-            df_debitos = pd.DataFrame(debitos)
+        if not df_debitos.empty:
 
             # Usa data oficial de saída de Entradas_e_saidas_consolidado
             entradas_saidas["CONTA"] = entradas_saidas["CONTA"].astype(str).str.strip()
@@ -1785,35 +4578,22 @@ def webhook_nnm():
             captacao_hoje = pd.concat([captacao_hoje, df_debitos], axis=0, ignore_index=True)
 
         # ── 8. ATUALIZA ASSESSOR ATUAL ────────────────────────────────────────
-        assessor_atual = base_ref[["Conta", "Assessor"]].rename(
-            columns={"Conta": "CONTA", "Assessor": "Assessor_atual"}
-        )
-        captacao_hoje = captacao_hoje.merge(assessor_atual, on="CONTA", how="left")
-        captacao_hoje["Assessor"] = captacao_hoje["Assessor_atual"].fillna(captacao_hoje["Assessor"])
-        captacao_hoje.drop(columns=["Assessor_atual"], inplace=True)
-        captacao_hoje["Assessor"] = captacao_hoje["Assessor"].astype(str).str.upper()
+        captacao_hoje["Assessor"] = captacao_hoje["CONTA"].map(ref_base["assessor"]) \
+            .fillna(captacao_hoje["Assessor"])
         captacao_hoje = aplicar_correcoes_assessor(captacao_hoje)
 
         # ── 9. ADICIONA NOME ──────────────────────────────────────────────────
-        nomes = base_ref[["Conta", "Nome"]].rename(columns={"Conta": "CONTA"})
-        nomes.drop_duplicates("CONTA", inplace=True)
         if "Nome" in captacao_hoje.columns:
             captacao_hoje.drop(columns=["Nome"], inplace=True)
-        captacao_hoje = captacao_hoje.merge(nomes, on="CONTA", how="left")
+        captacao_hoje["Nome"] = captacao_hoje["CONTA"].map(ref_base["nome"])
 
         captacao_hoje["DATA"] = pd.to_datetime(captacao_hoje["DATA"], errors="coerce")
 
-        # ── 10. SALVA EM captacao_historico (deleta D-1 e reinsere) ─────────────
-        with engine.begin() as conn:
-            conn.execute(text("""
-                DELETE FROM dbo.captacao_historico
-                WHERE CONVERT(DATE, DATA) >= :corte
-            """), {"corte": str_corte})
-
-        salvar_df_otimizado(captacao_hoje, "captacao_historico", if_exists="append")
+        # ── 10. SALVA EM captacao_historico (substitui a partir do corte) ──────
+        salvar_particao(captacao_hoje, "captacao_historico", "DATA", data_corte.to_pydatetime())
 
         msg = (
-            f"Raw backup: {str_min}→{str_max} ({len(df_raw)} linhas) | "
+            f"Raw backup: {str_min}→{str_max} ({len(df)} linhas) | "
             f"captacao_historico {str_corte} ate {str_max}: {len(captacao_hoje)} linhas"
         )
         print(f"[SUCESSO NNM] {msg}")
@@ -1824,7 +4604,8 @@ def webhook_nnm():
 
         return jsonify({
             "status":              "Sucesso",
-            "backup_raw":          {"de": str_min, "ate": str_max, "linhas": len(df_raw)},
+            "backup_raw":          {"de": str_min, "ate": str_max, "linhas": len(df),
+                                    "sha256": sha_raw},
             "captacao_historico":  len(captacao_hoje),
         }), 200
 
@@ -1836,7 +4617,98 @@ def webhook_nnm():
         return erro_interno("NNM", e)
 
 
+_coluna_hash_performance = False
+_hash_performance_lock   = threading.Lock()
+
+
+def _garantir_hash_performance(conn):
+    """Acrescenta hash_conteudo em relatorios_performance_atual (uma vez por worker)."""
+    global _coluna_hash_performance
+    if _coluna_hash_performance:
+        return
+    with _hash_performance_lock:
+        if _coluna_hash_performance:
+            return
+        TABELA_RELATORIOS_PERFORMANCE.create(conn, checkfirst=True)
+        colunas = {c["name"] for c in inspect(conn).get_columns(
+            "relatorios_performance_atual", schema=SCHEMA_DEFAULT
+        )}
+        if "hash_conteudo" not in colunas:
+            conn.execute(text(
+                "ALTER TABLE dbo.relatorios_performance_atual ADD hash_conteudo VARCHAR(64) NULL"
+            ))
+        _coluna_hash_performance = True
+
+
+def _hash_membro_zip(z: zipfile.ZipFile, nome: str) -> str:
+    h = hashlib.sha256()
+    with z.open(nome) as f:
+        for bloco in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(bloco)
+    return h.hexdigest()
+
+
+@etapa("gravar:relatorios_performance_atual")
+def _gravar_relatorios_performance(z: zipfile.ZipFile, conta_id: str, data_ref) -> Tuple[int, int, list]:
+    """
+    Grava os PDFs do ZIP em relatorios_performance_atual.
+    O hash de cada PDF é calculado lendo o membro em blocos; só os que mudaram
+    são lidos inteiros e enviados, em lotes de até PERFORMANCE_LOTE_BYTES por
+    executemany. Retorna (atualizados, ignorados, contas do ZIP).
+    """
+    # Conta → (nome do arquivo, hash); se a conta repetir no ZIP, vale o último
+    candidatos = {}
+    for nome_arquivo in z.namelist():
+        if not nome_arquivo.lower().endswith(".pdf"):
+            continue
+        conta_final = (
+            conta_id if conta_id != "Desconhecida"
+            else extrair_conta_do_nome(nome_arquivo)
+        )
+        candidatos[conta_final] = (nome_arquivo, _hash_membro_zip(z, nome_arquivo))
+
+    if not candidatos:
+        return 0, 0, []
+
+    with get_engine().begin() as conn:
+        _garantir_hash_performance(conn)
+
+        atuais = ler_por_chaves(
+            conn,
+            "SELECT conta, hash_conteudo FROM dbo.relatorios_performance_atual "
+            "WHERE conta IN :chaves",
+            list(candidatos)
+        )
+        atuais = dict(zip(atuais["conta"].astype(str), atuais["hash_conteudo"]))
+
+        alterados = [
+            (conta, nome, hash_pdf) for conta, (nome, hash_pdf) in candidatos.items()
+            if atuais.get(conta) != hash_pdf
+        ]
+
+        lote, bytes_lote = [], 0
+        data_upload = now_brasilia()
+        for conta, nome, hash_pdf in alterados:
+            pdf_bytes = z.read(nome)
+            lote.append({
+                "conta":           conta,
+                "arquivo_pdf":     pdf_bytes,
+                "nome_arquivo":    nome,
+                "data_referencia": data_ref,
+                "hash_conteudo":   hash_pdf,
+                "data_upload":     data_upload,
+            })
+            bytes_lote += len(pdf_bytes)
+            if bytes_lote >= PERFORMANCE_LOTE_BYTES:
+                upsert(conn, "relatorios_performance_atual", lote, ["conta"])
+                lote, bytes_lote = [], 0
+        upsert(conn, "relatorios_performance_atual", lote, ["conta"])
+
+    return len(alterados), len(candidatos) - len(alterados), list(candidatos)
+
+
 @app.route("/webhook/performance", methods=["POST"])
+@pipeline("PERFORMANCE")
 def webhook_performance():
     if not validar_token(request):
         return jsonify({"erro": "Acesso negado"}), 403
@@ -1873,55 +4745,42 @@ def webhook_performance():
                           f"URL bloqueada por política SSRF: {url_download}")
             return jsonify({"erro": "URL não autorizada"}), 400
 
-        r = requests.get(url_download, stream=True)
+        r = baixar(url_download, stream=True)
         r.raise_for_status()
 
-        arquivos_salvos = 0
-        conn_db = pyodbc.connect(CONN_STR)
-        cursor  = conn_db.cursor()
-
-        with zipfile.ZipFile(io.BytesIO(r.content)) as z:
-            for nome_arquivo in z.namelist():
-                if not nome_arquivo.lower().endswith(".pdf"):
-                    continue
-
-                conta_final = (
-                    conta_id if conta_id != "Desconhecida"
-                    else extrair_conta_do_nome(nome_arquivo)
+        with tempfile.SpooledTemporaryFile(max_size=PERFORMANCE_ZIP_MEMORIA_MAX) as zip_tmp:
+            with etapa("download_corpo") as e:
+                for bloco in r.iter_content(chunk_size=1024 * 1024):
+                    zip_tmp.write(bloco)
+                e.bytes = zip_tmp.tell()
+            contar_bytes_baixados(url_download, e.bytes)
+            zip_tmp.seek(0)
+
+            with zipfile.ZipFile(zip_tmp) as z:
+                atualizados, ignorados, contas = _gravar_relatorios_performance(
+                    z, conta_id, data_ref
                 )
-                pdf_bytes = z.read(nome_arquivo)
-
-                cursor.execute("""
-                    MERGE dbo.relatorios_performance_atual AS Target
-                    USING (SELECT ? AS ContaVal) AS Source
-                        ON Target.conta = Source.ContaVal
-                    WHEN MATCHED THEN
-                        UPDATE SET
-                            arquivo_pdf     = ?,
-                            nome_arquivo    = ?,
-                            data_referencia = ?,
-                            data_upload     = GETDATE()
-                    WHEN NOT MATCHED THEN
-                        INSERT (conta, arquivo_pdf, nome_arquivo, data_referencia, data_upload)
-                        VALUES (?, ?, ?, ?, GETDATE());
-                """, (conta_final, pdf_bytes, nome_arquivo, data_ref,
-                      conta_final, pdf_bytes, nome_arquivo, data_ref))
-                arquivos_salvos += 1
-
-        conn_db.commit()
-        conn_db.close()
+
+        marcar_performance_entregue(contas, data_ref)
 
         print(
             f"[SUCESSO PERFORMANCE] Conta: {conta_id} | "
-            f"Salvos: {arquivos_salvos} | Ref: {data_ref} | ID: {req_id}"
+            f"Atualizados: {atualizados} | Sem mudança: {ignorados} | "
+            f"Ref: {data_ref} | ID: {req_id}"
         )
-        return jsonify({"status": "Processado", "conta": conta_id}), 200
+        return jsonify({
+            "status":      "Processado",
+            "conta":       conta_id,
+            "atualizados": atualizados,
+            "ignorados":   ignorados,
+        }), 200
 
     except Exception as e:
         return erro_interno("PERFORMANCE", e, conta=conta_id)
 
 
 @app.route("/webhook/custodia", methods=["POST"])
+@pipeline("CUSTODIA")
 def webhook_custodia():
     if not validar_token(request):
         return jsonify({"erro": "Acesso negado"}), 403
@@ -1937,38 +4796,81 @@ def webhook_custodia():
                           f"URL bloqueada por política SSRF: {url_download}")
             return jsonify({"erro": "URL não autorizada"}), 400
 
-        r = requests.get(url_download)
+        r = baixar(url_download)
         r.raise_for_status()
 
+        # Backup raw: o próprio ZIP recebido
+        arquivar_raw("custodia", r.content)
+
+        # Leitura em blocos: cada bloco é gravado antes do próximo ser lido.
+        # O primeiro bloco recria a tabela (replace); todos na mesma transação
+        # — uma falha no meio desfaz a carga e a tabela anterior fica intacta.
+        linhas     = 0
+        data_carga = now_brasilia()
+        engine     = get_engine()
+
         with zipfile.ZipFile(io.BytesIO(r.content)) as z:
             nome_csv = z.namelist()[0]
-            with z.open(nome_csv) as f:
-                df = pd.read_csv(f, sep=",", encoding="latin1", low_memory=False)
+            with etapa("tipos_custodia"):
+                colunas, tipos = _tipos_custodia(z, nome_csv)
 
-        df_raw = df.copy()
-        df_raw["data_recebimento_webhook"] = now_brasilia()
-        salvar_df_otimizado(df_raw, "backup_custodia_raw", if_exists="replace")
-
-        df_final = df.copy()
-        for col in ["referenceDate", "dataInicio", "fixingDate", "dataKnockIn"]:
-            if col in df_final.columns:
-                df_final[col] = pd.to_datetime(
-                    df_final[col], format="%d/%m/%Y", errors="coerce"
+            # Só cabeçalho: o replace nunca aconteceria e a tabela anterior
+            # ficaria como se fosse a carga do dia
+            with z.open(nome_csv) as f:
+                sem_linhas = pd.read_csv(f, sep=",", encoding="latin1",
+                                         usecols=colunas, nrows=1).empty
+            if sem_linhas:
+                msg = "CSV de custódia sem linhas — relatorios_custodia mantida"
+                registrar_log("CUSTODIA", "Erro", 0, msg)
+                return jsonify({"erro": msg}), 400
+
+            with engine.begin() as conn, z.open(nome_csv) as f:
+                travar_tabela(conn, "relatorios_custodia")
+                leitor = pd.read_csv(
+                    f, sep=",", encoding="latin1",
+                    usecols=colunas,
+                    dtype={c: str for c in colunas},
+                    chunksize=CUSTODIA_LINHAS_BLOCO,
                 )
-
-        df_final["data_upload"] = now_brasilia()
-        salvar_df_otimizado(df_final, "relatorios_custodia", if_exists="replace")
-
-        msg = f"Importação Custódia concluída. Linhas: {len(df_final)}"
+                for i, bloco in enumerate(leitor):
+                    modo = "replace" if i == 0 else "append"
+
+                    with etapa("tipagem_bloco", linhas=len(bloco)):
+                        # Sem coerce: valor não numérico numa coluna declarada
+                        # numérica derruba a carga em vez de virar NaN
+                        for col, tipo in tipos.items():
+                            bloco[col] = pd.to_numeric(bloco[col]).astype(tipo)
+
+                        for col in COLUNAS_DATA_CUSTODIA:
+                            if col in bloco.columns:
+                                bloco[col] = pd.to_datetime(
+                                    bloco[col], format="%d/%m/%Y", errors="coerce"
+                                )
+
+                    bloco["data_upload"] = data_carga
+                    with etapa("gravar:relatorios_custodia", linhas=len(bloco)):
+                        bloco.to_sql(
+                            name="relatorios_custodia",
+                            con=conn,
+                            schema="dbo",
+                            if_exists=modo,
+                            index=False,
+                            chunksize=_chunksize_seguro(bloco),
+                            method="multi"
+                        )
+                    linhas += len(bloco)
+
+        msg = f"Importação Custódia concluída. Linhas: {linhas}"
         print(f"[SUCESSO CUSTODIA] {msg}", flush=True)
-        registrar_log("CUSTODIA", "Sucesso", len(df_final), msg)
-        return jsonify({"status": "Sucesso", "linhas": len(df_final)}), 200
+        registrar_log("CUSTODIA", "Sucesso", linhas, msg)
+        return jsonify({"status": "Sucesso", "linhas": linhas}), 200
 
     except Exception as e:
         return erro_interno("CUSTODIA", e)
 
 
 @app.route("/webhook/posicao", methods=["POST"])
+@pipeline("POSICAO_WEBHOOK")
 def webhook_posicao():
     """
     Recebe URL do ZIP de posições via webhook BTG (positions-by-partner).
@@ -1994,39 +4896,25 @@ def webhook_posicao():
             return jsonify({"erro": "URL nao autorizada"}), 400
 
         # Baixa ZIP e faz parse dos JSONs (1 por conta)
-        r_zip = requests.get(url_zip, timeout=120)
+        r_zip = baixar(url_zip, timeout=120)
         r_zip.raise_for_status()
 
-        df = _parse_posicao_zip(r_zip.content)
+        with etapa("parse_zip", bytes=len(r_zip.content)) as e:
+            df = _parse_posicao_zip(r_zip.content)
+            e.linhas = len(df)
 
         if df.empty:
             registrar_log(atividade, "Erro", 0, "ZIP sem posicoes parseáveis")
             return jsonify({"erro": "ZIP invalido"}), 400
 
-        # Adiciona Assessor via base_btg
-        engine = get_engine()
-        with engine.connect() as conn:
-            base_ref = pd.read_sql(
-                "SELECT Conta, Assessor FROM dbo.base_btg", conn
-            )
-        base_ref["Conta"] = base_ref["Conta"].astype(str)
+        # Adiciona Assessor via base_btg (cache de referência)
         if "Conta" in df.columns:
-            df["Conta"] = df["Conta"].astype(str)
-            df = df.merge(base_ref, on="Conta", how="left")
+            df["Conta"]    = df["Conta"].astype(str)
+            df["Assessor"] = df["Conta"].map(obter_referencia("base_btg")["assessor"])
 
-        # Adiciona Setor e Subsetor via setores.xlsx
-        try:
-            setores = pd.read_excel(r"C:\Scripts\setores_ativos\setores.xlsx")
-            for col_match in ["Ativo", "Emissor"]:
-                if col_match in df.columns and col_match in setores.columns:
-                    df = df.merge(
-                        setores[[col_match, "Setor", "Subsetor"]]
-                        .drop_duplicates(col_match),
-                        on=col_match, how="left"
-                    )
-                    break
-        except Exception as e_set:
-            print(f"[POSICAO] Aviso: nao foi possivel carregar setores — {e_set}")
+        # Adiciona Setor e Subsetor (cache de setores_ativos)
+        with etapa("setores", linhas=len(df)):
+            df = adicionar_setores(df)
 
         salvar_df_otimizado(df, "posicao", if_exists="replace")
 
@@ -2040,6 +4928,7 @@ def webhook_posicao():
 
 
 @app.route("/webhook/offshore", methods=["POST"])
+@pipeline("OFFSHORE_NNM")
 def webhook_offshore():
     """
     Recebe o arquivo AuC Offshore.xlsx via multipart/form-data.
@@ -2054,7 +4943,9 @@ def webhook_offshore():
 
     arquivo = request.files["file"]
     try:
-        df_offshore = pd.read_excel(arquivo, sheet_name="NNM Offshore")
+        with etapa("parse_excel") as e:
+            df_offshore = pd.read_excel(arquivo, sheet_name="NNM Offshore")
+            e.linhas = len(df_offshore)
 
         renomear = {
             "Data NNM": "data_captacao",
@@ -2075,18 +4966,11 @@ def webhook_offshore():
 
         df_offshore.dropna(subset=["data_captacao", "nr_conta"], inplace=True)
 
-        # Assessor via auc_offshore
-        engine = get_engine()
+        # Assessor via auc_offshore (cache de referência)
         try:
-            with engine.connect() as conn:
-                auc = pd.read_sql(
-                    "SELECT Conta, Assessor FROM dbo.auc_offshore", conn
-                )
-            auc["Conta"] = auc["Conta"].astype(str).str.strip()
-            df_offshore = df_offshore.merge(
-                auc, left_on="nr_conta", right_on="Conta", how="left"
+            df_offshore["Assessor"] = df_offshore["nr_conta"].map(
+                obter_referencia("auc_offshore")
             )
-            df_offshore.drop(columns=["Conta"], errors="ignore", inplace=True)
         except Exception as e:
             print(f"[AVISO OFFSHORE] auc_offshore não carregada: {e}")
 
@@ -2099,6 +4983,110 @@ def webhook_offshore():
     except Exception as e:
         return erro_interno("OFFSHORE_NNM", e)
 
+# 7b. CONSULTA DE RELATÓRIOS
+
+def _versao_pdf_performance(conta: str, data_upload: datetime) -> str:
+    """ETag do PDF: muda sempre que o webhook regrava a conta (data_upload)."""
+    base = f"{conta}|{pd.Timestamp(data_upload).isoformat()}"
+    return hashlib.sha1(base.encode()).hexdigest()
+
+
+def _blocos_pdf_performance(conta: str, hash_pdf: Optional[str], tamanho: int):
+    """
+    Gera o PDF em blocos de PERFORMANCE_BLOCO_DOWNLOAD lidos com SUBSTRING,
+    sem trazer o blob inteiro para a memória. Se o PDF for regravado no meio
+    do download (hash_conteudo mudou), interrompe — o cliente vê o corte pelo
+    Content-Length.
+    """
+    params = {"conta": conta, "n": PERFORMANCE_BLOCO_DOWNLOAD}
+    with get_engine().connect() as conn:
+        sql = f"""
+            SELECT {funcao_sql(conn, "fatia_blob")}(arquivo_pdf, :inicio, :n)
+            FROM dbo.relatorios_performance_atual
+            WHERE conta = :conta
+        """
+        if hash_pdf:
+            sql += " AND hash_conteudo = :hash_pdf"
+            params["hash_pdf"] = hash_pdf
+
+        for inicio in range(1, tamanho + 1, PERFORMANCE_BLOCO_DOWNLOAD):
+            bloco = conn.execute(text(sql), {**params, "inicio": inicio}).scalar()
+            if not bloco:
+                print(f"[AVISO PERFORMANCE] PDF da conta {conta} mudou durante o download", flush=True)
+                return
+            yield bytes(bloco)
+
+
+@app.route("/relatorios/performance/<conta>", methods=["GET"])
+def baixar_relatorio_performance(conta):
+    """
+    Devolve o PDF de performance atual da conta em streaming.
+    ETag/Last-Modified vêm de data_upload; If-None-Match/If-Modified-Since
+    respondem 304 sem ler o blob.
+    """
+    if not validar_token(request):
+        return jsonify({"erro": "Acesso negado"}), 403
+
+    try:
+        with get_engine().begin() as conn:
+            _garantir_hash_performance(conn)
+            meta = conn.execute(text(f"""
+                SELECT nome_arquivo, data_upload, hash_conteudo,
+                       {funcao_sql(conn, "tamanho_blob")}(arquivo_pdf) AS tamanho
+                FROM dbo.relatorios_performance_atual
+                WHERE conta = :conta
+            """), {"conta": conta}).first()
+
+        if meta is None or not meta.tamanho:
+            return jsonify({"erro": "Relatório não encontrado", "conta": conta}), 404
+
+        etag        = _versao_pdf_performance(conta, meta.data_upload)
+        # data_upload vem de now_brasilia() (naive, UTC-3); http_date trata
+        # naive como UTC — converte antes
+        modificado  = (
+            pd.Timestamp(meta.data_upload).to_pydatetime()
+            .replace(microsecond=0, tzinfo=UTC_BRASILIA)
+            .astimezone(timezone.utc)
+        )
+        cabecalhos  = {
+            "ETag":          f'"{etag}"',
+            "Last-Modified": http_date(modificado),
+            "Cache-Control": "private, no-cache",
+        }
+
+        # If-None-Match prevalece sobre If-Modified-Since (RFC 9110)
+        if request.if_none_match:
+            nao_mudou = request.if_none_match.contains(etag)
+        elif request.if_modified_since:
+            desde = request.if_modified_since
+            if desde.tzinfo is None:
+                desde = desde.replace(tzinfo=timezone.utc)
+            nao_mudou = modificado <= desde
+        else:
+            nao_mudou = False
+
+        if nao_mudou:
+            return Response(status=304, headers=cabecalhos)
+
+        nome = os.path.basename(meta.nome_arquivo or f"performance_{conta}.pdf")
+        # filename ASCII sem aspas/controle como fallback + filename* (RFC 6266)
+        nome_ascii = re.sub(r'[\x00-\x1f\x7f"\\]', "_",
+                            nome.encode("ascii", "replace").decode("ascii"))
+        cabecalhos["Content-Length"]      = str(meta.tamanho)
+        cabecalhos["Content-Disposition"] = (
+            f'inline; filename="{nome_ascii}"; filename*=UTF-8\'\'{quote(nome, safe="")}'
+        )
+
+        return Response(
+            _blocos_pdf_performance(conta, meta.hash_conteudo, int(meta.tamanho)),
+            mimetype="application/pdf",
+            headers=cabecalhos,
+        )
+
+    except Exception as e:
+        return erro_interno("DOWNLOAD_PERFORMANCE", e, conta=conta)
+
+
 # 8. ADMIN — uploads manuais pontuais
 
 @app.route("/admin/times", methods=["POST"])
@@ -2128,6 +5116,7 @@ def upload_times():
             df, "times_nova_empresa",
             col_pk="Assessor", if_exists="replace"
         )
+        invalidar_referencia("times_nova_empresa")
 
         registrar_log("UPLOAD_TIMES", "Sucesso", len(df),
                       f"{len(df)} assessores carregados")
@@ -2176,6 +5165,7 @@ def upload_offshore():
             auc_offshore, "auc_offshore",
             col_pk="Conta", if_exists="replace"
         )
+        invalidar_referencia("pl_offshore", "auc_offshore")
 
         registrar_log("UPLOAD_OFFSHORE", "Sucesso", len(df),
                       f"{len(df)} contas offshore carregadas")
@@ -2184,15 +5174,456 @@ def upload_offshore():
     except Exception as e:
         return erro_interno("UPLOAD_OFFSHORE", e)
 
+
+@app.route("/admin/correcoes-assessor", methods=["POST"])
+def upload_correcoes_assessor():
+    """
+    Substitui as correções de assessor da tabela correcoes_assessor a partir de
+    um xlsx com colunas Tipo ('nome' ou 'conta'), Chave e Valor.
+    As correções fixas do código continuam valendo; a tabela prevalece.
+    """
+    if not validar_token(request):
+        return jsonify({"erro": "Acesso negado"}), 403
+
+    if "file" not in request.files:
+        return jsonify({"erro": "Nenhum arquivo enviado"}), 400
+
+    try:
+        df = pd.read_excel(request.files["file"], dtype=str)
+
+        colunas_esperadas = ["Tipo", "Chave", "Valor"]
+        faltando = [c for c in colunas_esperadas if c not in df.columns]
+        if faltando:
+            return jsonify({"erro": f"Colunas esperadas ausentes: {faltando}"}), 400
+
+        df = df.dropna(subset=colunas_esperadas)
+        df["Tipo"]  = df["Tipo"].str.lower().str.strip()
+        df["Chave"] = df["Chave"].str.strip()
+        df["Valor"] = df["Valor"].str.upper().str.strip()
+
+        invalidos = sorted(set(df["Tipo"]) - {"nome", "conta"})
+        if invalidos:
+            return jsonify({"erro": f"Tipo inválido: {invalidos}"}), 400
+
+        df.loc[df["Tipo"] == "nome", "Chave"] = \
+            df.loc[df["Tipo"] == "nome", "Chave"].map(_normalizar_nome_assessor)
+        df = df.drop_duplicates(subset=["Tipo", "Chave"], keep="last")
+
+        garantir_tabela(TABELA_CORRECOES_ASSESSOR)
+        with get_engine().begin() as conn:
+            conn.execute(TABELA_CORRECOES_ASSESSOR.delete())
+            if not df.empty:
+                conn.execute(
+                    TABELA_CORRECOES_ASSESSOR.insert(),
+                    [{"tipo": t, "chave": c, "valor": v}
+                     for t, c, v in df[colunas_esperadas].itertuples(index=False)]
+                )
+        invalidar_referencia("correcoes_assessor")
+
+        registrar_log("UPLOAD_CORRECOES_ASSESSOR", "Sucesso", len(df),
+                      f"{len(df)} correções carregadas")
+        return jsonify({"status": "Sucesso", "linhas": len(df)}), 200
+
+    except Exception as e:
+        return erro_interno("UPLOAD_CORRECOES_ASSESSOR", e)
+
+
+@app.route("/admin/setores", methods=["POST"])
+def upload_setores():
+    """
+    Atualiza setores_ativos a partir do setores.xlsx (Ativo e/ou Emissor,
+    Setor, Subsetor). Alimenta Setor/Subsetor da posição.
+    """
+    if not validar_token(request):
+        return jsonify({"erro": "Acesso negado"}), 403
+
+    if "file" not in request.files:
+        return jsonify({"erro": "Nenhum arquivo enviado"}), 400
+
+    try:
+        df = pd.read_excel(request.files["file"])
+        df.columns = [str(c).strip() for c in df.columns]
+
+        faltando = [c for c in ["Setor", "Subsetor"] if c not in df.columns]
+        if faltando or not any(c in df.columns for c in COLUNAS_MATCH_SETOR):
+            return jsonify({
+                "erro": f"Colunas esperadas: Setor, Subsetor e uma de {COLUNAS_MATCH_SETOR}"
+            }), 400
+
+        colunas = [c for c in COLUNAS_MATCH_SETOR if c in df.columns] + ["Setor", "Subsetor"]
+        df = df[colunas].copy()
+        for col_match in COLUNAS_MATCH_SETOR:
+            if col_match in df.columns:
+                df[col_match] = df[col_match].astype("string").str.strip()
+
+        salvar_df_otimizado(df, "setores_ativos", if_exists="replace")
+        invalidar_referencia("setores_ativos")
+
+        registrar_log("UPLOAD_SETORES", "Sucesso", len(df),
+                      f"{len(df)} setores carregados")
+        return jsonify({"status": "Sucesso", "linhas": len(df)}), 200
+
+    except Exception as e:
+        return erro_interno("UPLOAD_SETORES", e)
+
+
+@app.route("/admin/particoes", methods=["GET", "POST"])
+def admin_particoes():
+    """
+    Layout particionado por mês + columnstore dos históricos (SQL Server).
+    GET: estado por tabela e, se particionada, linhas/rowgroups/delta por partição.
+    POST ?acao=migrar — converte as tabelas (pesado; roda em background)
+    POST ?acao=manutencao — partições dos próximos meses + REORGANIZE dos
+    deltas (agendar mensalmente; a carga diária também cria as que faltarem).
+    POST só com PARTICIONAMENTO_MSSQL=1.
+    """
+    if not validar_token(request):
+        return jsonify({"erro": "Acesso negado"}), 403
+    if get_engine().dialect.name != "mssql":
+        return jsonify({"erro": "particionamento só existe no SQL Server"}), 400
+    if request.method == "POST" and not PARTICIONAMENTO_ATIVO:
+        return jsonify({"erro": "particionamento desligado (PARTICIONAMENTO_MSSQL=1 para ativar)"}), 409
+
+    try:
+        if request.method == "GET":
+            return jsonify(json.loads(json.dumps(status_particoes(), default=str))), 200
+
+        acao = request.args.get("acao")
+        if acao == "migrar":
+            tabelas = request.args.get("tabela", ",".join(TABELAS_PARTICIONADAS)).split(",")
+            if not set(tabelas) <= set(TABELAS_PARTICIONADAS):
+                return jsonify({"erro": "tabela inválida", "tabelas": list(TABELAS_PARTICIONADAS)}), 400
+            job_id = iniciar_job("PARTICOES_MIGRAR",
+                                 lambda: {t: migrar_para_particionado(t) for t in tabelas})
+        elif acao == "manutencao":
+            job_id = iniciar_job("PARTICOES_MANUTENCAO", manutencao_particoes)
+        else:
+            return jsonify({"erro": "acao deve ser migrar ou manutencao"}), 400
+        return jsonify({"status": "iniciado", "job_id": job_id,
+                        "acompanhar": f"/trigger/jobs/{job_id}"}), 202
+
+    except Exception as e:
+        return erro_interno("PARTICOES", e)
+
+
+@app.route("/admin/cache", methods=["GET"])
+def status_cache():
+    """Hits, misses, invalidações, versão e idade de cada conjunto em cache neste worker."""
+    if not validar_token(request):
+        return jsonify({"erro": "Acesso negado"}), 403
+    return jsonify({"pid": os.getpid(), "referencias": metricas_referencia()}), 200
+
+
+@app.route("/admin/metricas", methods=["GET"])
+def status_metricas():
+    """
+    Percentis de duração por pipeline/etapa nos últimos ?dias= (padrão 7),
+    com volume médio de linhas e bytes. Filtro opcional: ?pipeline=BASE_BTG.
+    """
+    if not validar_token(request):
+        return jsonify({"erro": "Acesso negado"}), 403
+
+    try:
+        dias = int(request.args.get("dias", 7))
+    except ValueError:
+        return jsonify({"erro": "dias deve ser inteiro"}), 400
+
+    try:
+        t = TABELA_METRICAS_ETAPA
+        garantir_tabela(t)
+        consulta = t.select().with_only_columns(
+            t.c.pipeline, t.c.etapa, t.c.duracao_ms, t.c.linhas, t.c.bytes, t.c.status,
+            t.c.mem_pico_mb, t.c.rss_mb,
+        ).where(t.c.inicio >= now_brasilia() - timedelta(days=dias))
+        if request.args.get("pipeline"):
+            consulta = consulta.where(t.c.pipeline == request.args["pipeline"])
+
+        with get_engine().connect() as conn:
+            df = pd.read_sql(consulta, conn)
+
+        if df.empty:
+            return jsonify({"dias": dias, "etapas": []}), 200
+
+        df["erro"] = df["status"] == "erro"
+        agregado = df.groupby(["pipeline", "etapa"], sort=True).agg(
+            execucoes=("duracao_ms", "size"),
+            erros=("erro", "sum"),
+            p50_ms=("duracao_ms", lambda x: x.quantile(0.50)),
+            p90_ms=("duracao_ms", lambda x: x.quantile(0.90)),
+            p99_ms=("duracao_ms", lambda x: x.quantile(0.99)),
+            max_ms=("duracao_ms", "max"),
+            linhas_media=("linhas", "mean"),
+            bytes_media=("bytes", "mean"),
+            mem_pico_max_mb=("mem_pico_mb", "max"),
+            rss_max_mb=("rss_mb", "max"),
+        ).reset_index()
+
+        agregado = agregado.round(1).astype(object).where(agregado.notna(), None)
+        return jsonify({"dias": dias, "etapas": agregado.to_dict(orient="records")}), 200
+
+    except Exception as e:
+        return erro_interno("METRICAS", e)
+
+
+@app.route("/admin/snapshot-base", methods=["GET"])
+def consultar_snapshot_base():
+    """
+    Snapshot da base em ?data=AAAA-MM-DD (padrão: hoje), no modo diário ou
+    SCD2 (recomposto da vw_base_btg_snapshot_scd). Filtro opcional: ?conta=.
+    """
+    if not validar_token(request):
+        return jsonify({"erro": "Acesso negado"}), 403
+
+    try:
+        dia = pd.Timestamp(request.args.get("data") or now_brasilia().date())
+    except ValueError:
+        return jsonify({"erro": "data deve ser AAAA-MM-DD"}), 400
+
+    try:
+        df = ler_snapshot_base(dia)
+        if request.args.get("conta"):
+            df = df[df["Conta"].astype(str).str.strip() == request.args["conta"].strip()]
+        df = df.astype(object).where(df.notna(), None)
+        resposta = {"data": f"{dia:%Y-%m-%d}", "contas": len(df),
+                    "snapshot": df.to_dict(orient="records")}
+        return jsonify(json.loads(json.dumps(resposta, default=str))), 200
+
+    except Exception as e:
+        return erro_interno("SNAPSHOT_BASE", e)
+
+
+@app.route("/admin/sql", methods=["GET", "DELETE"])
+def status_sql():
+    """
+    Perfil de SQL deste worker desde o último reset: comandos normalizados
+    por pipeline/etapa com execuções, tempo total/médio/máximo, linhas
+    afetadas e tamanho de lote, mais os últimos comandos lentos.
+    ?ordem=total_s|max_s|execucoes|linhas, ?limite=50, ?pipeline=NNM.
+    DELETE zera o perfil.
+    """
+    if not validar_token(request):
+        return jsonify({"erro": "Acesso negado"}), 403
+
+    if request.method == "DELETE":
+        _perfil_sql.zerar()
+        return jsonify({"pid": os.getpid(), "status": "zerado"}), 200
+
+    ordem = request.args.get("ordem", "total_s")
+    if ordem not in ("total_s", "max_s", "execucoes", "linhas", "lote"):
+        return jsonify({"erro": "ordem inválida"}), 400
+    try:
+        limite = int(request.args.get("limite", 50))
+    except ValueError:
+        return jsonify({"erro": "limite deve ser inteiro"}), 400
+
+    return jsonify({
+        "pid":    os.getpid(),
+        "ativo":  SQL_PERFIL,
+        **_perfil_sql.resumo(ordem, limite, request.args.get("pipeline")),
+    }), 200
+
+# Pipelines que /admin/perfil consegue rodar na hora: jobs sem argumento e
+# webhooks (reprocessados com o `payload` informado, como se viesse do BTG)
+JOBS_PERFIL = {
+    "POSICAO":         _executar_posicao,
+    "ENTRADAS_SAIDAS": _executar_entradas_saidas,
+    "CALCULO_SAIDAS":  _executar_calculo_saidas,
+    "PREVIA_RECEITA":  _executar_previa_receita,
+}
+WEBHOOKS_PERFIL = {
+    "BASE_BTG":        ("/webhook/basebtg", webhook_base_btg),
+    "NNM":             ("/webhook/nnm",     webhook_nnm),
+    "CUSTODIA":        ("/webhook/custodia", webhook_custodia),
+    "POSICAO_WEBHOOK": ("/webhook/posicao", webhook_posicao),
+}
+RE_ID_PERFIL = re.compile(r"^[\w-]+$")
+
+
+def _rodar_com_perfil(pedido: dict, alvo, payload: Optional[dict] = None):
+    _perfil_pedido.set(pedido)
+    if pedido["pipeline"] in JOBS_PERFIL:
+        alvo()
+        return
+    rota, view = alvo
+    with app.test_request_context(rota, method="POST", json=payload,
+                                  headers={"X-Webhook-Token": WEBHOOK_TOKEN or ""}):
+        view()
+
+
+@app.route("/admin/perfil", methods=["GET", "POST"])
+def perfil_pipeline():
+    """
+    POST: pede o profiling de um pipeline (JSON ou query string).
+      pipeline      nome do @pipeline (ex.: BASE_BTG, POSICAO)
+      modo          amostragem (padrão) | cprofile
+      quando        proxima (padrão — a próxima execução em qualquer worker)
+                    | agora (jobs; webhooks exigem `payload` com o corpo do BTG)
+      intervalo_ms  período de amostragem (padrão PERFIL_INTERVALO_MS)
+    GET: perfis gravados e pedidos pendentes.
+    """
+    if not validar_token(request):
+        return jsonify({"erro": "Acesso negado"}), 403
+
+    if request.method == "GET":
+        perfis = []
+        if os.path.isdir(PERFIL_DIR):
+            for arquivo in sorted(os.listdir(PERFIL_DIR), reverse=True):
+                if not arquivo.endswith(".json"):
+                    continue
+                with contextlib.suppress(OSError, ValueError):
+                    with open(_caminho_perfil(arquivo), encoding="utf-8") as f:
+                        meta = json.load(f)
+                    meta.pop("top", None)
+                    perfis.append(meta)
+        return jsonify({"perfis": perfis, "pendentes": perfis_pendentes()}), 200
+
+    dados = request.get_json(silent=True) or {}
+    param = lambda chave, padrao=None: dados.get(chave, request.args.get(chave, padrao))
+
+    nome = str(param("pipeline", "")).upper()
+    if nome not in PIPELINES_REGISTRADOS:
+        return jsonify({"erro": "pipeline inválido",
+                        "pipelines": sorted(PIPELINES_REGISTRADOS)}), 400
+    modo = param("modo", "amostragem")
+    if modo not in ("amostragem", "cprofile"):
+        return jsonify({"erro": "modo deve ser amostragem ou cprofile"}), 400
+    try:
+        intervalo_ms = max(1.0, float(param("intervalo_ms", PERFIL_INTERVALO_MS)))
+    except (TypeError, ValueError):
+        return jsonify({"erro": "intervalo_ms deve ser numérico"}), 400
+
+    try:
+        pedido = novo_pedido_perfil(nome, modo, intervalo_ms)
+        quando = param("quando", "proxima")
+        if quando == "proxima":
+            marcar_proxima_execucao(pedido)
+            return jsonify({"status": "marcado", **pedido}), 202
+        if quando != "agora":
+            return jsonify({"erro": "quando deve ser proxima ou agora"}), 400
+
+        payload = param("payload")
+        alvo = JOBS_PERFIL.get(nome) or WEBHOOKS_PERFIL.get(nome)
+        if alvo is None:
+            return jsonify({"erro": f"{nome} só pode ser perfilado com quando=proxima"}), 400
+        if nome in WEBHOOKS_PERFIL and not isinstance(payload, dict):
+            return jsonify({"erro": "webhook exige payload (corpo JSON enviado pelo BTG)"}), 400
+        if _perfil_lock.locked():
+            return jsonify({"erro": "já há um perfil em andamento neste worker"}), 409
+
+        threading.Thread(target=_rodar_com_perfil, args=(pedido, alvo, payload),
+                         daemon=True).start()
+        return jsonify({"status": "iniciado", **pedido}), 202
+
+    except Exception as e:
+        return erro_interno("PERFIL", e)
+
+
+@app.route("/admin/perfil/<perfil_id>", methods=["GET"])
+def resumo_perfil(perfil_id):
+    """Metadados e top-N (?top=, padrão PERFIL_TOP) das funções mais quentes."""
+    if not validar_token(request):
+        return jsonify({"erro": "Acesso negado"}), 403
+    if not RE_ID_PERFIL.match(perfil_id):
+        return jsonify({"erro": "id inválido"}), 400
+    try:
+        top = int(request.args.get("top", PERFIL_TOP))
+    except ValueError:
+        return jsonify({"erro": "top deve ser inteiro"}), 400
+
+    caminho = _caminho_perfil(f"{perfil_id}.json")
+    if not os.path.exists(caminho):
+        return jsonify({"erro": "perfil não encontrado"}), 404
+    with open(caminho, encoding="utf-8") as f:
+        meta = json.load(f)
+    meta["top"] = meta.get("top", [])[:top]
+    return jsonify(meta), 200
+
+
+@app.route("/admin/perfil/<perfil_id>/<formato>", methods=["GET"])
+def artefato_perfil(perfil_id, formato):
+    """collapsed — pilhas no formato do flamegraph.pl/speedscope; pstats — dump do cProfile."""
+    if not validar_token(request):
+        return jsonify({"erro": "Acesso negado"}), 403
+    extensoes = {"collapsed": (".collapsed", "text/plain"),
+                 "pstats":    (".prof", "application/octet-stream")}
+    if not RE_ID_PERFIL.match(perfil_id) or formato not in extensoes:
+        return jsonify({"erro": "id ou formato inválido"}), 400
+
+    extensao, mimetype = extensoes[formato]
+    caminho = _caminho_perfil(perfil_id + extensao)
+    if not os.path.exists(caminho):
+        return jsonify({"erro": f"perfil sem artefato {formato}"}), 404
+    with open(caminho, "rb") as f:
+        conteudo = f.read()
+    return Response(conteudo, mimetype=mimetype, headers={
+        "Content-Disposition": f'attachment; filename="{perfil_id}{extensao}"'
+    })
+
 # 9. UTILITÁRIOS
 
+@app.before_request
+def _iniciar_cronometro_http():
+    g.inicio_requisicao = time.perf_counter()
+
+
+@app.after_request
+def _medir_requisicao_http(resposta):
+    if BOOT["primeira_resposta_s"] is None:
+        BOOT["primeira_resposta_s"] = round(time.time() - BOOT["inicio"], 3)
+        print(
+            f"[BOOT] pid {os.getpid()} primeira resposta ({request.method} {request.path}) "
+            f"{BOOT['primeira_resposta_s']:.2f}s após a partida do processo",
+            flush=True
+        )
+    inicio = g.get("inicio_requisicao")
+    if inicio is not None and request.path.startswith(PREFIXOS_ROTAS_MEDIDAS):
+        rota = request.url_rule.rule if request.url_rule else "desconhecida"
+        METRICA_HTTP.labels(
+            rota=rota, metodo=request.method, status=str(resposta.status_code)
+        ).observe(time.perf_counter() - inicio)
+    return resposta
+
+
+@app.route("/metrics", methods=["GET"])
+def metricas_prometheus():
+    """
+    Exposição Prometheus. Sob gunicorn (PROMETHEUS_MULTIPROC_DIR definido)
+    agrega as métricas de todos os workers. O scrape deve enviar X-Api-Key.
+    """
+    if not validar_token(request):
+        return jsonify({"erro": "Acesso negado"}), 403
+
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registro = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registro)
+    else:
+        registro = REGISTRY
+    return Response(generate_latest(registro), mimetype=CONTENT_TYPE_LATEST)
+
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """
+    Liveness para o health check do Render e para acordar a instância —
+    não toca banco nem BTG. Inclui os tempos de partida deste worker.
+    """
+    return jsonify({
+        "status":   "ok",
+        "pid":      os.getpid(),
+        "uptime_s": round(time.time() - BOOT["inicio"], 1),
+        "boot":     {k: BOOT[k] for k in ("importacao_s", "primeira_resposta_s", "aquecimento")},
+    }), 200
+
+
 @app.route("/meu-ip", methods=["GET"])
 def get_ip():
     try:
-        return jsonify({"ip_render": requests.get("https://api.ipify.org").text})
+        return jsonify({"ip_render": requisitar("GET", "https://api.ipify.org").text})
     except Exception:
         return jsonify({"erro": "Falha ao obter IP"}), 500
 
+BOOT["importacao_s"] = round(time.time() - BOOT["inicio"], 3)
+
 # 10. ENTRYPOINT
 
 if __name__ == "__main__":
@@ -0,0 +1,17 @@
+"""
+Benchmarks dos pipelines do app.py.
+
+Rodar a partir da raiz do repositório, por exemplo:
+    python -m benchmarks.bench_debitos_nnm
+
+Suite completa (arquivos sintéticos de benchmarks.geradores, SQLite local)
+e comparação entre commits:
+    python -m benchmarks.executar --tamanhos 1000 10000 100000 --saida novo.json
+    python -m benchmarks.comparar base.json novo.json
+
+Teste de carga sob gunicorn, com simuladores locais do BTG e do S3:
+    python -m benchmarks.carga --contas 1000 --duracao 60 --concorrencia 8
+
+Partida a frio (tempo até a primeira resposta, com e sem preload):
+    python -m benchmarks.partida --repeticoes 5 --aquecer
+"""
@@ -0,0 +1,85 @@
+"""
+Banco SQLite local que faz o papel do SQL Server nos benchmarks.
+
+É o mesmo backend do app com BANCO_BACKEND=sqlite: o arquivo é anexado
+como schema "dbo", então o SQL do app.py (dbo.tabela, [coluna com espaço])
+roda sem alteração.
+"""
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import app
+from benchmarks.geradores import ASSESSORES, EMISSORES, TICKERS, DATA_REFERENCIA, contas_sinteticas
+
+
+def criar_engine_sqlite(diretorio: str = None):
+    return app.criar_engine_sqlite(diretorio or tempfile.mkdtemp(prefix="bench_btg_"))
+
+
+def popular_referencias(engine, n_contas: int, seed: int = 11):
+    """
+    Cria as tabelas de referência e histórico que os pipelines leem,
+    dimensionadas para `n_contas` (as de controle o próprio app cria).
+    As contas seguem benchmarks.geradores.contas_sinteticas.
+    """
+    rng    = np.random.default_rng(seed)
+    contas = contas_sinteticas(int(n_contas * 1.05))
+    ativas, inativas = contas[:n_contas], contas[n_contas:]
+    datas  = pd.date_range(end=DATA_REFERENCIA, periods=30, freq="D")
+
+    tabelas = {
+        "base_btg": pd.DataFrame({
+            "Conta":    ativas,
+            "Nome":     [f"CLIENTE {c}" for c in ativas],
+            "Assessor": rng.choice(ASSESSORES, size=len(ativas)),
+        }),
+        "times_nova_empresa": pd.DataFrame({
+            "Assessor":    ASSESSORES,
+            "CGE OFFICER": [str(500 + i) for i in range(len(ASSESSORES))],
+        }),
+        "pl_offshore": pd.DataFrame({
+            "Conta": [f"OFF{i}" for i in range(max(1, n_contas // 100))],
+            "Nome": "CLIENTE OFFSHORE", "Assessor": ASSESSORES[0], "PL Total": 1e6,
+        }),
+        "setores_ativos": pd.DataFrame({
+            "Ativo":    TICKERS + [None] * len(EMISSORES),
+            "Emissor":  [None] * len(TICKERS) + EMISSORES,
+            "Setor":    "Setor", "Subsetor": "Subsetor",
+        }),
+        "migracoes_btg": pd.DataFrame({
+            "CONTA": ativas[:10], "DATA": DATA_REFERENCIA, "CAPTAÇÃO": 1e5,
+            "Assessor": ASSESSORES[1],
+        }),
+        "nnm_offshore": pd.DataFrame({
+            "nr_conta": ["OFF0"], "data_captacao": [DATA_REFERENCIA], "captacao": [5e4],
+            "Assessor": [ASSESSORES[0]],
+        }),
+        "Entradas_e_saidas_consolidado": pd.DataFrame({
+            "Conta": inativas[: len(inativas) // 2],
+            "Mês de entrada/saída": DATA_REFERENCIA - pd.Timedelta(days=1),
+        }),
+        # Histórico de PL só das contas que saíram — é o que o NNM consulta
+        "pl_historico_diario": pd.DataFrame({
+            "Conta":    np.repeat(inativas, len(datas)),
+            "Assessor": ASSESSORES[0],
+            "PL Total": rng.uniform(1e3, 5e6, size=len(inativas) * len(datas)).round(2),
+            "PL Declarado": 0.0, "Faixa Cliente": "Ate 300k", "Data Vínculo": DATA_REFERENCIA,
+            "Conta Corrente": 0.0, "Fundos": 0.0, "Renda Fixa": 0.0,
+            "Renda Variável": 0.0, "Previdência": 0.0, "Derivativos": 0.0,
+            "Data":     np.tile(datas, len(inativas)),
+            "Mês":      "2026/10",
+        }),
+        "captacao_historico": pd.DataFrame({
+            "DATA": [DATA_REFERENCIA - pd.Timedelta(days=365)], "CONTA": [ativas[0]],
+            "CAPTAÇÃO": [0.0], "Assessor": [ASSESSORES[0]],
+            "TIPO DE CAPTACAO": ["Padrão"], "MERCADO": ["Renda Fixa"],
+            "Situacao": ["Ativo"], "Nome": [f"CLIENTE {ativas[0]}"],
+        }),
+    }
+    tabelas["auc_offshore"] = tabelas["pl_offshore"][["Conta", "Assessor"]]
+
+    with engine.begin() as conn:
+        for nome, df in tabelas.items():
+            df.to_sql(nome, conn, schema="dbo", index=False, if_exists="replace")
@@ -0,0 +1,138 @@
+"""
+Detecção de saídas (_executar_calculo_saidas) em histórico sintético de vários anos.
+
+Compara a versão anterior (contas carregadas no pandas + loop de pertinência
+em lista) com app.SQL_NOVAS_SAIDAS, que resolve tudo no banco. Exige o mesmo
+resultado e imprime o tempo de cada uma. Roda num SQLite local.
+
+    python -m benchmarks.bench_calculo_saidas --contas 2000 --anos 3
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from app import _buscar_novas_saidas, TIPO_SAIDA_CONTA
+from benchmarks.banco_local import criar_engine_sqlite
+
+
+def popular_banco(engine, n_contas: int, anos: int, seed: int = 7):
+    rng    = np.random.default_rng(seed)
+    contas = np.array([str(2_000_000 + i) for i in range(n_contas)])
+    datas  = pd.bdate_range(end="2026-10-16", periods=252 * anos)
+
+    # 80% ativas; das inativas, metade já tem lançamento de saída
+    ativas       = contas[: int(n_contas * 0.8)]
+    inativas     = contas[int(n_contas * 0.8):]
+    ja_com_saida = inativas[: len(inativas) // 2]
+
+    with engine.begin() as conn:
+        pd.DataFrame({"Conta": ativas, "Assessor": "ASSESSOR", "Nome": "NOME"}) \
+            .to_sql("base_btg", conn, schema="dbo", index=False)
+
+        n_capt = n_contas * 5
+        captacao = pd.DataFrame({
+            "DATA":             rng.choice(datas, size=n_capt),
+            "CONTA":            rng.choice(contas, size=n_capt),
+            "CAPTAÇÃO":         rng.normal(0, 50_000, size=n_capt).round(2),
+            "TIPO DE CAPTACAO": "Padrão",
+        })
+        saidas = pd.DataFrame({
+            "DATA": datas[-30], "CONTA": ja_com_saida,
+            "CAPTAÇÃO": -1.0, "TIPO DE CAPTACAO": TIPO_SAIDA_CONTA,
+        })
+        pd.concat([captacao, saidas]).to_sql(
+            "captacao_historico", conn, schema="dbo", index=False, chunksize=50_000
+        )
+
+    # pl_historico_diario: cópia do book por dia útil (contas inativas
+    # param de aparecer num dia aleatório)
+    saida_em = dict(zip(inativas, rng.integers(0, len(datas), size=len(inativas))))
+    datas_str = [d.strftime("%Y-%m-%d 00:00:00.000000") for d in datas]
+    raw = engine.raw_connection()
+    try:
+        cur = raw.cursor()
+        cur.execute('CREATE TABLE dbo.pl_historico_diario (Conta TEXT, "PL Total" REAL, Data TIMESTAMP)')
+        for i, d in enumerate(datas_str):
+            vivas = [c for c in contas if saida_em.get(c, len(datas)) > i]
+            cur.executemany(
+                "INSERT INTO dbo.pl_historico_diario VALUES (?, ?, ?)",
+                [(c, float(v), d) for c, v in zip(vivas, rng.uniform(1e3, 5e6, size=len(vivas)).round(2))],
+            )
+        cur.execute("CREATE INDEX dbo.ix_pl_conta_data ON pl_historico_diario (Conta, Data)")
+        cur.execute("CREATE INDEX dbo.ix_capt_conta ON captacao_historico (CONTA)")
+        cur.execute("CREATE INDEX dbo.ix_base_conta ON base_btg (Conta)")
+        raw.commit()
+    finally:
+        raw.close()
+
+
+def novas_saidas_legado(conn) -> pd.DataFrame:
+    """Implementação anterior, mantida só como referência."""
+    contas_historico = pd.read_sql(
+        "SELECT DISTINCT CONTA AS nr_conta FROM dbo.captacao_historico", conn
+    )
+    contas_historico["nr_conta"] = contas_historico["nr_conta"].astype(str).str.strip()
+    contas_ativas = pd.read_sql("SELECT Conta FROM dbo.base_btg", conn)
+    contas_ativas["Conta"] = contas_ativas["Conta"].astype(str).str.strip()
+    inativas = contas_historico[
+        ~contas_historico["nr_conta"].isin(contas_ativas["Conta"])
+    ]["nr_conta"].tolist()
+
+    saidas_existentes = pd.read_sql(
+        text("SELECT DISTINCT CONTA AS nr_conta FROM dbo.captacao_historico "
+             "WHERE [TIPO DE CAPTACAO] = :t"), conn, params={"t": TIPO_SAIDA_CONTA}
+    )
+    saidas_existentes["nr_conta"] = saidas_existentes["nr_conta"].astype(str)
+    novas_saidas = [
+        c for c in inativas
+        if c not in saidas_existentes["nr_conta"].tolist()
+    ]
+
+    placeholders = ", ".join([f"'{c}'" for c in novas_saidas])
+    pl_historico = pd.read_sql(f"""
+        SELECT Conta AS nr_conta, [PL Total], Data
+        FROM dbo.pl_historico_diario
+        WHERE Conta IN ({placeholders})
+        ORDER BY Data
+    """, conn)
+    pl_historico["Data"] = pd.to_datetime(pl_historico["Data"])
+    return pl_historico.sort_values("Data").groupby("nr_conta").last().reset_index()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--contas", type=int, default=2000)
+    parser.add_argument("--anos",   type=int, default=3)
+    args = parser.parse_args()
+
+    engine = criar_engine_sqlite()
+    inicio = time.perf_counter()
+    popular_banco(engine, args.contas, args.anos)
+    with engine.connect() as conn:
+        n_pl = conn.execute(text("SELECT COUNT(*) FROM dbo.pl_historico_diario")).scalar()
+    print(f"banco sintético: {args.contas} contas, {args.anos} anos, "
+          f"{n_pl} linhas de PL ({time.perf_counter() - inicio:.1f}s para gerar)")
+
+    with engine.connect() as conn:
+        t0 = time.perf_counter()
+        legado = novas_saidas_legado(conn)
+        t_legado = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        novo = _buscar_novas_saidas(conn)
+        t_novo = time.perf_counter() - t0
+
+    novo["Data"] = pd.to_datetime(novo["Data"])
+    ordenar = lambda df: df.sort_values("nr_conta").reset_index(drop=True)
+    pd.testing.assert_frame_equal(ordenar(novo), ordenar(legado[novo.columns]), check_dtype=False)
+
+    print(f"saída idêntica: {len(novo)} novas saídas")
+    print(f"legado (pandas + loop): {t_legado:8.3f}s")
+    print(f"SQL_NOVAS_SAIDAS:       {t_novo:8.3f}s  ({t_legado / max(t_novo, 1e-9):.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
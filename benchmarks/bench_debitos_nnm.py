@@ -0,0 +1,93 @@
+"""
+Regressão do passo 7 do webhook_nnm (débitos de saída de contas inativas).
+
+Compara a implementação antiga (iterrows + filtro do pl_hist por conta) com
+app._calcular_debitos_saida em dados sintéticos: exige saída idêntica e
+imprime o tempo de cada uma.
+
+    python -m benchmarks.bench_debitos_nnm --contas 2000 --dias 60
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from app import _calcular_debitos_saida
+
+
+def gerar_dados(n_contas: int, n_dias: int, seed: int = 42):
+    rng    = np.random.default_rng(seed)
+    contas = [str(1_000_000 + i) for i in range(n_contas)]
+
+    # Algumas contas aparecem mais de uma vez no dia (vários lançamentos)
+    repetidas = rng.choice(contas, size=n_contas // 4)
+    contas_inativas = pd.DataFrame({
+        "CONTA":    contas + list(repetidas),
+        "Assessor": [f"ASSESSOR {i % 40}" for i in range(n_contas + len(repetidas))],
+    }).drop_duplicates(subset="CONTA")
+
+    # 10% das contas sem histórico de PL — não geram débito
+    com_pl = contas[: int(n_contas * 0.9)]
+    datas  = pd.date_range(end="2026-10-16", periods=n_dias, freq="D")
+    pl_hist = pd.DataFrame({
+        "CONTA":    np.repeat(com_pl, n_dias),
+        "Data":     np.tile(datas, len(com_pl)),
+        "PL Total": rng.uniform(1_000, 5_000_000, size=len(com_pl) * n_dias).round(2),
+    })
+    # Ordem do banco não é garantida
+    pl_hist = pl_hist.sample(frac=1, random_state=seed).reset_index(drop=True)
+    return contas_inativas, pl_hist
+
+
+def debitos_legado(contas_inativas: pd.DataFrame, pl_hist: pd.DataFrame) -> pd.DataFrame:
+    """Implementação anterior do passo 7, mantida só como referência."""
+    debitos = []
+    for _, row in contas_inativas.iterrows():
+        conta = row["CONTA"]
+        pl_conta = pl_hist[pl_hist["CONTA"] == conta].sort_values("Data")
+        if pl_conta.empty:
+            continue
+        ultimo = pl_conta.iloc[-1]
+        debitos.append({
+            "CONTA":            conta,
+            "CAPTAÇÃO":         float(ultimo["PL Total"]) * -1,
+            "Assessor":         row["Assessor"],
+            "Situacao":         "Inativo",
+            "TIPO DE CAPTACAO": "Saída de conta",
+            "MERCADO":          "Saída de conta",
+            "_data_pl":         ultimo["Data"],
+        })
+    return pd.DataFrame(debitos)
+
+
+def cronometrar(func, *args):
+    inicio = time.perf_counter()
+    resultado = func(*args)
+    return resultado, time.perf_counter() - inicio
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--contas", type=int, default=2000)
+    parser.add_argument("--dias",   type=int, default=60)
+    args = parser.parse_args()
+
+    contas_inativas, pl_hist = gerar_dados(args.contas, args.dias)
+    print(f"contas inativas: {len(contas_inativas)} | linhas pl_hist: {len(pl_hist)}")
+
+    novo,   t_novo   = cronometrar(_calcular_debitos_saida, contas_inativas, pl_hist)
+    legado, t_legado = cronometrar(debitos_legado, contas_inativas, pl_hist)
+
+    pd.testing.assert_frame_equal(
+        novo.reset_index(drop=True),
+        legado[novo.columns].reset_index(drop=True),
+        check_dtype=False,
+    )
+    print(f"saída idêntica: {len(novo)} débitos")
+    print(f"legado (iterrows): {t_legado:8.3f}s")
+    print(f"vetorizado:        {t_novo:8.3f}s  ({t_legado / max(t_novo, 1e-9):.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
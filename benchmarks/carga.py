@@ -0,0 +1,281 @@
+"""
+Teste de carga ponta a ponta: app sob gunicorn + simuladores BTG/S3 locais.
+
+Sobe o simulador (benchmarks.simuladores), um banco SQLite com as
+referências (BANCO_BACKEND=sqlite) e o gunicorn com o gunicorn.conf.py do
+repositório; depois dispara, por `--duracao` segundos, uma mistura ponderada
+de webhooks e triggers com `--concorrencia` clientes. Opcionalmente, rajadas
+de /webhook/performance (uma chamada por conta, como o BTG faz).
+
+O relatório (tela + JSON) traz, por rota: chamadas, vazão, p50/p90/p99/máx
+de latência, taxa de erro (5xx/falha de conexão) e respostas 4xx, além das
+chamadas recebidas pelo simulador.
+
+    python -m benchmarks.carga --contas 1000 --duracao 60 --concorrencia 8
+    python -m benchmarks.carga --mix webhook.performance=1 --rajada 500 --intervalo-rajada 15
+"""
+import argparse
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import requests
+
+import app
+from benchmarks import geradores
+from benchmarks.banco_local import popular_referencias
+from benchmarks.simuladores import iniciar_simulador
+
+TOKEN = "carga"
+RAIZ  = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MIX_PADRAO = (
+    "webhook.performance=10,relatorio.performance=5,webhook.nnm=1,webhook.base_btg=1,"
+    "webhook.custodia=1,webhook.posicao=1,trigger.nnm=2,trigger.saldo_cc=1,trigger.carteiras=1"
+)
+
+
+def _webhook(rota: str, arquivo: str):
+    return lambda ctx: ("POST", rota, {"response": {"url": f"{ctx['s3']}/{arquivo}"}})
+
+
+def _webhook_performance(ctx):
+    conta = random.choice(ctx["contas"])
+    return "POST", "/webhook/performance", {"response": {
+        "url":           f"{ctx['s3']}/performance/{conta}.zip",
+        "accountNumber": conta,
+        "endDate":       geradores.DATA_REFERENCIA.strftime("%Y-%m-%d"),
+    }}
+
+
+# Operação → função(contexto) -> (método, caminho, json)
+OPERACOES = {
+    "webhook.base_btg":      _webhook("/webhook/basebtg", "base_btg.csv"),
+    "webhook.nnm":           _webhook("/webhook/nnm", "nnm.csv"),
+    "webhook.custodia":      _webhook("/webhook/custodia", "custodia.zip"),
+    "webhook.posicao":       _webhook("/webhook/posicao", "posicao.zip"),
+    "webhook.performance":   _webhook_performance,
+    "relatorio.performance": lambda ctx: (
+        "GET", f"/relatorios/performance/{random.choice(ctx['contas'])}", None
+    ),
+    "trigger.nnm":           lambda ctx: ("GET", "/trigger/nnm", None),
+    "trigger.basebtg":       lambda ctx: ("GET", "/trigger/basebtg", None),
+    "trigger.custodia":      lambda ctx: ("GET", "/trigger/custodia", None),
+    "trigger.saldo_cc":      lambda ctx: ("GET", "/trigger/saldo-cc", None),
+    "trigger.carteiras":     lambda ctx: ("GET", "/trigger/carteiras-recomendadas", None),
+    "trigger.posicao":       lambda ctx: ("GET", "/trigger/posicao", None),
+    "trigger.inspecionar_posicao": lambda ctx: ("GET", "/trigger/inspecionar-posicao", None),
+    # O simulador devolve cada pedido como callback em /webhook/performance
+    "trigger.performance_lote": lambda ctx: (
+        "GET", "/trigger/performance-lote?contas=" + ",".join(random.sample(ctx["contas"], 20)), None
+    ),
+}
+
+
+def ler_mix(texto: str) -> dict:
+    mix = {}
+    for item in texto.split(","):
+        nome, _, peso = item.partition("=")
+        nome = nome.strip()
+        if nome not in OPERACOES:
+            raise SystemExit(f"Operação desconhecida no mix: {nome} (use {', '.join(OPERACOES)})")
+        mix[nome] = float(peso or 1)
+    return mix
+
+
+class Registro:
+    """Amostras (operação, status, latência) coletadas pelos clientes."""
+
+    def __init__(self):
+        self.amostras = []
+        self._lock = threading.Lock()
+
+    def executar(self, sessao: requests.Session, base: str, nome: str, ctx: dict):
+        metodo, caminho, corpo = OPERACOES[nome](ctx)
+        inicio = time.perf_counter()
+        try:
+            r = sessao.request(metodo, base + caminho, json=corpo,
+                               headers={"X-Webhook-Token": TOKEN}, timeout=900)
+            status = r.status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        with self._lock:
+            self.amostras.append((nome, status, time.perf_counter() - inicio))
+
+    def resumo(self, duracao: float) -> dict:
+        por_operacao = {}
+        for nome in sorted({a[0] for a in self.amostras}):
+            status = [a[1] for a in self.amostras if a[0] == nome]
+            tempos = np.array([a[2] for a in self.amostras if a[0] == nome]) * 1000
+            # Erro = 5xx ou falha de conexão; 4xx (ex.: PDF ainda não entregue) à parte
+            erros  = sum(1 for s in status if not isinstance(s, int) or s >= 500)
+            rejeitadas = sum(1 for s in status if isinstance(s, int) and 400 <= s < 500)
+            por_operacao[nome] = {
+                "chamadas":    len(status),
+                "vazao_rps":   round(len(status) / duracao, 3),
+                "p50_ms":      round(float(np.percentile(tempos, 50)), 1),
+                "p90_ms":      round(float(np.percentile(tempos, 90)), 1),
+                "p99_ms":      round(float(np.percentile(tempos, 99)), 1),
+                "max_ms":      round(float(tempos.max()), 1),
+                "erros":       erros,
+                "taxa_erro":   round(erros / len(status), 4),
+                "respostas_4xx": rejeitadas,
+                "status":      {str(s): status.count(s) for s in set(status)},
+            }
+        return por_operacao
+
+
+def preparar_banco(diretorio: str, n_contas: int):
+    engine = app.criar_engine_sqlite(diretorio)
+    popular_referencias(engine, n_contas)
+    engine.dispose()
+
+
+def iniciar_gunicorn(porta: int, env: dict, workers: int, extras: list) -> subprocess.Popen:
+    comando = [
+        sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+        "--bind", f"127.0.0.1:{porta}", "--workers", str(workers), *extras, "app:app",
+    ]
+    return subprocess.Popen(comando, cwd=RAIZ, env=env)
+
+
+def aguardar_app(base: str, processo: subprocess.Popen, limite: float = 120):
+    fim = time.monotonic() + limite
+    while time.monotonic() < fim:
+        if processo.poll() is not None:
+            raise SystemExit(f"gunicorn saiu com código {processo.returncode}")
+        try:
+            if requests.get(f"{base}/healthz", timeout=2).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise SystemExit("app não respondeu a tempo")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--contas", type=int, default=1000)
+    parser.add_argument("--duracao", type=float, default=60, help="segundos de carga")
+    parser.add_argument("--concorrencia", type=int, default=8, help="clientes simultâneos")
+    parser.add_argument("--mix", default=MIX_PADRAO, help="operacao=peso,...")
+    parser.add_argument("--rajada", type=int, default=0,
+                        help="webhooks de performance por rajada (0 = sem rajadas)")
+    parser.add_argument("--intervalo-rajada", type=float, default=20)
+    parser.add_argument("--concorrencia-rajada", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=2, help="workers do gunicorn")
+    parser.add_argument("--gunicorn", nargs=argparse.REMAINDER, default=[],
+                        help="argumentos extras do gunicorn (ex.: --gunicorn --threads 8; "
+                             "workers sync exigem --worker-class sync --threads 1)")
+    parser.add_argument("--latencia-btg", type=float, default=0.05,
+                        help="latência simulada das chamadas ao BTG/S3 (s)")
+    parser.add_argument("--espera-posicao", type=int, default=5,
+                        help="espera entre refresh e download da posição (s; produção: 90)")
+    parser.add_argument("--porta", type=int, default=18000)
+    parser.add_argument("--saida", default="carga.json")
+    args = parser.parse_args()
+
+    mix = ler_mix(args.mix)
+    diretorio = tempfile.mkdtemp(prefix="carga_btg_")
+    preparar_banco(os.path.join(diretorio, "banco"), args.contas)
+
+    simulador = iniciar_simulador(args.contas, latencia=args.latencia_btg, token_webhook=TOKEN)
+    base_app  = f"http://127.0.0.1:{args.porta}"
+    host_sim  = simulador.url_base.split("//", 1)[1]
+
+    env = {
+        **os.environ,
+        "BANCO_BACKEND":            "sqlite",
+        "BANCO_SQLITE_DIR":         os.path.join(diretorio, "banco"),
+        "WEBHOOK_TOKEN":            TOKEN,
+        "BTG_CLIENT_ID":            "carga",
+        "BTG_CLIENT_SECRET":        "carga",
+        "BTG_API_BASE_URL":         simulador.url_base,
+        "DOMINIOS_DOWNLOAD_LOCAIS": host_sim,
+        "PARTNER_REPORT_URL_NNM":      f"{simulador.url_base}/reports/nnm",
+        "PARTNER_REPORT_URL_BASEBTG":  f"{simulador.url_base}/reports/basebtg",
+        "PARTNER_REPORT_URL_CUSTODIA": f"{simulador.url_base}/reports/custodia",
+        "PERFORMANCE_CALLBACK_URL": f"{base_app}/webhook/performance",
+        "POSICAO_ESPERA_REFRESH_SEGUNDOS": str(args.espera_posicao),
+        "ARQUIVO_RAW_DESTINO":      "disco",
+        "ARQUIVO_RAW_DIR":          os.path.join(diretorio, "arquivo_raw"),
+        "PROMETHEUS_MULTIPROC_DIR": os.path.join(diretorio, "prometheus"),
+    }
+    processo = iniciar_gunicorn(args.porta, env, args.workers, args.gunicorn)
+
+    try:
+        aguardar_app(base_app, processo)
+        ctx = {"s3": f"{simulador.url_base}/s3", "contas": simulador.contas}
+        registro = Registro()
+        nomes, pesos = list(mix), list(mix.values())
+        fim = time.monotonic() + args.duracao
+
+        def cliente():
+            sessao = requests.Session()
+            while time.monotonic() < fim:
+                registro.executar(sessao, base_app, random.choices(nomes, pesos)[0], ctx)
+
+        def rajadas():
+            with ThreadPoolExecutor(args.concorrencia_rajada) as pool:
+                while time.monotonic() < fim:
+                    sessao = requests.Session()
+                    list(pool.map(
+                        lambda _: registro.executar(sessao, base_app, "webhook.performance", ctx),
+                        range(args.rajada),
+                    ))
+                    time.sleep(max(0.0, min(args.intervalo_rajada, fim - time.monotonic())))
+
+        print(f"Carga por {args.duracao:.0f}s — {args.concorrencia} clientes, mix {mix}", flush=True)
+        inicio = time.monotonic()
+        threads = [threading.Thread(target=cliente) for _ in range(args.concorrencia)]
+        if args.rajada:
+            threads.append(threading.Thread(target=rajadas))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        duracao = time.monotonic() - inicio
+    finally:
+        processo.send_signal(signal.SIGTERM)
+        try:
+            processo.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            processo.kill()
+        simulador.shutdown()
+
+    por_operacao = registro.resumo(duracao)
+    total = len(registro.amostras)
+    relatorio = {
+        "gerado_em":   datetime.now().isoformat(timespec="seconds"),
+        "parametros":  {k: v for k, v in vars(args).items() if k != "saida"},
+        "duracao_s":   round(duracao, 1),
+        "total": {
+            "chamadas":  total,
+            "vazao_rps": round(total / duracao, 3),
+            "erros":     sum(o["erros"] for o in por_operacao.values()),
+        },
+        "operacoes":   por_operacao,
+        "simulador":   dict(simulador.chamadas),
+    }
+    with open(args.saida, "w", encoding="utf-8") as f:
+        json.dump(relatorio, f, ensure_ascii=False, indent=2)
+
+    print(f"\n{'operação':<24} {'n':>6} {'rps':>7} {'p50 ms':>9} {'p99 ms':>9} {'erro %':>7}")
+    for nome, o in por_operacao.items():
+        print(f"{nome:<24} {o['chamadas']:>6} {o['vazao_rps']:>7.2f} {o['p50_ms']:>9.1f} "
+              f"{o['p99_ms']:>9.1f} {o['taxa_erro'] * 100:>6.1f}%")
+    print(f"\nTotal: {total} chamadas em {duracao:.1f}s ({total / duracao:.2f} rps). "
+          f"Relatório em {args.saida}")
+
+
+if __name__ == "__main__":
+    main()
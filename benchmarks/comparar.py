@@ -0,0 +1,79 @@
+"""
+Compara dois relatórios de benchmarks.executar (ex.: main × branch).
+
+Casa os resultados por caso + nº de contas e aponta regressão quando a
+mediana nova passa da base por mais de `--tolerancia` (fração) e por mais
+de `--minimo` segundos — abaixo disso é ruído. Sai com código 1 se houver
+regressão ou caso que passou a falhar.
+
+    python -m benchmarks.comparar base.json novo.json --tolerancia 0.10
+"""
+import argparse
+import json
+import sys
+
+
+def _indexar(relatorio: dict) -> dict:
+    return {(r["caso"], r["contas"]): r for r in relatorio["resultados"]}
+
+
+def comparar(base: dict, novo: dict, tolerancia: float, minimo: float) -> list:
+    antes, depois = _indexar(base), _indexar(novo)
+    linhas = []
+    for chave in sorted(antes.keys() | depois.keys(), key=lambda k: (k[1], k[0])):
+        a, d = antes.get(chave), depois.get(chave)
+        if a is None or d is None:
+            linhas.append((*chave, None, None, None, "só na base" if d is None else "novo"))
+            continue
+        if d.get("erro") and not a.get("erro"):
+            linhas.append((*chave, a.get("mediana_s"), None, None, "REGRESSÃO (passou a falhar)"))
+            continue
+        if a.get("erro") or d.get("erro"):
+            situacao = "corrigido" if not d.get("erro") else "falha nos dois"
+            linhas.append((*chave, a.get("mediana_s"), d.get("mediana_s"), None, situacao))
+            continue
+
+        t_a, t_d = a["mediana_s"], d["mediana_s"]
+        razao = t_d / t_a if t_a else None
+        if razao and razao > 1 + tolerancia and t_d - t_a > minimo:
+            situacao = "REGRESSÃO"
+        elif razao and razao < 1 - tolerancia and t_a - t_d > minimo:
+            situacao = "melhora"
+        else:
+            situacao = ""
+        linhas.append((*chave, t_a, t_d, razao, situacao))
+    return linhas
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("base")
+    parser.add_argument("novo")
+    parser.add_argument("--tolerancia", type=float, default=0.10)
+    parser.add_argument("--minimo", type=float, default=0.005,
+                        help="diferença absoluta mínima (s) para contar como mudança")
+    args = parser.parse_args()
+
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.novo, encoding="utf-8") as f:
+        novo = json.load(f)
+
+    print(f"base: {(base['commit'].get('sha') or '?')[:10]}  "
+          f"novo: {(novo['commit'].get('sha') or '?')[:10]}")
+    print(f"{'caso':<40} {'contas':>7} {'base (s)':>10} {'novo (s)':>10} {'razão':>7}")
+
+    regressoes = 0
+    for caso, contas, t_a, t_d, razao, situacao in comparar(
+        base, novo, args.tolerancia, args.minimo
+    ):
+        fmt = lambda v, casas: f"{v:.{casas}f}" if v is not None else "-"
+        print(f"{caso:<40} {contas:>7} {fmt(t_a, 4):>10} {fmt(t_d, 4):>10} "
+              f"{fmt(razao, 2):>7}  {situacao}")
+        regressoes += situacao.startswith("REGRESSÃO")
+
+    sys.exit(1 if regressoes else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+"""
+Suite de benchmarks dos leitores, transformações, gravações e webhooks.
+
+Para cada tamanho (nº de contas) gera os arquivos sintéticos de
+benchmarks.geradores, monta um SQLite local com as referências
+(banco_local.popular_referencias) e mede cada caso `--repeticoes` vezes.
+Os webhooks rodam inteiros pelo cliente de teste do Flask, com o download
+servido da memória; os jobs encadeados em thread (entradas/saídas,
+cálculo de saídas) ficam de fora — têm benchmark próprio.
+
+O relatório JSON traz commit, versões e, por caso e tamanho, os tempos
+brutos, mínimo e mediana — comparável entre commits com benchmarks.comparar.
+
+    python -m benchmarks.executar --tamanhos 1000 10000 --saida bench.json
+    python -m benchmarks.executar --tamanhos 100000 --filtro webhook.posicao
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import requests
+import sqlalchemy
+from sqlalchemy import text
+
+import app
+from benchmarks import geradores
+from benchmarks.banco_local import criar_engine_sqlite, popular_referencias
+
+TOKEN = "bench"
+URL_ARQUIVO = "https://invest-reports.s3.amazonaws.com/bench/{}"
+
+# Caso → função(cenário) que prepara os dados e devolve
+# {"executar": fn() -> linhas, "antes": fn() opcional, "bytes": entrada}
+CASOS = {}
+
+
+def caso(nome: str):
+    def registrar(fn):
+        CASOS[nome] = fn
+        return fn
+    return registrar
+
+
+class Cenario:
+    """Arquivos sintéticos de um tamanho, gerados sob demanda e reaproveitados entre casos."""
+
+    def __init__(self, n_contas: int):
+        self.n_contas = n_contas
+        self._arquivos = {}
+
+    def arquivo(self, nome: str) -> bytes:
+        if nome not in self._arquivos:
+            gerador = getattr(geradores, f"gerar_{nome}")
+            self._arquivos[nome] = gerador(self.n_contas)
+        return self._arquivos[nome]
+
+
+# ── Leitura ───────────────────────────────────────────────────────────────────
+
+@caso("leitura.base_btg_csv")
+def _(c):
+    dados = c.arquivo("csv_base_btg")
+    return {"executar": lambda: len(app._ler_csv_base_btg(dados)), "bytes": len(dados)}
+
+
+@caso("leitura.nnm_csv")
+def _(c):
+    dados = c.arquivo("csv_nnm")
+    return {"executar": lambda: len(app._ler_csv_nnm(dados)), "bytes": len(dados)}
+
+
+@caso("leitura.custodia_zip")
+def _(c):
+    dados = c.arquivo("zip_custodia")
+    return {"executar": lambda: len(app._ler_zip_custodia(dados)), "bytes": len(dados)}
+
+
+@caso("leitura.custodia_tipos")
+def _(c):
+    dados = c.arquivo("zip_custodia")
+
+    def executar():
+        with zipfile.ZipFile(io.BytesIO(dados)) as z:
+            colunas, _ = app._tipos_custodia(z, z.namelist()[0])
+        return len(colunas)
+    return {"executar": executar, "bytes": len(dados)}
+
+
+@caso("leitura.parse_posicao_zip")
+def _(c):
+    dados = c.arquivo("zip_posicao")
+    return {"executar": lambda: len(app._parse_posicao_zip(dados)), "bytes": len(dados)}
+
+
+# ── Transformações ────────────────────────────────────────────────────────────
+
+def _base_renomeada(c) -> pd.DataFrame:
+    base = app._ler_csv_base_btg(c.arquivo("csv_base_btg"))
+    base.rename(columns=app.COLUNAS_RENAME_BASE_BTG, inplace=True)
+    base["Conta"] = base["Conta"].astype(str)
+    return base
+
+
+@caso("transformacao.correcoes_assessor")
+def _(c):
+    base = _base_renomeada(c)
+    estado = {}
+
+    def antes():
+        estado["df"] = base.copy()
+
+    return {
+        "antes":    antes,
+        "executar": lambda: len(app.aplicar_correcoes_assessor(estado["df"])),
+    }
+
+
+@caso("transformacao.adicionar_setores")
+def _(c):
+    posicao = app._parse_posicao_zip(c.arquivo("zip_posicao"))
+    estado = {}
+
+    def antes():
+        estado["df"] = posicao.copy()
+
+    return {"antes": antes, "executar": lambda: len(app.adicionar_setores(estado["df"]))}
+
+
+@caso("transformacao.debitos_saida")
+def _(c):
+    with app.get_engine().connect() as conn:
+        pl_hist = pd.read_sql(
+            'SELECT Conta AS CONTA, "PL Total", Data FROM dbo.pl_historico_diario', conn
+        )
+    pl_hist["Data"] = pd.to_datetime(pl_hist["Data"])
+    inativas = pd.DataFrame({"CONTA": pl_hist["CONTA"].unique(), "Assessor": "ASSESSOR"})
+    return {"executar": lambda: len(app._calcular_debitos_saida(inativas, pl_hist))}
+
+
+# ── Gravação ──────────────────────────────────────────────────────────────────
+
+def _apagar(tabela: str):
+    with app.get_engine().begin() as conn:
+        conn.execute(text(f'DROP TABLE IF EXISTS dbo."{tabela}"'))
+
+
+@caso("gravacao.salvar_df_otimizado.replace")
+def _(c):
+    base = _base_renomeada(c)
+
+    def executar():
+        app.salvar_df_otimizado(base, "bench_base_btg", col_pk="Conta", if_exists="replace")
+        return len(base)
+    return {"executar": executar}
+
+
+@caso("gravacao.salvar_df_otimizado.append")
+def _(c):
+    posicao = app._parse_posicao_zip(c.arquivo("zip_posicao"))
+
+    def executar():
+        app.salvar_df_otimizado(posicao, "bench_posicao", if_exists="append")
+        return len(posicao)
+    return {"antes": lambda: _apagar("bench_posicao"), "executar": executar}
+
+
+@caso("gravacao.salvar_particao")
+def _(c):
+    base = _base_renomeada(c)
+    pl = base[[col for col in app.COLUNAS_PL_HISTORICO if col in base.columns]].copy()
+    pl.rename(columns=app.RENAME_PL_HISTORICO, inplace=True)
+    dia = geradores.DATA_REFERENCIA
+    pl["Data"] = dia
+    inicio, fim = app._intervalo_dia(dia)
+
+    # Um dia já gravado, substituído a cada repetição, sobre um mês de histórico
+    historico = pd.concat(
+        [pl.assign(Data=dia - pd.Timedelta(days=d)) for d in range(1, 31)], ignore_index=True
+    )
+    with app.get_engine().begin() as conn:
+        historico.to_sql("bench_pl_historico", conn, schema="dbo", index=False, if_exists="replace")
+
+    def executar():
+        app.salvar_particao(pl, "bench_pl_historico", "Data", inicio, fim)
+        return len(pl)
+    return {"executar": executar}
+
+
+@caso("gravacao.arquivar_raw")
+def _(c):
+    dados = c.arquivo("csv_nnm")
+
+    def antes():
+        app.garantir_tabela(app.TABELA_ARQUIVO_RAW)
+        with app.get_engine().begin() as conn:
+            conn.execute(app.TABELA_ARQUIVO_RAW.delete())
+
+    def executar():
+        if app.arquivar_raw("bench", dados) is None:
+            raise RuntimeError("arquivar_raw falhou")
+        return 1
+    return {"antes": antes, "executar": executar, "bytes": len(dados)}
+
+
+# ── Webhooks completos ────────────────────────────────────────────────────────
+
+def _caso_webhook(rota: str, arquivo: str, payload: dict = None, antes=None):
+    def montar(c):
+        dados   = c.arquivo(arquivo)
+        url     = URL_ARQUIVO.format(arquivo)
+        cliente = app.app.test_client()
+        corpo   = {"response": {"url": url, **(payload or {})}}
+
+        def executar():
+            with servir_downloads({url: dados}):
+                r = cliente.post(rota, json=corpo, headers={"X-Webhook-Token": TOKEN})
+            if r.status_code != 200:
+                raise RuntimeError(f"HTTP {r.status_code}")
+            resposta = r.get_json()
+            return resposta.get("linhas") or resposta.get("base_btg") \
+                or resposta.get("captacao_historico") or resposta.get("atualizados") or 0
+
+        return {"antes": antes, "executar": executar, "bytes": len(dados)}
+    return montar
+
+
+def _limpar_performance():
+    with app.get_engine().begin() as conn:
+        app.TABELA_RELATORIOS_PERFORMANCE.create(conn, checkfirst=True)
+        conn.execute(app.TABELA_RELATORIOS_PERFORMANCE.delete())
+
+
+caso("webhook.base_btg")(_caso_webhook("/webhook/basebtg", "csv_base_btg"))
+caso("webhook.nnm")(_caso_webhook("/webhook/nnm", "csv_nnm"))
+caso("webhook.custodia")(_caso_webhook("/webhook/custodia", "zip_custodia"))
+caso("webhook.posicao")(_caso_webhook("/webhook/posicao", "zip_posicao"))
+caso("webhook.performance")(_caso_webhook(
+    "/webhook/performance", "zip_performance",
+    payload={"endDate": geradores.DATA_REFERENCIA.strftime("%Y-%m-%d")},
+    antes=_limpar_performance,
+))
+
+
+# ── Infraestrutura ────────────────────────────────────────────────────────────
+
+@contextlib.contextmanager
+def servir_downloads(arquivos: dict):
+    """Responde as URLs de `arquivos` da memória no lugar do S3/BTG."""
+    original = requests.Session.request
+
+    def request(sessao, metodo, url, **kwargs):
+        if url not in arquivos:
+            return original(sessao, metodo, url, **kwargs)
+        r = requests.Response()
+        r.status_code       = 200
+        r.url               = url
+        r._content          = arquivos[url]
+        r._content_consumed = True
+        return r
+
+    requests.Session.request = request
+    try:
+        yield
+    finally:
+        requests.Session.request = original
+
+
+@contextlib.contextmanager
+def banco_isolado(n_contas: int):
+    """Aponta o app para um SQLite novo, com referências e caches zerados."""
+    diretorio = tempfile.mkdtemp(prefix="bench_btg_")
+    engine    = criar_engine_sqlite(diretorio)
+    popular_referencias(engine, n_contas)
+    app._instrumentar_engine(engine)
+
+    originais = {
+        "get_engine":                app.get_engine,
+        "WEBHOOK_TOKEN":             app.WEBHOOK_TOKEN,
+        "_executar_entradas_saidas": app._executar_entradas_saidas,
+        "_executar_calculo_saidas":  app._executar_calculo_saidas,
+    }
+    app.get_engine                = lambda: engine
+    app.WEBHOOK_TOKEN             = TOKEN
+    app._executar_entradas_saidas = lambda: None
+    app._executar_calculo_saidas  = lambda: None
+    app._ref_cache.clear()
+    app._tabelas_criadas.clear()
+    app._coluna_hash_performance = False
+    try:
+        yield engine
+    finally:
+        for nome, valor in originais.items():
+            setattr(app, nome, valor)
+        engine.dispose()
+
+
+def medir(montar, cenario: Cenario, repeticoes: int, memoria: bool, verboso: bool) -> dict:
+    resultado = {"tempos_s": [], "linhas": None, "bytes": None, "erro": None}
+    capturado = io.StringIO()
+    saida = contextlib.nullcontext() if verboso else contextlib.redirect_stdout(capturado)
+
+    with banco_isolado(cenario.n_contas), saida:
+        try:
+            definicao = montar(cenario)
+            resultado["bytes"] = definicao.get("bytes")
+            antes = definicao.get("antes") or (lambda: None)
+
+            for _ in range(repeticoes):
+                antes()
+                t0 = time.perf_counter()
+                resultado["linhas"] = definicao["executar"]()
+                resultado["tempos_s"].append(round(time.perf_counter() - t0, 6))
+
+            if memoria:
+                antes()
+                tracemalloc.start()
+                definicao["executar"]()
+                resultado["pico_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 2)
+                tracemalloc.stop()
+        except Exception as e:
+            # Webhooks devolvem só "erro interno" — o motivo está no log do pipeline
+            causa = next((
+                linha for linha in capturado.getvalue().splitlines()
+                if linha.startswith("[ERRO CRÍTICO")
+            ), "")
+            resultado["erro"] = f"{type(e).__name__}: {e} {causa}".strip()[:500]
+
+    if resultado["tempos_s"]:
+        resultado["min_s"]     = min(resultado["tempos_s"])
+        resultado["mediana_s"] = round(statistics.median(resultado["tempos_s"]), 6)
+    return resultado
+
+
+def _commit_atual() -> dict:
+    raiz = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        sha = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=raiz, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        sujo = bool(subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=raiz, capture_output=True, text=True
+        ).stdout.strip())
+        return {"sha": sha, "alteracoes_locais": sujo}
+    except Exception:
+        return {"sha": None, "alteracoes_locais": None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tamanhos", type=int, nargs="+", default=[1000, 10000],
+                        help="nº de contas de cada rodada (ex.: 1000 10000 100000)")
+    parser.add_argument("--repeticoes", type=int, default=3)
+    parser.add_argument("--filtro", nargs="*", default=[],
+                        help="prefixos de casos a rodar (ex.: leitura webhook.nnm)")
+    parser.add_argument("--memoria", action="store_true",
+                        help="mede o pico do tracemalloc numa execução extra")
+    parser.add_argument("--verboso", action="store_true", help="mostra a saída dos pipelines")
+    parser.add_argument("--saida", default="bench.json")
+    args = parser.parse_args()
+
+    casos = [
+        nome for nome in CASOS
+        if not args.filtro or any(nome.startswith(p) for p in args.filtro)
+    ]
+    relatorio = {
+        "gerado_em":  datetime.now().isoformat(timespec="seconds"),
+        "commit":     _commit_atual(),
+        "ambiente": {
+            "python":     platform.python_version(),
+            "plataforma": platform.platform(),
+            "pandas":     pd.__version__,
+            "numpy":      np.__version__,
+            "sqlalchemy": sqlalchemy.__version__,
+        },
+        "repeticoes": args.repeticoes,
+        "resultados": [],
+    }
+
+    for n in args.tamanhos:
+        cenario = Cenario(n)
+        for nome in casos:
+            r = medir(CASOS[nome], cenario, args.repeticoes, args.memoria, args.verboso)
+            relatorio["resultados"].append({"caso": nome, "contas": n, **r})
+            status = (
+                f"ERRO {r['erro']}" if r["erro"]
+                else f"mediana {r['mediana_s']:.3f}s  min {r['min_s']:.3f}s  linhas {r['linhas']}"
+            )
+            print(f"{nome:<40} {n:>7}  {status}", file=sys.stderr, flush=True)
+
+    with open(args.saida, "w", encoding="utf-8") as f:
+        json.dump(relatorio, f, ensure_ascii=False, indent=2)
+    print(f"Relatório gravado em {args.saida}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Geradores de arquivos sintéticos no formato dos feeds do BTG.
+
+Cada função recebe o número de contas e devolve os bytes exatamente como
+chegam nos webhooks (CSV ou ZIP), com distribuições próximas das reais:
+~40 assessores (alguns com grafia a corrigir), PL log-normal, vários
+lançamentos de NNM por conta e vários ativos por posição.
+"""
+import io
+import json
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+DATA_REFERENCIA = pd.Timestamp("2026-10-16")
+
+ASSESSORES = [f"ASSESSOR {i:02d}" for i in range(36)] + [
+    "RODRIGO DE MELLO DELIA", "MURILO LUIZ SILVA GINO",
+    "ROSANA PAVANI", "FERNANDO DOMINGUES",
+]
+FAIXAS   = ["Ate 50K", "Entre 50k e 100k", "Entre 100k e 300k",
+            "Entre 300k e 1M", "Entre 1M e 5M", "Acima de 5M"]
+MERCADOS = ["Renda Fixa", "Fundos", "Renda Variável", "Previdência", "Conta Corrente"]
+EMISSORES = ["BANCO BTG PACTUAL", "PETROBRAS", "VALE", "ITAU UNIBANCO",
+             "TESOURO NACIONAL", "BRADESCO", "ELETROBRAS", "AMBEV"]
+TICKERS  = ["PETR4", "VALE3", "ITUB4", "BBDC4", "ABEV3", "ELET3", "WEGE3", "B3SA3"]
+
+
+def contas_sinteticas(n_contas: int) -> list:
+    return [str(1_000_000 + i) for i in range(n_contas)]
+
+
+def _datas_br(rng, n: int, anos: int = 10) -> list:
+    dias = rng.integers(0, 365 * anos, size=n)
+    return [(DATA_REFERENCIA - pd.Timedelta(days=int(d))).strftime("%Y-%m-%d") for d in dias]
+
+
+def gerar_csv_base_btg(n_contas: int, seed: int = 1) -> bytes:
+    """CSV da base_btg (sep=";", utf-8) com as colunas renomeadas e as do snapshot."""
+    rng    = np.random.default_rng(seed)
+    contas = contas_sinteticas(n_contas)
+    pl     = rng.lognormal(mean=12, sigma=1.6, size=n_contas).round(2)
+    officer = rng.integers(0, len(ASSESSORES), size=n_contas)
+
+    df = pd.DataFrame({
+        "nr_conta":        contas,
+        "nome_completo":   [f"CLIENTE {c}" for c in contas],
+        "nm_officer":      [ASSESSORES[i].title() for i in officer],
+        "faixa_cliente":   rng.choice(FAIXAS, size=n_contas),
+        "pl_total":        pl,
+        "vl_pl_declarado": (pl * rng.uniform(0.5, 3, size=n_contas)).round(2),
+        "dt_vinculo":      _datas_br(rng, n_contas),
+        "dt_abertura":     _datas_br(rng, n_contas),
+        "tipo_cliente":    rng.choice(["PF", "PJ", None], size=n_contas, p=[0.85, 0.1, 0.05]),
+        "profissao":       rng.choice(["ENGENHEIRO", "MEDICO", "ADVOGADO", "EMPRESARIO"], size=n_contas),
+        "dt_nascimento":   _datas_br(rng, n_contas, anos=60),
+        "perfil_investidor": rng.choice(["CONSERVADOR", "MODERADO", "ARROJADO"], size=n_contas),
+        "endereco_cidade": rng.choice(["SAO PAULO", "CAMPINAS", "RIO DE JANEIRO", "CURITIBA"], size=n_contas),
+        "endereco_estado": rng.choice(["SP", "RJ", "PR", "MG"], size=n_contas),
+        "pl_conta_corrente": (pl * 0.05).round(2),
+        "pl_fundos":         (pl * 0.30).round(2),
+        "pl_renda_fixa":     (pl * 0.40).round(2),
+        "pl_renda_variavel": (pl * 0.20).round(2),
+        "pl_previdencia":    (pl * 0.05).round(2),
+        "pl_derivativos":    0.0,
+        "pl_valores_transito": 0.0,
+        "cge_officer":     [str(500 + i) for i in officer],
+        "cge_partner":     "999",
+        "nm_partner":      "ATRIA",
+        "email":           [f"cliente{c}@exemplo.com" for c in contas],
+        "email_assessor":  [f"assessor{i}@exemplo.com" for i in officer],
+        "dt_primeiro_investimento": _datas_br(rng, n_contas),
+        "dt_ultimo_aporte":         _datas_br(rng, n_contas, anos=1),
+        "dt_vinculo_escritorio":    _datas_br(rng, n_contas),
+    })
+    return df.to_csv(sep=";", index=False).encode("utf-8")
+
+
+def gerar_csv_nnm(n_contas: int, lancamentos_por_conta: int = 3,
+                  dias: int = 30, seed: int = 2) -> bytes:
+    """CSV de NNM (sep=";") com alguns estornos RS e contas que já saíram da base."""
+    rng    = np.random.default_rng(seed)
+    # 5% das contas do NNM não estão na base gerada — viram inativas
+    contas = contas_sinteticas(int(n_contas * 1.05))
+    n      = n_contas * lancamentos_por_conta
+    datas  = pd.date_range(end=DATA_REFERENCIA, periods=dias, freq="D")
+
+    df = pd.DataFrame({
+        "nr_conta":        rng.choice(contas, size=n),
+        "dt_captacao":     rng.choice(datas, size=n).astype("datetime64[ns]"),
+        "captacao":        rng.normal(0, 80_000, size=n).round(2),
+        "mercado":         rng.choice(MERCADOS, size=n),
+        "tipo_lancamento": rng.choice(["TED", "PIX", "RS", "TRANSF"], size=n, p=[0.4, 0.4, 0.05, 0.15]),
+        "cge_officer":     [str(500 + i) for i in rng.integers(0, len(ASSESSORES), size=n)],
+    })
+    df["dt_captacao"] = df["dt_captacao"].dt.strftime("%Y-%m-%d")
+    return df.to_csv(sep=";", index=False).encode("utf-8")
+
+
+def _posicao_conta(rng, conta: str) -> dict:
+    data = DATA_REFERENCIA.strftime("%Y-%m-%dT00:00:00")
+    return {
+        "AccountNumber": conta.zfill(9),
+        "PositionDate":  data,
+        "FixedIncome": [{
+            "AccountingGroupCode": "CDB", "Ticker": f"CDB{rng.integers(1000, 9999)}",
+            "Issuer": str(rng.choice(EMISSORES)), "Yield": 1.1,
+            "MaturityDate": "2028-01-01T00:00:00", "Quantity": 10,
+            "GrossValue": float(rng.uniform(1e3, 1e6)), "IncomeTax": 10.0,
+            "IOFTax": 0.0, "NetValue": 990.0, "FTSId": int(rng.integers(1, 1e9)),
+            "Acquisitions": [{"AcquisitionDate": "2024-01-01T00:00:00", "YieldToMaturity": 1.05}],
+        } for _ in range(int(rng.integers(0, 4)))],
+        "InvestmentFund": [{
+            "Fund": {"SecurityCode": f"FND{rng.integers(100, 999)}", "FundName": "FUNDO XP",
+                     "FundCNPJCode": "00000000000100", "ManagerName": "BTG PACTUAL ASSET"},
+            "Acquisition": [{"AcquisitionDate": "2023-05-02T00:00:00", "NumberOfShares": 100,
+                             "GrossAssetValue": float(rng.uniform(1e3, 1e5)), "IncomeTax": 1,
+                             "VirtualIOF": 0, "NetAssetValue": 900}
+                            for _ in range(int(rng.integers(1, 4)))],
+        } for _ in range(int(rng.integers(0, 3)))],
+        "Equities": [{
+            "StockPositions": [{
+                "Ticker": str(rng.choice(TICKERS)), "CompanyName": "EMPRESA SA",
+                "Quantity": int(rng.integers(1, 1000)), "GrossValue": float(rng.uniform(1e2, 1e5)),
+            } for _ in range(int(rng.integers(0, 5)))],
+            "ForwardPositions": [],
+        }],
+        "Cash": [{"CashInvested": [{
+            "Name": "CDB PLUS", "AcquisitionDate": "2026-01-02T00:00:00", "Yield": 1.0,
+            "MaturityDate": "2027-01-02T00:00:00", "Quantity": 1,
+            "GrossValue": float(rng.uniform(1e2, 1e4)), "IncomeTax": 0, "IofTax": 0, "NetValue": 100,
+        }]}],
+    }
+
+
+def gerar_zip_posicao(n_contas: int, seed: int = 3) -> bytes:
+    """ZIP de posições (um JSON por conta), como o positions-by-partner."""
+    rng = np.random.default_rng(seed)
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as z:
+        for conta in contas_sinteticas(n_contas):
+            z.writestr(f"{conta}.json", json.dumps(_posicao_conta(rng, conta)))
+    return buf.getvalue()
+
+
+def gerar_zip_custodia(n_contas: int, ativos_por_conta: int = 5, seed: int = 4) -> bytes:
+    """ZIP com um CSV de custódia (sep=",", latin1, datas dd/mm/aaaa)."""
+    rng = np.random.default_rng(seed)
+    n   = n_contas * ativos_por_conta
+    datas = pd.date_range(end=DATA_REFERENCIA, periods=900, freq="D").strftime("%d/%m/%Y")
+
+    df = pd.DataFrame({
+        "account":       np.repeat(contas_sinteticas(n_contas), ativos_por_conta),
+        "referenceDate": DATA_REFERENCIA.strftime("%d/%m/%Y"),
+        "dataInicio":    rng.choice(datas, size=n),
+        "fixingDate":    rng.choice(list(datas) + [""], size=n),
+        "dataKnockIn":   "",
+        "produto":       rng.choice(["COE", "CDB", "LCI", "DEBÊNTURE", "AÇÕES"], size=n),
+        "ativo":         rng.choice(TICKERS, size=n),
+        "emissor":       rng.choice(EMISSORES, size=n),
+        "quantidade":    rng.integers(1, 10_000, size=n),
+        "valorBruto":    rng.uniform(100, 1e6, size=n).round(2),
+        "valorLiquido":  rng.uniform(100, 1e6, size=n).round(2),
+    })
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("custodia.csv", df.to_csv(sep=",", index=False).encode("latin1"))
+    return buf.getvalue()
+
+
+def _pdf_sintetico(rng, conta: str, tamanho: int) -> bytes:
+    cabecalho = f"%PDF-1.4\n% Relatorio de performance {conta}\n".encode()
+    corpo     = rng.bytes(max(0, tamanho - len(cabecalho) - 6))
+    return cabecalho + corpo + b"\n%%EOF"
+
+
+def gerar_zip_performance(n_contas: int, tamanho_pdf: int = 4096, seed: int = 5) -> bytes:
+    """ZIP de relatórios de performance, um PDF por conta (<conta>_performance.pdf)."""
+    rng = np.random.default_rng(seed)
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as z:
+        for conta in contas_sinteticas(n_contas):
+            z.writestr(f"{conta}_performance.pdf", _pdf_sintetico(rng, conta, tamanho_pdf))
+    return buf.getvalue()
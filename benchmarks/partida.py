@@ -0,0 +1,118 @@
+"""
+Tempo até a primeira resposta do app sob gunicorn (partida a frio).
+
+Para cada configuração — sem preload, com preload e, com --aquecer, com
+preload + AQUECER_NO_BOOT — sobe o gunicorn do zero `--repeticoes` vezes e
+mede, do spawn do processo, quanto leva até o primeiro 200 em /healthz.
+Registra também o que o próprio worker reporta em /healthz (import e
+primeira resposta desde a partida do processo).
+
+    python -m benchmarks.partida --repeticoes 5 --workers 2 --aquecer
+"""
+import argparse
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import requests
+
+from benchmarks.carga import RAIZ, TOKEN
+from benchmarks.simuladores import iniciar_simulador
+
+CONFIGURACOES = {
+    "sem_preload":        {"GUNICORN_PRELOAD": "0", "AQUECER_NO_BOOT": "0"},
+    "preload":            {"GUNICORN_PRELOAD": "1", "AQUECER_NO_BOOT": "0"},
+    "preload_aquecido":   {"GUNICORN_PRELOAD": "1", "AQUECER_NO_BOOT": "1"},
+}
+
+
+def medir_partida(porta: int, workers: int, env: dict, limite: float = 120) -> dict:
+    comando = [
+        sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+        "--bind", f"127.0.0.1:{porta}", "--workers", str(workers), "app:app",
+    ]
+    t0 = time.perf_counter()
+    processo = subprocess.Popen(comando, cwd=RAIZ, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - t0 < limite:
+            if processo.poll() is not None:
+                raise SystemExit(f"gunicorn saiu com código {processo.returncode}")
+            try:
+                r = requests.get(f"http://127.0.0.1:{porta}/healthz", timeout=5)
+                if r.status_code == 200:
+                    boot = r.json()["boot"]
+                    return {"primeira_resposta_s": time.perf_counter() - t0,
+                            "importacao_s": boot["importacao_s"]}
+            except requests.RequestException:
+                pass
+            time.sleep(0.01)
+        raise SystemExit("app não respondeu a tempo")
+    finally:
+        processo.send_signal(signal.SIGTERM)
+        try:
+            processo.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            processo.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeticoes", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--aquecer", action="store_true",
+                        help="inclui a configuração com AQUECER_NO_BOOT=1")
+    parser.add_argument("--porta", type=int, default=18100)
+    parser.add_argument("--saida", default="partida.json")
+    args = parser.parse_args()
+
+    diretorio = tempfile.mkdtemp(prefix="partida_btg_")
+    simulador = iniciar_simulador(1)
+    nomes = [n for n in CONFIGURACOES if args.aquecer or n != "preload_aquecido"]
+
+    resultados = []
+    for nome in nomes:
+        medidas = []
+        for i in range(args.repeticoes):
+            env = {
+                **os.environ, **CONFIGURACOES[nome],
+                "BANCO_BACKEND":            "sqlite",
+                "BANCO_SQLITE_DIR":         os.path.join(diretorio, "banco"),
+                "WEBHOOK_TOKEN":            TOKEN,
+                "BTG_API_BASE_URL":         simulador.url_base,
+                "PROMETHEUS_MULTIPROC_DIR": os.path.join(diretorio, f"prometheus_{nome}_{i}"),
+            }
+            # Porta nova a cada subida: workers da rodada anterior ainda
+            # encerrando não podem responder por esta
+            porta = args.porta + len(resultados) * args.repeticoes + i
+            medidas.append(medir_partida(porta, args.workers, env))
+        tempos = [m["primeira_resposta_s"] for m in medidas]
+        resultados.append({
+            "configuracao":          nome,
+            "tempos_s":              [round(t, 3) for t in tempos],
+            "mediana_s":             round(statistics.median(tempos), 3),
+            "min_s":                 round(min(tempos), 3),
+            "importacao_mediana_s":  statistics.median(m["importacao_s"] for m in medidas),
+        })
+        print(f"{nome:<20} mediana {resultados[-1]['mediana_s']:.3f}s  "
+              f"mín {resultados[-1]['min_s']:.3f}s  "
+              f"import {resultados[-1]['importacao_mediana_s']:.3f}s", flush=True)
+
+    with open(args.saida, "w", encoding="utf-8") as f:
+        json.dump({
+            "executado_em": datetime.now().isoformat(timespec="seconds"),
+            "workers":      args.workers,
+            "repeticoes":   args.repeticoes,
+            "resultados":   resultados,
+        }, f, ensure_ascii=False, indent=2)
+    print(f"relatório: {args.saida}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Simuladores HTTP locais da API BTG e do S3 para o teste de carga.
+
+Um único servidor (threads) responde as rotas que o app chama — token,
+disparo de relatórios, posição (refresh/partner), saldo CC, carteiras
+recomendadas e pedido de relatório de performance — e serve em /s3/ os
+arquivos sintéticos de benchmarks.geradores. O app aponta para cá com
+BTG_API_BASE_URL, PARTNER_REPORT_URL_* e DOMINIOS_DOWNLOAD_LOCAIS.
+
+Pedidos de performance geram o callback em /webhook/performance do app
+(como o BTG faz), com o ZIP de um PDF da conta servido em /s3/performance/.
+"""
+import collections
+import io
+import json
+import random
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import requests
+
+from benchmarks import geradores
+
+TOKEN_SIMULADO = "token-simulado"
+
+# Caminho do arquivo em /s3/<nome> → gerador em benchmarks.geradores
+ARQUIVOS_S3 = {
+    "base_btg.csv": "csv_base_btg",
+    "nnm.csv":      "csv_nnm",
+    "custodia.zip": "zip_custodia",
+    "posicao.zip":  "zip_posicao",
+}
+
+
+class SimuladorBTG(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, porta: int, n_contas: int, latencia: float = 0.0,
+                 token_webhook: str = "", atraso_callback: float = 1.0):
+        super().__init__(("127.0.0.1", porta), _Tratador)
+        self.n_contas        = n_contas
+        self.latencia        = latencia
+        self.token_webhook   = token_webhook
+        self.atraso_callback = atraso_callback
+        self.contas          = geradores.contas_sinteticas(n_contas)
+        self.chamadas        = collections.Counter()
+        self._arquivos       = {}
+        self._lock           = threading.Lock()
+
+    @property
+    def url_base(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def arquivo(self, nome: str) -> bytes:
+        with self._lock:
+            if nome not in self._arquivos:
+                self._arquivos[nome] = getattr(geradores, f"gerar_{ARQUIVOS_S3[nome]}")(self.n_contas)
+            return self._arquivos[nome]
+
+    def zip_performance(self, conta: str) -> bytes:
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as z:
+            # Conteúdo muda a cada pedido — o app grava em vez de ignorar
+            pdf = f"%PDF-1.4\n% {conta} {time.time_ns()}\n".encode() + b"0" * 4096 + b"\n%%EOF"
+            z.writestr(f"{conta}_performance.pdf", pdf)
+        return buf.getvalue()
+
+    def agendar_callback(self, corpo: dict):
+        def enviar():
+            time.sleep(self.atraso_callback)
+            conta = str(corpo.get("accountNumber"))
+            try:
+                requests.post(corpo["callbackUrl"], json={
+                    "response": {
+                        "url":           f"{self.url_base}/s3/performance/{conta}.zip",
+                        "accountNumber": conta,
+                        "endDate":       corpo.get("endDate"),
+                    },
+                }, headers={"X-Webhook-Token": self.token_webhook}, timeout=120)
+            except requests.RequestException as e:
+                print(f"[SIMULADOR] callback de {conta} falhou: {e}", flush=True)
+        threading.Thread(target=enviar, daemon=True).start()
+
+
+class _Tratador(BaseHTTPRequestHandler):
+    server: SimuladorBTG
+
+    def log_message(self, *args):
+        pass
+
+    def _responder(self, status: int, corpo=b"", headers: dict = None,
+                   tipo: str = "application/json"):
+        if isinstance(corpo, (dict, list)):
+            corpo = json.dumps(corpo).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(corpo)))
+        for nome, valor in (headers or {}).items():
+            self.send_header(nome, valor)
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def _rota(self, metodo: str):
+        caminho = urlparse(self.path).path
+        sim     = self.server
+        rotulo  = "/s3/performance/*" if caminho.startswith("/s3/performance/") else caminho
+        sim.chamadas[f"{metodo} {rotulo}"] += 1
+        if sim.latencia:
+            time.sleep(sim.latencia)
+
+        if caminho.endswith("/oauth2/accesstoken"):
+            return self._responder(200, {}, headers={"access_token": TOKEN_SIMULADO})
+
+        if caminho.startswith("/s3/performance/"):
+            conta = caminho.rsplit("/", 1)[-1].split(".")[0]
+            return self._responder(200, sim.zip_performance(conta), tipo="application/zip")
+        if caminho.startswith("/s3/"):
+            nome = caminho[len("/s3/"):]
+            if nome not in ARQUIVOS_S3:
+                return self._responder(404, {"erro": "arquivo inexistente"})
+            return self._responder(200, sim.arquivo(nome), tipo="application/octet-stream")
+
+        if caminho.startswith("/reports/") or caminho.endswith("/position/refresh"):
+            return self._responder(202, {"status": "accepted"})
+
+        if caminho.endswith("/position/partner"):
+            return self._responder(200, {"response": {"url": f"{sim.url_base}/s3/posicao.zip"}})
+
+        if caminho.endswith("/account-balance/list"):
+            amostra = random.sample(sim.contas, min(len(sim.contas), 5000))
+            return self._responder(200, [
+                {"account": c.zfill(9), "balance": round(random.uniform(0, 1e5), 2)}
+                for c in amostra
+            ])
+
+        if caminho.endswith("/recommended-equities-allocation"):
+            return self._responder(200, [{
+                "typeInitial": "DIV", "name": "Dividendos", "description": "Carteira simulada",
+                "validityStart": "2026-10-01", "validityEnd": "2026-10-31",
+                "assets": [{"asset": {"ticker": t, "company": t, "sector": {"name": "Setor"}},
+                            "weight": 0.125} for t in geradores.TICKERS],
+            }])
+
+        if caminho.endswith("/performance-report/account"):
+            tamanho = int(self.headers.get("Content-Length") or 0)
+            corpo   = json.loads(self.rfile.read(tamanho) or b"{}")
+            if corpo.get("callbackUrl"):
+                sim.agendar_callback(corpo)
+            return self._responder(202, {"status": "accepted"})
+
+        return self._responder(404, {"erro": f"rota não simulada: {caminho}"})
+
+    def do_GET(self):
+        self._rota("GET")
+
+    def do_POST(self):
+        self._rota("POST")
+
+
+def iniciar_simulador(n_contas: int, porta: int = 0, **kwargs) -> SimuladorBTG:
+    """Sobe o simulador numa thread e devolve o servidor (url_base, chamadas)."""
+    servidor = SimuladorBTG(porta, n_contas, **kwargs)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
@@ -0,0 +1,43 @@
+# Configuração do gunicorn (usada pelo CMD do Dockerfile)
+import os
+import shutil
+
+bind    = "0.0.0.0:10000"
+workers = 2
+timeout = 600
+
+# Workers com threads: uma requisição esperando BTG/S3/banco segura só uma
+# thread, não o worker inteiro. Engine, caches de referência, tabelas de
+# controle e sessão HTTP do app são seguros entre threads. Memória: cada
+# thread pode ter um DataFrame grande em voo — reduzir threads se o plano
+# tiver pouca RAM. GUNICORN_WORKER_CLASS=sync volta ao modelo anterior.
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads      = int(os.getenv("GUNICORN_THREADS", "4"))
+
+# Importa o app uma vez no master e só então cria os workers (fork): a
+# partida de cada worker não paga mais o import de pandas/SQLAlchemy.
+# Engine e sessão HTTP continuam por worker (criados sob demanda no filho).
+# GUNICORN_PRELOAD=0 volta ao import por worker (ex.: reload com HUP).
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+# Métricas Prometheus multi-processo: cada worker grava seus contadores
+# neste diretório e o /metrics de qualquer worker agrega todos.
+# Precisa estar no ambiente antes de o app importar prometheus_client.
+PROMETHEUS_DIR = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus_multiproc")
+
+
+def on_starting(server):
+    # Arquivos de uma execução anterior inflariam os contadores
+    shutil.rmtree(PROMETHEUS_DIR, ignore_errors=True)
+    os.makedirs(PROMETHEUS_DIR, exist_ok=True)
+
+
+def post_fork(server, worker):
+    # Relógio de partida do worker e aquecimento opcional (AQUECER_NO_BOOT=1)
+    import app
+    app.iniciar_worker()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,141 @@
+"""
+Ida e volta do snapshot da base em SNAPSHOT_BASE_MODO=scd2, no backend
+SQLite: semente do snapshot diário, conta alterada, conta que sai,
+reprocessamento do mesmo dia e leitura de volta por ler_snapshot_base.
+"""
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+import app
+
+D1, D2, D3, D4 = (datetime(2026, 10, d) for d in (13, 14, 15, 16))
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    engine = app.criar_engine_sqlite(str(tmp_path))
+    monkeypatch.setattr(app, "get_engine", lambda: engine)
+    monkeypatch.setattr(app, "registrar_log", lambda *a, **k: None)
+    monkeypatch.setattr(app, "WEBHOOK_TOKEN", "t")
+    monkeypatch.setattr(app, "SNAPSHOT_BASE_MODO", "scd2")
+    yield engine
+    engine.dispose()
+
+
+def base(*linhas):
+    df = pd.DataFrame(linhas, columns=[
+        "Conta", "Nome", "Assessor", "PL Total", "Data Vínculo", "pl_fundos", "pl_valores_transito",
+    ])
+    df["Data Vínculo"] = pd.to_datetime(df["Data Vínculo"])
+    return df
+
+
+def carregar(df, dia, modo="scd2"):
+    """O que o passo 10/11 do webhook/basebtg grava para `dia`."""
+    snapshot = df.assign(**{"Data": dia, "Mês": dia.strftime("%Y/%m")})
+    resumo = None
+    if modo == "scd2":
+        resumo = app.salvar_snapshot_scd2(snapshot, dia)
+    else:
+        app.salvar_particao(snapshot, "base_btg_snapshot_diario", "Data", *app._intervalo_dia(dia))
+    pl = df[[c for c in app.COLUNAS_PL_HISTORICO if c in df.columns]].rename(
+        columns=app.RENAME_PL_HISTORICO
+    )
+    pl["Data"], pl["Mês"] = dia, dia.strftime("%Y/%m")
+    app.acrescentar_colunas_df("pl_historico_diario", pl)
+    app.salvar_particao(pl, "pl_historico_diario", "Data", *app._intervalo_dia(dia))
+    if modo == "scd2":
+        with app.get_engine().begin() as conn:
+            app._recriar_view_snapshot_scd(conn)
+    return resumo
+
+
+def versoes(engine):
+    return pd.read_sql(
+        "SELECT Conta, Assessor, valid_from, valid_to FROM dbo.base_btg_snapshot_scd "
+        "ORDER BY Conta, valid_from", engine,
+    )
+
+
+def lido(dia, coluna):
+    df = app.ler_snapshot_base(dia).sort_values("Conta")
+    return dict(zip(df["Conta"], df[coluna]))
+
+
+def test_ida_e_volta(engine):
+    # Dia 1 no modo diário: é a semente do SCD2
+    carregar(base(["1", "Ana", "X", 100.0, "2020-01-01", 10.0, 1.0],
+                  ["2", "Bia", "Y", 200.0, "2021-02-02", 20.0, 0.0],
+                  ["3", "Caio", "Z", 300.0, None, 30.0, 0.0]), D1, modo="diario")
+
+    # Dia 2: 1 só muda valores, 2 troca de assessor, 3 sai, 4 entra
+    dia2 = base(["1", "Ana", "X", 111.0, "2020-01-01", 11.0, 5.0],
+                ["2", "Bia", "W", 222.0, "2021-02-02", 22.0, 0.0],
+                ["4", "Duda", "X", 400.0, "2022-03-03", 40.0, 0.0])
+    esperado = {"novas": 1, "alteradas": 1, "encerradas": 1}
+    assert carregar(dia2, D2) == esperado
+    # Reprocessar o dia desfaz a carga anterior dele antes de regravar
+    assert carregar(dia2, D2) == esperado
+
+    scd = versoes(engine)
+    assert list(zip(scd["Conta"], scd["Assessor"], scd["valid_to"].notna())) == [
+        ("1", "X", False),
+        ("2", "Y", True), ("2", "W", False),
+        ("3", "Z", True),
+        ("4", "X", False),
+    ]
+
+    assert lido(D1, "Assessor") == {"1": "X", "2": "Y", "3": "Z"}
+    assert lido(D1, "PL Total") == {"1": 100.0, "2": 200.0, "3": 300.0}
+    assert lido(D2, "Assessor") == {"1": "X", "2": "W", "4": "X"}
+    assert lido(D2, "PL Total") == {"1": 111.0, "2": 222.0, "4": 400.0}
+    assert lido(D2, "pl_valores_transito") == {"1": 5.0, "2": 0.0, "4": 0.0}
+
+    # Dia 3: só valores mudam — nenhuma escrita no SCD2
+    assert carregar(dia2.assign(**{"PL Total": 1.0, "pl_valores_transito": 9.0}), D3) == {
+        "novas": 0, "alteradas": 0, "encerradas": 0,
+    }
+    assert len(versoes(engine)) == 5
+    assert lido(D3, "pl_valores_transito") == {"1": 9.0, "2": 9.0, "4": 9.0}
+
+    # Dia anterior à última carga é recusado
+    with pytest.raises(ValueError):
+        carregar(dia2, D1)
+
+
+def test_hash_de_definicao_antiga_nao_versiona(engine, monkeypatch):
+    """Versão gravada quando pl_valores_transito ainda era rastreada."""
+    dia = base(["1", "Ana", "X", 100.0, "2020-01-01", 10.0, 1.0])
+    with monkeypatch.context() as m:
+        m.setattr(app, "COLUNAS_SCD_RASTREADAS", app.COLUNAS_SCD_RASTREADAS + ["pl_valores_transito"])
+        carregar(dia, D1)
+
+    assert carregar(dia.assign(pl_valores_transito=2.0), D2) == {
+        "novas": 0, "alteradas": 0, "encerradas": 0,
+    }
+    assert len(versoes(engine)) == 1
+    # Hash já regravado: a carga seguinte compara direto
+    assert carregar(dia.assign(Assessor="W"), D3)["alteradas"] == 1
+
+
+def test_pl_historico_antigo_ganha_coluna(engine):
+    antigo = pd.DataFrame({"Conta": ["1"], "PL Total": [1.0], "Data": [D1], "Mês": ["2026/10"]})
+    app.salvar_particao(antigo, "pl_historico_diario", "Data", *app._intervalo_dia(D1))
+
+    carregar(base(["1", "Ana", "X", 100.0, "2020-01-01", 10.0, 3.0]), D2, modo="diario")
+    pl = pd.read_sql('SELECT Data, "Valores em Trânsito" FROM dbo.pl_historico_diario ORDER BY Data', engine)
+    assert pl["Valores em Trânsito"].tolist()[1] == 3.0 and pd.isna(pl["Valores em Trânsito"][0])
+
+
+def test_rota_snapshot_base(engine):
+    carregar(base(["1", "Ana", "X", 100.0, "2020-01-01", 10.0, 1.0],
+                  ["2", "Bia", "Y", 200.0, None, 20.0, 0.0]), D1)
+    cliente = app.app.test_client()
+
+    r = cliente.get("/admin/snapshot-base?data=2026-10-13&conta=2", headers={"X-Webhook-Token": "t"})
+    assert r.status_code == 200
+    assert r.json["contas"] == 1 and r.json["snapshot"][0]["Assessor"] == "Y"
+    assert cliente.get("/admin/snapshot-base?data=ontem", headers={"X-Webhook-Token": "t"}).status_code == 400
+    assert cliente.get("/admin/snapshot-base").status_code == 403
@@ -0,0 +1,2 @@
+#!/bin/sh
+curl -s -H "X-Webhook-Token: $WEBHOOK_TOKEN" https://weebhook-btg.onrender.com/trigger/limpar-arquivo-raw